@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Bot SDK throughput benchmark
+Posts messages through ChatBot against a running local server and reports
+messages per second for unbatched and batched sends
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "client"))
+
+from chat_client import ChatClient, Config
+from chat_bot import ChatBot
+
+async def run_once(client, room_id, count, batch_size):
+    """Send count messages and wait until all of them are broadcast back"""
+    bot = ChatBot(client, batch_size=batch_size)
+    done = asyncio.Event()
+    received = 0
+    
+    def on_message(data):
+        nonlocal received
+        if data.get("type") == "chat_message" and data.get("username") == client.username:
+            received += 1
+            if received >= count:
+                done.set()
+    
+    await bot.open_room(room_id, on_message=on_message)
+    start = time.perf_counter()
+    for i in range(count):
+        await bot.send(room_id, f"bench message {i}")
+    await bot.flush()
+    await asyncio.wait_for(done.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+    batches = bot.rooms[room_id].batches
+    await bot.close()
+    return elapsed, batches
+
+async def main_async(args):
+    client = ChatClient(Config(server_url=args.server_url, websocket_url=args.websocket_url))
+    result = client.login(args.username, args.password)
+    if not result["success"]:
+        print(f"Login failed: {result.get('error')}")
+        return 1
+    
+    for batch_size in args.batch_sizes:
+        elapsed, batches = await run_once(client, args.room, args.count, batch_size)
+        print(f"batch_size={batch_size:<5} {args.count} msgs in {elapsed:6.2f}s "
+              f"-> {args.count / elapsed:9.0f} msg/s ({batches} frames)")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bot send throughput")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--room", type=int, default=1)
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--server-url", default="http://localhost:8000")
+    parser.add_argument("--websocket-url", default="ws://localhost:8000")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
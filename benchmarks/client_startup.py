@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Client cold start benchmark
+Measures import time and time-to-first-frame of the login screen and
+fails when either exceeds its budget or a heavy optional module is loaded
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+CLIENT_DIR = Path(__file__).resolve().parent.parent / "client"
+
+# Modules that must stay unloaded until the feature using them is opened
+LAZY_MODULES = ["pyaudio", "aiortc", "av", "numpy", "requests", "websockets"]
+
+PROBE = '''
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def first_frame():
+    app = main.TerminalChatApp()
+    async with app.run_test(headless=True) as pilot:
+        await pilot.pause()
+        return time.perf_counter()
+
+rendered = asyncio.run(first_frame())
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_frame_ms": (rendered - start) * 1000,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+''' % (LAZY_MODULES,)
+
+def run_probe():
+    """Run one cold start in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=CLIENT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure client cold start time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=400.0)
+    parser.add_argument("--max-first-frame-ms", type=float, default=1500.0)
+    args = parser.parse_args()
+    
+    samples = [run_probe() for _ in range(args.runs)]
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    first_frame_ms = statistics.median(s["first_frame_ms"] for s in samples)
+    loaded = sorted({name for s in samples for name in s["loaded"]})
+    
+    print(f"import main:       {import_ms:8.1f} ms (budget {args.max_import_ms:.0f} ms)")
+    print(f"first frame:       {first_frame_ms:8.1f} ms (budget {args.max_first_frame_ms:.0f} ms)")
+    print(f"eager heavy mods:  {', '.join(loaded) or 'none'}")
+    
+    failed = False
+    if import_ms > args.max_import_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    if first_frame_ms > args.max_first_frame_ms:
+        print("FAIL: time to first frame over budget")
+        failed = True
+    if loaded:
+        print("FAIL: optional modules imported at startup")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
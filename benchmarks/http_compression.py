@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+REST compression benchmark
+Drives the server app in-process over ASGI and reports bytes on the wire
+and server CPU per request for identity, gzip, brotli and 304 responses
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "server"
+sys.path.insert(0, str(SERVER_DIR))
+
+async def request(app, path, headers):
+    """Minimal ASGI client: returns (status, response headers, body)"""
+    raw_path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": raw_path,
+        "raw_path": raw_path.encode(),
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 8000),
+    }
+    response = {"status": None, "headers": {}, "body": b""}
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+    
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+async def measure(app, path, headers, count):
+    """Average wire bytes (status line excluded) and server CPU ms per request"""
+    status, response_headers, body = await request(app, path, headers)
+    header_bytes = sum(len(k) + len(v) + 4 for k, v in response_headers.items())
+    start = time.process_time()
+    for _ in range(count):
+        await request(app, path, headers)
+    cpu_ms = (time.process_time() - start) * 1000 / count
+    return status, header_bytes + len(body), cpu_ms, response_headers
+
+def seed(messages, message_size):
+    from auth import AuthService
+    from database import ChatRoom, Message, RoomMembership, SessionLocal, User
+    
+    db = SessionLocal()
+    user = User(username="bench", email="bench@example.com", hashed_password="", is_active=True, is_verified=True)
+    db.add(user)
+    db.flush()
+    room = db.query(ChatRoom).filter(ChatRoom.name == "general").first()
+    db.add(RoomMembership(user_id=user.id, room_id=room.id))
+    filler = "lorem ipsum dolor sit amet consectetur adipiscing elit "
+    db.add_all([
+        Message(content=(f"message {i} " + filler * (message_size // len(filler) + 1))[:message_size],
+                user_id=user.id, room_id=room.id, message_type="text")
+        for i in range(messages)
+    ])
+    for i in range(200):
+        db.add(ChatRoom(name=f"room-{i:03d}", description="benchmark room " * 4))
+    db.commit()
+    token = AuthService.create_access_token({"sub": "bench"}, timedelta(minutes=60))
+    room_id = room.id
+    db.close()
+    return token, room_id
+
+async def main_async(args):
+    workdir = tempfile.mkdtemp(prefix="chat-http-")
+    # database.py and the archive use paths relative to the working directory
+    os.chdir(workdir)
+    import http_cache
+    import main as server
+    
+    await server.startup_event()
+    token, room_id = seed(args.messages, args.message_size)
+    auth = {"Authorization": f"Bearer {token}"}
+    
+    endpoints = [
+        ("history", f"/rooms/{room_id}/messages?limit={args.limit}"),
+        ("rooms", "/rooms?limit=100"),
+    ]
+    encodings = [("identity", None), ("gzip", "gzip")]
+    if http_cache.brotli:
+        encodings.append(("br", "br"))
+    
+    print(f"{'endpoint':<9} {'response':<10} {'status':>6} {'bytes':>8} {'cpu ms':>8}")
+    for name, path in endpoints:
+        etag = None
+        for label, encoding in encodings:
+            headers = dict(auth)
+            if encoding:
+                headers["Accept-Encoding"] = encoding
+            status, size, cpu_ms, response_headers = await measure(server.app, path, headers, args.requests)
+            etag = response_headers.get("etag", etag)
+            print(f"{name:<9} {label:<10} {status:>6} {size:>8} {cpu_ms:8.3f}")
+        if etag:
+            headers = {**auth, "Accept-Encoding": "gzip", "If-None-Match": etag}
+            status, size, cpu_ms, _ = await measure(server.app, path, headers, args.requests)
+            print(f"{name:<9} {'304':<10} {status:>6} {size:>8} {cpu_ms:8.3f}")
+    
+    await server.shutdown_event()
+    shutil.rmtree(workdir)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure REST response size and server CPU")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--message-size", type=int, default=120)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
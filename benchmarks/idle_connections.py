@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Idle connection soak benchmark
+Starts the server on a scratch database, holds N idle WebSockets open and
+reports server RSS per connection, then checks it is returned on close
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "server"
+sys.path.insert(0, str(SERVER_DIR))
+
+# Source addresses rotate past this many sockets to stay clear of port exhaustion
+SOCKETS_PER_SOURCE = 20000
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def raise_fd_limit(needed: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+def seed(users: int, room_size: int):
+    """Verified users, room_size to a room; returns their tokens"""
+    from sqlalchemy import insert
+    from auth import AuthService
+    from database import ChatRoom, RoomMembership, SessionLocal, User, create_tables
+    
+    create_tables()
+    db = SessionLocal()
+    db.execute(insert(ChatRoom.__table__), [
+        {"id": room + 1, "name": "general" if room == 0 else f"soak-{room}", "is_private": False}
+        for room in range((users + room_size - 1) // room_size)
+    ])
+    db.execute(insert(User.__table__), [
+        {"id": i + 1, "username": f"soak{i}", "email": f"soak{i}@example.com",
+         "hashed_password": "", "is_active": True, "is_verified": True}
+        for i in range(users)
+    ])
+    db.execute(insert(RoomMembership.__table__), [
+        {"user_id": i + 1, "room_id": i // room_size + 1} for i in range(users)
+    ])
+    db.commit()
+    db.close()
+    return [AuthService.create_access_token({"sub": f"soak{i}"}, timedelta(hours=2)) for i in range(users)]
+
+def print_sql_report(report: dict, top: int = 5):
+    """Costliest statements and statements per request or event, from /debug/sql"""
+    print(f"{'count':>8} {'total ms':>9} {'mean ms':>8} {'max ms':>8}  statement")
+    for stats in report["statements"][:top]:
+        print(f"{stats['count']:>8} {stats['total_ms']:>9.1f} {stats['mean_ms']:>8.3f} {stats['max_ms']:>8.1f}  "
+              f"{stats['statement'][:90]}")
+    print(f"{'count':>8} {'queries':>9} {'per':>8} {'max':>8}  scope")
+    for name, stats in list(report["scopes"].items())[:top * 2]:
+        print(f"{stats['count']:>8} {stats['queries']:>9} {stats['queries_per_scope']:>8.1f} "
+              f"{stats['max_queries']:>8}  {name}")
+    full_scans = {entry["statement"] for entry in report["slow"] if entry["full_scan"]}
+    for statement in sorted(full_scans):
+        print(f"slow full scan: {statement[:110]}")
+
+async def discard(ws):
+    # Join notices keep arriving while the room fills; read them like a client
+    try:
+        async for _ in ws:
+            pass
+    except Exception:
+        pass
+
+async def open_sockets(url: str, tokens, room_size: int, count: int, concurrency: int):
+    import websockets
+    
+    sockets = [None] * count
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def connect(i):
+        user = i % len(tokens)
+        source = f"127.0.0.{1 + i // SOCKETS_PER_SOURCE}"
+        async with semaphore:
+            ws = await websockets.connect(
+                f"{url}/ws/{user // room_size + 1}?token={tokens[user]}",
+                local_addr=(source, 0), compression=None, ping_interval=None, open_timeout=60
+            )
+        sockets[i] = (ws, asyncio.create_task(discard(ws)))
+    
+    await asyncio.gather(*(connect(i) for i in range(count)))
+    return sockets
+
+async def main_async(args):
+    workdir = tempfile.mkdtemp(prefix="chat-soak-")
+    os.chdir(workdir)
+    os.environ.setdefault("SECRET_KEY", "soak-benchmark-key")
+    raise_fd_limit(args.connections + 1024)
+    tokens = seed(min(args.users, args.connections), args.room_size)
+    
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning",
+         "--app-dir", str(SERVER_DIR)] + args.uvicorn_args,
+        cwd=workdir
+    )
+    try:
+        url = f"ws://127.0.0.1:{args.port}"
+        for _ in range(100):
+            try:
+                warm = await open_sockets(url, tokens, args.room_size, 1, 1)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        await warm[0][0].close()
+        await asyncio.sleep(1)
+        baseline = rss_kb(server.pid)
+        
+        start = time.perf_counter()
+        sockets = await open_sockets(url, tokens, args.room_size, args.connections, args.concurrency)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(args.settle)
+        loaded = rss_kb(server.pid)
+        per_connection = (loaded - baseline) * 1024 / args.connections
+        print(f"connections      {args.connections:>10} (opened in {elapsed:.1f}s)")
+        print(f"server RSS idle  {baseline / 1024:>10.1f} MB")
+        print(f"server RSS open  {loaded / 1024:>10.1f} MB")
+        print(f"per connection   {per_connection / 1024:>10.2f} KB")
+        print(f"100k projection  {(baseline * 1024 + per_connection * 100000) / 2**30:>10.2f} GB")
+        
+        for ws, reader in sockets:
+            reader.cancel()
+            ws.transport.abort()
+        await asyncio.sleep(args.settle)
+        print(f"server RSS after {rss_kb(server.pid) / 1024:>10.1f} MB (all closed)")
+    finally:
+        server.terminate()
+        server.wait()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure server memory per idle WebSocket")
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=5000, help="distinct users the sockets are spread over")
+    parser.add_argument("--room-size", type=int, default=50, help="members per room")
+    parser.add_argument("--concurrency", type=int, default=200, help="handshakes in flight")
+    parser.add_argument("--settle", type=float, default=5.0, help="seconds to wait before sampling RSS")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("uvicorn_args", nargs=argparse.REMAINDER, help="extra uvicorn options after --")
+    args = parser.parse_args()
+    if args.uvicorn_args[:1] == ["--"]:
+        args.uvicorn_args = args.uvicorn_args[1:]
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
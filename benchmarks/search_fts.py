@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Message search benchmark
+Seeds a throwaway database with a synthetic corpus through the same triggers
+the server uses, then times FTS5 searches against an equivalent LIKE scan
+"""
+
+import argparse
+import itertools
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "server"
+sys.path.insert(0, str(SERVER_DIR))
+
+def make_vocabulary(size, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+def seed(db_path, args):
+    """Create the schema via the server models, then bulk insert messages"""
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    # Zipf-like weights so a few words are very common and most are rare
+    weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+    
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executemany(
+        "INSERT INTO users (id, username, email, hashed_password, is_active) VALUES (?, ?, ?, '', 1)",
+        [(i, f"user{i}", f"user{i}@example.com") for i in range(1, args.users + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO chat_rooms (id, name, created_by) VALUES (?, ?, 1)",
+        [(i, f"room{i}") for i in range(1, args.rooms + 1)]
+    )
+    # user 1 searches and belongs to half of the rooms
+    conn.executemany(
+        "INSERT INTO room_memberships (user_id, room_id) VALUES (1, ?)",
+        [(i,) for i in range(1, args.rooms + 1, 2)]
+    )
+    
+    start = time.perf_counter()
+    batch = 50000
+    for offset in range(0, args.messages, batch):
+        rows = []
+        for _ in range(min(batch, args.messages - offset)):
+            words = rng.choices(vocabulary, cum_weights=weights, k=rng.randint(4, 20))
+            rows.append((" ".join(words), rng.randint(1, args.users), rng.randint(1, args.rooms)))
+        conn.executemany(
+            "INSERT INTO messages (content, user_id, room_id, message_type, timestamp) "
+            "VALUES (?, ?, ?, 'text', CURRENT_TIMESTAMP)",
+            rows
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    print(f"seeded {args.messages} messages in {elapsed:.1f}s "
+          f"({args.messages / elapsed:,.0f} rows/s including index maintenance)")
+    return vocabulary
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FTS5 message search")
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-like", action="store_true", help="skip the LIKE baseline")
+    parser.add_argument("--keep-db", action="store_true", help="keep the seeded database")
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix="chat-search-")
+    # database.py uses a path relative to the working directory
+    os.chdir(workdir)
+    import database
+    from archive import ColdStore
+    from search import search_messages, search_terms
+    
+    database.create_tables()
+    vocabulary = seed(os.path.join(workdir, "chat.db"), args)
+    db = database.SessionLocal()
+    store = ColdStore(os.path.join(workdir, "archive"))
+    
+    common, medium, rare = vocabulary[0], vocabulary[200], vocabulary[-1]
+    queries = [
+        ("rare word", rare, None),
+        ("medium word", medium, None),
+        ("common word", common, None),
+        ("two words", f"{common} {medium}", None),
+        ("prefix", medium[:3], None),
+        ("rare word, one room", rare, 1),
+        ("common word, one room", common, 1),
+    ]
+    print(f"\n{'query':<24} {'fts5 ms':>9} {'like ms':>9} {'hits':>5}")
+    for label, query, room_id in queries:
+        terms = search_terms(query)
+        fts_ms, page = timed(lambda: search_messages(db, store, terms, 1, room_id, 20), args.repeat)
+        like_ms = float("nan")
+        if not args.skip_like:
+            like_sql = database.text(
+                "SELECT id FROM messages WHERE content LIKE :pattern "
+                + ("AND room_id = :room_id " if room_id else "")
+                + "AND room_id IN (SELECT room_id FROM room_memberships WHERE user_id = 1) "
+                "ORDER BY id DESC LIMIT 20"
+            )
+            like_ms, _ = timed(
+                lambda: db.execute(like_sql, {"pattern": f"%{query}%", "room_id": room_id}).all(), 1
+            )
+        print(f"{label:<24} {fts_ms:9.2f} {like_ms:9.2f} {len(page['results']):5}")
+    
+    # Walk several pages of a common term to show keyset paging stays flat
+    terms = search_terms(common)
+    cursor = None
+    print()
+    for number in range(1, 6):
+        elapsed, page = timed(lambda: search_messages(db, store, terms, 1, None, 20, cursor), 1)
+        print(f"page {number}: {elapsed:7.2f} ms")
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    db.close()
+    if args.keep_db:
+        print(f"\ndatabase kept in {workdir}")
+    else:
+        shutil.rmtree(workdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+SFU loopback test
+Connects synthetic tone publishers to an in-process selective forwarding
+unit over localhost and checks that every subscriber receives forwarded
+audio, including with active-speaker selection
+"""
+
+import argparse
+import asyncio
+import fractions
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
+from av import AudioFrame
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+from sfu import SelectiveForwardingUnit, add_candidate, local_candidates
+
+SAMPLE_RATE = 48000
+FRAME_SAMPLES = 960
+
+class ToneTrack(MediaStreamTrack):
+    """Real-time paced sine tone"""
+    
+    kind = "audio"
+    
+    def __init__(self, frequency):
+        super().__init__()
+        self.frequency = frequency
+        self._timestamp = 0
+        self._start = None
+    
+    async def recv(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        else:
+            self._timestamp += FRAME_SAMPLES
+            await asyncio.sleep(max(0, self._start + self._timestamp / SAMPLE_RATE - time.monotonic()))
+        t = (self._timestamp + np.arange(FRAME_SAMPLES)) / SAMPLE_RATE
+        samples = (8000 * np.sin(2 * np.pi * self.frequency * t)).astype(np.int16)
+        frame = AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = SAMPLE_RATE
+        frame.pts = self._timestamp
+        frame.time_base = fractions.Fraction(1, SAMPLE_RATE)
+        return frame
+
+class Client:
+    def __init__(self, user_id, slots):
+        self.user_id = user_id
+        self.slots = slots
+        self.pc = RTCPeerConnection()
+        self.frames = {}
+        self.first_audio = None
+        self.remote_candidates = []
+        
+        @self.pc.on("track")
+        def on_track(track):
+            asyncio.create_task(self.consume(track))
+    
+    async def consume(self, track):
+        self.frames[track.id] = 0
+        try:
+            while True:
+                await track.recv()
+                if self.first_audio is None:
+                    self.first_audio = time.perf_counter()
+                self.frames[track.id] += 1
+        except Exception:
+            pass
+    
+    async def send(self, payload):
+        # Signaling from the SFU: the answer, then trickled candidates
+        if payload["type"] == "sfu_answer":
+            answer = payload["answer"]
+            await self.gathering
+            await self.pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+            for candidate in self.remote_candidates:
+                await add_candidate(self.pc, candidate)
+        elif self.pc.remoteDescription is None:
+            self.remote_candidates.append(payload["candidate"])
+        else:
+            await add_candidate(self.pc, payload["candidate"])
+    
+    async def connect(self, sfu, room_id):
+        """Trickle ICE: offer before gathering, candidates afterwards"""
+        self.pc.addTrack(ToneTrack(200 + 50 * self.user_id))
+        for _ in range(self.slots - 1):
+            self.pc.addTransceiver("audio", direction="recvonly")
+        offer = await self.pc.createOffer()
+        self.gathering = asyncio.create_task(self.pc.setLocalDescription(offer))
+        await sfu.handle_offer(room_id, self.user_id, f"user{self.user_id}",
+                               {"type": offer.type, "sdp": offer.sdp}, self.send, owner=self)
+        await self.gathering
+        for candidate in local_candidates(self.pc):
+            await sfu.add_ice_candidate(room_id, self.user_id, candidate, owner=self)
+        await sfu.add_ice_candidate(room_id, self.user_id, None, owner=self)
+    
+    def total_frames(self):
+        return sum(self.frames.values())
+
+async def main_async(args):
+    sfu = SelectiveForwardingUnit()
+    room_id = 1
+    clients = [Client(user_id, args.slots) for user_id in range(1, args.participants + 1)]
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(client.connect(sfu, room_id) for client in clients))
+    print(f"{len(clients)} participants signaled in {time.perf_counter() - start:.2f}s")
+    
+    await asyncio.sleep(args.seconds)
+    first_audio = [round((c.first_audio - start) * 1000) if c.first_audio else None for c in clients]
+    print("time to first audio (ms):", first_audio)
+    before = [client.total_frames() for client in clients]
+    print("frames received per client:", before)
+    
+    # Only participant 1 speaks: with one slot everyone else should hear it
+    sfu.set_speaking(room_id, 1, True)
+    routes = sfu.rooms[room_id].routes
+    print("routes after speaker change:", {pid: len(slots) for pid, slots in routes.items()})
+    
+    cpu_start = time.process_time()
+    await asyncio.sleep(args.seconds)
+    cpu = time.process_time() - cpu_start
+    after = [client.total_frames() for client in clients]
+    print(f"server+clients CPU: {100 * cpu / args.seconds:.0f}% of one core")
+    
+    failed = [c.user_id for c, b, a in zip(clients, before, after) if a <= b]
+    for client in clients:
+        await sfu.leave(room_id, client.user_id, owner=client)
+        await client.pc.close()
+    if failed:
+        print(f"FAIL: no forwarded audio for participants {failed}")
+        return 1
+    print("OK: every participant receives forwarded audio")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Run synthetic participants through the SFU")
+    parser.add_argument("--participants", type=int, default=4)
+    parser.add_argument("--slots", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
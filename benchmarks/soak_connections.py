@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Connection lifecycle soak test
+Churns sockets through clean closes, malformed frames, handler errors and
+abrupt drops, and fails unless registries, tasks and RSS stay flat
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from idle_connections import SERVER_DIR, print_sql_report, raise_fd_limit, seed
+
+# Each socket runs one of these, picked at random
+SCENARIOS = (
+    "clean",            # chat, read the echo, close
+    "malformed_json",   # not JSON at all
+    "missing_type",     # JSON object without a type
+    "not_an_object",    # valid JSON that is not an object
+    "handler_error",    # a frame the handler raises on
+    "abort",            # TCP reset right after the handshake
+    "abort_mid_frame",  # reset halfway through a frame
+    "half_handshake",   # reset during the HTTP upgrade
+)
+
+def debug_get(base_url: str, token: str, path: str) -> dict:
+    request = urllib.request.Request(f"{base_url}{path}", headers={"Authorization": f"Bearer {token}"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def debug_snapshot(base_url: str, token: str) -> dict:
+    return debug_get(base_url, token, "/debug/connections?collect=true")
+
+async def run_scenario(url: str, port: int, token: str, room_id: int, scenario: str):
+    import websockets
+    
+    if scenario == "half_handshake":
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET /ws/{room_id}?token={token} HTTP/1.1\r\nHost: localhost\r\nUpgrade: webs".encode())
+        await writer.drain()
+        writer.transport.abort()
+        return
+    
+    ws = await websockets.connect(f"{url}/ws/{room_id}?token={token}", compression=None, open_timeout=30)
+    try:
+        if scenario == "clean":
+            await ws.send(json.dumps({"type": "chat_message", "content": "soak"}))
+            await asyncio.wait_for(ws.recv(), 5)
+            await ws.close()
+        elif scenario == "malformed_json":
+            await ws.send("{not json")
+            await ws.close()
+        elif scenario == "missing_type":
+            await ws.send(json.dumps({"content": "no type"}))
+            await ws.close()
+        elif scenario == "not_an_object":
+            await ws.send(json.dumps(["type", "chat_message"]))
+            await ws.close()
+        elif scenario == "handler_error":
+            await ws.send(json.dumps({"type": "chat_batch", "messages": 5}))
+            await asyncio.wait_for(ws.wait_closed(), 5)
+        elif scenario == "abort":
+            ws.transport.abort()
+        elif scenario == "abort_mid_frame":
+            # Text frame header announcing 126+ bytes, then nothing
+            ws.transport.write(b"\x81\xfe\x01\x00\x00\x00\x00\x00abc")
+            ws.transport.abort()
+    except Exception:
+        ws.transport.abort()
+
+async def run_round(args, url: str, tokens, rng: random.Random) -> dict:
+    counts = dict.fromkeys(SCENARIOS, 0)
+    jobs = []
+    for _ in range(args.sockets):
+        user = rng.randrange(len(tokens))
+        scenario = rng.choice(SCENARIOS)
+        counts[scenario] += 1
+        jobs.append(run_scenario(url, args.port, tokens[user], user // args.room_size + 1, scenario))
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    counts["client_errors"] = sum(1 for result in results if isinstance(result, Exception))
+    return counts
+
+async def main_async(args):
+    workdir = tempfile.mkdtemp(prefix="chat-soak-")
+    os.chdir(workdir)
+    os.environ.setdefault("SECRET_KEY", "soak-benchmark-key")
+    raise_fd_limit(args.sockets * 2 + 1024)
+    tokens = seed(args.users, args.room_size)
+    
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning",
+         "--app-dir", str(SERVER_DIR)],
+        cwd=workdir, env={**os.environ, "ADMIN_USERNAMES": "soak0"},
+        stdout=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    url = f"ws://127.0.0.1:{args.port}"
+    rng = random.Random(args.seed)
+    failures = []
+    try:
+        for _ in range(100):
+            try:
+                debug_snapshot(base_url, tokens[0])
+                break
+            except OSError:
+                time.sleep(0.1)
+        
+        print(f"{'round':>5} {'open':>5} {'members':>7} {'sessions':>8} {'alive':>6} {'tasks':>6} "
+              f"{'db':>3} {'rss MB':>7} {'errors':>6} {'malformed':>9}")
+        baseline = None
+        deadline = time.monotonic() + args.duration
+        round_number = 0
+        while round_number < args.rounds or time.monotonic() < deadline:
+            round_number += 1
+            await run_round(args, url, tokens, rng)
+            await asyncio.sleep(args.settle)
+            snap = await asyncio.to_thread(debug_snapshot, base_url, tokens[0])
+            handlers, registries = snap["handlers"], snap["registries"]
+            rss_mb = f"{snap['rss_kb'] / 1024:>7.1f}" if snap["rss_kb"] is not None else f"{'n/a':>7}"
+            print(f"{round_number:>5} {handlers['open']:>5} {registries['room_members']:>7} "
+                  f"{registries['sessions']:>8} {snap['connections_alive']:>6} {snap['tasks']:>6} "
+                  f"{snap['db_connections_checked_out']:>3} {rss_mb} "
+                  f"{handlers['errors']:>6} {handlers['malformed_frames']:>9}")
+            if round_number == args.warmup_rounds:
+                baseline = snap
+            if args.duration <= 0 and round_number >= args.rounds:
+                break
+        
+        final = snap
+        if handlers["open"] != 0:
+            failures.append(f"{handlers['open']} handlers still open")
+        for name, count in final["leaks"].items():
+            if count:
+                failures.append(f"{count} leaked {name}")
+        if registries["room_members"] or registries["sessions"]:
+            failures.append(f"registries not empty: {registries}")
+        if final["db_connections_checked_out"]:
+            failures.append(f"{final['db_connections_checked_out']} database connections checked out")
+        if baseline is not None:
+            if final["tasks"] > baseline["tasks"] + args.task_slack:
+                failures.append(f"tasks grew from {baseline['tasks']} to {final['tasks']}")
+            # The server reports no RSS on platforms without /proc or resource
+            if final["rss_kb"] is not None and baseline["rss_kb"] is not None:
+                growth_mb = (final["rss_kb"] - baseline["rss_kb"]) / 1024
+                if growth_mb > args.rss_slack_mb:
+                    failures.append(f"RSS grew {growth_mb:.1f} MB after warm-up (limit {args.rss_slack_mb} MB)")
+        print_sql_report(debug_get(base_url, tokens[0], "/debug/sql"))
+    finally:
+        server.terminate()
+        server.wait()
+    
+    opened = final["handlers"]["opened"]
+    if failures:
+        print(f"FAIL after {opened} sockets:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print(f"OK: {opened} sockets, no leaks")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak the WebSocket lifecycle and check for leaks")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=0, help="run for this many seconds instead of --rounds")
+    parser.add_argument("--sockets", type=int, default=300, help="sockets per round")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=50, help="members per room")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to let the server catch up per round")
+    parser.add_argument("--warmup-rounds", type=int, default=3, help="rounds before the RSS/task baseline")
+    parser.add_argument("--rss-slack-mb", type=float, default=16.0)
+    parser.add_argument("--task-slack", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
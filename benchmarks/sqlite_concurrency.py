@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+SQLite read/write concurrency benchmark
+Runs history-page reads against a steady stream of message writes, once
+through the server's WAL writer/reader split and once through a single
+engine in rollback-journal mode, and compares read latency
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from idle_connections import print_sql_report
+
+MODES = ("split", "legacy")
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else 0.0
+
+def seed(args):
+    """Schema through the server models, then users, rooms and history"""
+    rng = random.Random(args.seed)
+    conn = sqlite3.connect("chat.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executemany(
+        "INSERT INTO users (id, username, email, hashed_password, is_active) VALUES (?, ?, ?, '', 1)",
+        [(i, f"user{i}", f"user{i}@example.com") for i in range(1, args.users + 1)]
+    )
+    conn.executemany("INSERT INTO chat_rooms (id, name) VALUES (?, ?)", [(i, f"room{i}") for i in range(1, args.rooms + 1)])
+    conn.executemany(
+        "INSERT INTO room_memberships (user_id, room_id) VALUES (?, ?)",
+        [(user, user % args.rooms + 1) for user in range(1, args.users + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO messages (content, user_id, room_id, message_type) VALUES (?, ?, ?, 'text')",
+        ((f"seed message {i}", rng.randint(1, args.users), rng.randint(1, args.rooms)) for i in range(args.messages))
+    )
+    conn.commit()
+    conn.close()
+
+def run_mode(args) -> dict:
+    """Child process: one mode on its own scratch database"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import database
+    from database import Message, RoomMembership, User
+    from read_markers import increment_unread
+    from sql_metrics import sql_metrics
+    
+    database.create_tables()
+    seed(args)
+    if args.run == "split":
+        session_factory = database.SessionLocal
+    else:
+        # The pre-WAL setup: one pooled engine for everything, default journal
+        database.engine.dispose()
+        database.reader_engine.dispose()
+        conn = sqlite3.connect("chat.db")
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        legacy = create_engine(database.DATABASE_URL, connect_args={"check_same_thread": False})
+        sql_metrics.instrument(legacy)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=legacy)
+    
+    sql_metrics.reset()
+    stop = threading.Event()
+    read_latencies, write_latencies = [], []
+    errors = []
+    
+    def reader(seed_offset):
+        rng = random.Random(args.seed + seed_offset)
+        while not stop.is_set():
+            # A member reading their own room, as seeded
+            user_id = rng.randint(1, args.users)
+            room_id = user_id % args.rooms + 1
+            start = time.perf_counter()
+            with sql_metrics.scope("history read"):
+                db = session_factory()
+                try:
+                    # What GET /rooms/{id}/messages does on the hot path
+                    db.query(RoomMembership).filter(
+                        RoomMembership.user_id == user_id, RoomMembership.room_id == room_id
+                    ).first()
+                    db.query(Message.id, Message.content, Message.timestamp, User.username).join(User).filter(
+                        Message.room_id == room_id
+                    ).order_by(Message.id.desc()).limit(50).all()
+                except Exception as e:
+                    errors.append(str(e))
+                finally:
+                    db.close()
+            read_latencies.append(time.perf_counter() - start)
+    
+    def writer(seed_offset):
+        # Paced batches like a room actor's turn: insert, bump unread, commit
+        rng = random.Random(args.seed + seed_offset)
+        interval = args.batch * args.writers / args.write_rate
+        next_at = time.perf_counter()
+        while not stop.is_set():
+            room_id = rng.randint(1, args.rooms)
+            sender = rng.randint(1, args.users)
+            start = time.perf_counter()
+            with sql_metrics.scope("message write"):
+                db = session_factory()
+                try:
+                    db.add_all([
+                        Message(content=f"load message {i}", user_id=sender, room_id=room_id, message_type="text")
+                        for i in range(args.batch)
+                    ])
+                    db.flush()
+                    increment_unread(db, room_id, sender, args.batch)
+                    db.commit()
+                except Exception as e:
+                    errors.append(str(e))
+                finally:
+                    db.close()
+            write_latencies.append(time.perf_counter() - start)
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+    
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(1000 + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    
+    return {
+        "mode": args.run,
+        "reads_per_s": len(read_latencies) / args.duration,
+        "read_p50_ms": percentile(read_latencies, 0.5),
+        "read_p99_ms": percentile(read_latencies, 0.99),
+        "read_max_ms": percentile(read_latencies, 1.0),
+        "writes_per_s": len(write_latencies) * args.batch / args.duration,
+        "commit_p99_ms": percentile(write_latencies, 0.99),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "sql": sql_metrics.report(args.sql_top)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Read latency under sustained write load, WAL split vs single engine")
+    parser.add_argument("--readers", type=int, default=8, help="reader threads")
+    parser.add_argument("--writers", type=int, default=2, help="writer threads, like busy room actors")
+    parser.add_argument("--write-rate", type=float, default=2000, help="target messages per second across writers")
+    parser.add_argument("--batch", type=int, default=20, help="messages per write transaction")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--messages", type=int, default=200000, help="history seeded before the run")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sql-top", type=int, default=5, help="statements per mode in the SQL report (0: none)")
+    parser.add_argument("--run", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.run:
+        print(json.dumps(run_mode(args)))
+        return 0
+    
+    print(f"{args.readers} readers, {args.writers} writers at {args.write_rate:.0f} msg/s in batches of "
+          f"{args.batch}, {args.messages} seeded messages, {args.duration:.0f}s per mode")
+    print(f"{'mode':>6} {'reads/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'writes/s':>9} "
+          f"{'commit p99':>10} {'errors':>6}")
+    results = []
+    for mode in MODES:
+        workdir = tempfile.mkdtemp(prefix=f"chat-sqlite-{mode}-")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", mode] + sys.argv[1:],
+            cwd=workdir, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{mode:>6} {result['reads_per_s']:>8.0f} {result['read_p50_ms']:>7.2f} {result['read_p99_ms']:>7.2f} "
+              f"{result['read_max_ms']:>7.1f} {result['writes_per_s']:>9.0f} {result['commit_p99_ms']:>10.2f} "
+              f"{result['errors']:>6}")
+        if result["first_error"]:
+            print(f"       first error: {result['first_error'][:200]}")
+    if args.sql_top:
+        for result in results:
+            print(f"\nSQL, {result['mode']}:")
+            print_sql_report(result["sql"], args.sql_top)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
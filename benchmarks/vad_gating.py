@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Voice activity detection benchmark
+Runs the capture-side VAD over recorded WAV files and reports how many
+frames are gated, the upstream bandwidth saved and the cost per frame
+"""
+
+import argparse
+import sys
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "client"))
+
+from audio_processing import FRAME_SAMPLES, SAMPLE_RATE, Resampler, VoiceActivityDetector
+
+# Typical Opus voice bitrate used by WebRTC, for the bandwidth estimate
+OPUS_KBPS = 32
+
+def load_wav(path):
+    """Read a 16-bit WAV file as 48 kHz mono int16 samples"""
+    with wave.open(str(path), "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit PCM is supported")
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return Resampler(rate, SAMPLE_RATE).process(samples)
+
+def synthetic_sample(seconds=60, seed=0):
+    """Background noise with intermittent voiced bursts, for runs without recordings"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(seconds * SAMPLE_RATE) / SAMPLE_RATE
+    signal = rng.normal(0, 120, len(t))
+    start = 0.0
+    while start < seconds:
+        length = rng.uniform(0.5, 3.0)
+        mask = (t >= start) & (t < start + length)
+        pitch = rng.uniform(100, 250)
+        signal[mask] += 5000 * np.sin(2 * np.pi * pitch * t[mask]) * (1 + 0.5 * np.sin(2 * np.pi * 4 * t[mask]))
+        start += length + rng.uniform(1.0, 6.0)
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+def run(name, samples):
+    frames = samples[:len(samples) - len(samples) % FRAME_SAMPLES].reshape(-1, FRAME_SAMPLES)
+    vad = VoiceActivityDetector()
+    start = time.perf_counter()
+    sent = sum(vad.process(frame) for frame in frames)
+    elapsed = time.perf_counter() - start
+    gated = len(frames) - sent
+    print(f"{name}: {len(frames)} frames, sent {sent}, gated {gated} "
+          f"({100 * gated / len(frames):.1f}%), upstream {OPUS_KBPS * sent / len(frames):.1f} "
+          f"of {OPUS_KBPS} kbps, {1e6 * elapsed / len(frames):.1f} us/frame")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure VAD gating on recorded audio")
+    parser.add_argument("files", nargs="*", help="16-bit WAV recordings")
+    args = parser.parse_args()
+    
+    if not args.files:
+        run("synthetic (no recordings given)", synthetic_sample())
+    for path in args.files:
+        run(Path(path).name, load_wav(path))
+
+if __name__ == "__main__":
+    main()
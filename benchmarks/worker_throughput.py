@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Worker throughput benchmark
+Runs the launcher with one worker and then with several on a scratch
+database, drives keep-alive HTTP load from client processes, and compares
+requests per second and latency
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from idle_connections import SERVER_DIR, raise_fd_limit, seed
+
+async def http_get(reader, writer, request: bytes):
+    writer.write(request)
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return head[9:12]
+
+async def drive(port: int, path: str, token: str, connections: int, duration: float):
+    """Keep-alive GETs on each connection until duration runs out"""
+    request = (f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+               f"Authorization: Bearer {token}\r\n\r\n").encode()
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    
+    async def connection():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            while True:
+                start = time.perf_counter()
+                if start > deadline:
+                    break
+                status = await http_get(reader, writer, request)
+                latencies.append(time.perf_counter() - start)
+                if status != b"200":
+                    errors += 1
+        finally:
+            writer.close()
+    
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return latencies, errors
+
+def client_process(port: int, path: str, token: str, connections: int, duration: float, results):
+    latencies, errors = asyncio.run(drive(port, path, token, connections, duration))
+    results.put((latencies, errors))
+
+def wait_for_workers(port: int, workers: int, timeout: float = 30.0):
+    """Poll /health over fresh connections until every worker has answered"""
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while len(seen) < workers and time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=5) as response:
+                seen.add(json.loads(response.read()).get("worker"))
+        except OSError:
+            time.sleep(0.1)
+    if len(seen) < workers:
+        raise RuntimeError(f"only {len(seen)} of {workers} workers came up")
+
+def run(args, workdir: str, token: str, workers: int) -> dict:
+    server = subprocess.Popen(
+        [sys.executable, str(SERVER_DIR / "launcher.py"), "--workers", str(workers), "--port", str(args.port),
+         "--drain", "0", "--log-level", "warning"] + args.launcher_args,
+        cwd=workdir, stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_for_workers(args.port, workers)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        clients = [
+            context.Process(target=client_process,
+                            args=(args.port, args.path, token, args.connections, args.duration, results))
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        latencies, errors = [], 0
+        for _ in clients:
+            client_latencies, client_errors = results.get()
+            latencies.extend(client_latencies)
+            errors += client_errors
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+    
+    latencies.sort()
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "rps": len(latencies) / args.duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+        "errors": errors
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single-process and multi-worker throughput")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker count to compare with 1")
+    parser.add_argument("--clients", type=int, default=4, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=32, help="keep-alive connections per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--path", default="/health",
+                        help="endpoint to load; /rooms adds auth and two queries per request")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("launcher_args", nargs=argparse.REMAINDER, help="extra launcher options after --")
+    args = parser.parse_args()
+    if args.launcher_args[:1] == ["--"]:
+        args.launcher_args = args.launcher_args[1:]
+    
+    workdir = tempfile.mkdtemp(prefix="chat-workers-")
+    os.chdir(workdir)
+    os.environ.setdefault("SECRET_KEY", "worker-benchmark-key")
+    raise_fd_limit(args.clients * args.connections + 1024)
+    token = seed(50, 50)[0]
+    
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients x {args.connections} connections, "
+          f"GET {args.path} for {args.duration:.0f}s")
+    print(f"{'workers':>7} {'requests':>9} {'req/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'errors':>6}")
+    runs = []
+    for workers in sorted({1, args.workers}):
+        result = run(args, workdir, token, workers)
+        runs.append(result)
+        print(f"{result['workers']:>7} {result['requests']:>9} {result['rps']:>9.0f} "
+              f"{result['p50_ms']:>7.2f} {result['p99_ms']:>7.2f} {result['errors']:>6}")
+    if len(runs) > 1 and runs[0]["rps"]:
+        print(f"speedup {runs[-1]['rps'] / runs[0]['rps']:.2f}x with {runs[-1]['workers']} workers")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -42,31 +42,30 @@ a = Analysis(
         'asyncio',
         'pyaudio',
         'aiortc',
+        'numpy',
     ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['tkinter'],
     cipher=block_cipher,
     noarchive=False,
 )
 
 pyz = PYZ(a.pure, a.zipped_data, cipher=block_cipher)
 
+# One-folder build: a one-file executable unpacks every library to a temp
+# directory on each launch, which delays the login screen by seconds.
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.zipfiles,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='terminal-chat',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=True,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -75,6 +74,16 @@ exe = EXE(
     entitlements_file=None,
     icon='icon.ico' if platform.system() == 'Windows' else None,
 )
+
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.zipfiles,
+    a.datas,
+    strip=False,
+    upx=False,
+    name='terminal-chat',
+)
 '''
     
     with open('terminal-chat.spec', 'w') as f:
@@ -103,17 +112,17 @@ def build_client():
         print("Failed to build executable")
         return False
     
-    # Move executable to dist folder in root
+    # Move application folder to dist folder in root
     root_dist = Path(__file__).parent / "dist"
     root_dist.mkdir(exist_ok=True)
     
     exe_name = "terminal-chat.exe" if platform.system() == "Windows" else "terminal-chat"
-    source_exe = client_dir / "dist" / exe_name
-    target_exe = root_dist / exe_name
+    source_dir = client_dir / "dist" / "terminal-chat"
+    target_dir = root_dist / "terminal-chat"
     
-    if source_exe.exists():
-        shutil.copy2(source_exe, target_exe)
-        print(f"Executable created: {target_exe}")
+    if (source_dir / exe_name).exists():
+        shutil.copytree(source_dir, target_dir, dirs_exist_ok=True)
+        print(f"Executable created: {target_dir / exe_name}")
         return True
     else:
         print("Executable not found after build")
@@ -125,9 +134,9 @@ def create_installer_script():
         installer_content = '''@echo off
 echo Installing Terminal Chat...
 
-REM Copy executable to Program Files
+REM Copy application folder to Program Files
 if not exist "%ProgramFiles%\\TerminalChat" mkdir "%ProgramFiles%\\TerminalChat"
-copy terminal-chat.exe "%ProgramFiles%\\TerminalChat\\"
+xcopy /E /I /Y terminal-chat "%ProgramFiles%\\TerminalChat"
 
 REM Create desktop shortcut
 echo Creating desktop shortcut...
@@ -148,9 +157,11 @@ pause
         installer_content = '''#!/bin/bash
 echo "Installing Terminal Chat..."
 
-# Copy executable to /usr/local/bin
-sudo cp terminal-chat /usr/local/bin/
-sudo chmod +x /usr/local/bin/terminal-chat
+# Copy application folder to /opt and link the executable into /usr/local/bin
+sudo mkdir -p /opt/terminal-chat
+sudo cp -r terminal-chat/. /opt/terminal-chat/
+sudo chmod +x /opt/terminal-chat/terminal-chat
+sudo ln -sf /opt/terminal-chat/terminal-chat /usr/local/bin/terminal-chat
 
 # Create desktop entry
 mkdir -p ~/.local/share/applications
@@ -190,7 +201,7 @@ def main():
     print("Build completed successfully!")
     print("=" * 50)
     print(f"Platform: {platform.system()} {platform.architecture()[0]}")
-    print(f"Executable: dist/terminal-chat{'exe' if platform.system() == 'Windows' else ''}")
+    print(f"Executable: dist/terminal-chat/terminal-chat{'.exe' if platform.system() == 'Windows' else ''}")
     print(f"Installer: install.{'bat' if platform.system() == 'Windows' else 'sh'}")
     print("\nTo install:")
     if platform.system() == "Windows":
@@ -0,0 +1,260 @@
+"""
+Audio processing building blocks for voice chat
+NumPy-based buffers and sample-rate conversion shared by capture and playback
+"""
+
+from collections import deque
+
+import numpy as np
+
+# WebRTC (Opus) native format: 48 kHz mono, 20 ms frames
+SAMPLE_RATE = 48000
+FRAME_SAMPLES = 960
+
+class RingBuffer:
+    """Single-producer/single-consumer ring buffer of int16 samples.
+    
+    The producer only advances ``write_pos`` and the consumer only advances
+    ``read_pos``, and each index is published after its data, so one capture
+    thread and the event loop can share it without a lock.
+    """
+    
+    def __init__(self, capacity: int):
+        # Round up to a power of two so positions wrap with a mask
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self._mask = size - 1
+        self._data = np.zeros(size, dtype=np.int16)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overruns = 0
+    
+    def available(self) -> int:
+        """Number of samples ready to read"""
+        return self.write_pos - self.read_pos
+    
+    def write(self, samples: np.ndarray) -> int:
+        """Append samples, dropping what does not fit; returns samples written"""
+        free = self.capacity - (self.write_pos - self.read_pos)
+        count = len(samples)
+        if count > free:
+            self.overruns += 1
+            count = free
+        if count == 0:
+            return 0
+        start = self.write_pos & self._mask
+        first = min(count, self.capacity - start)
+        self._data[start:start + first] = samples[:first]
+        self._data[:count - first] = samples[first:count]
+        self.write_pos += count
+        return count
+    
+    def read(self, count: int) -> np.ndarray:
+        """Remove and return exactly count samples; caller checks available()"""
+        start = self.read_pos & self._mask
+        first = min(count, self.capacity - start)
+        out = np.empty(count, dtype=np.int16)
+        out[:first] = self._data[start:start + first]
+        out[first:] = self._data[:count - first]
+        self.read_pos += count
+        return out
+    
+    def skip(self, count: int):
+        """Discard count samples from the read side"""
+        self.read_pos += min(count, self.available())
+
+class Resampler:
+    """Streaming linear-interpolation resampler for int16 mono audio.
+    
+    Keeps the fractional read position and last input sample between calls
+    so consecutive chunks join without clicks.
+    """
+    
+    def __init__(self, src_rate: int, dst_rate: int = SAMPLE_RATE):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.step = src_rate / dst_rate
+        self._pos = 1.0
+        self._tail = np.zeros(1, dtype=np.float32)
+    
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """Convert a chunk of samples at src_rate to dst_rate"""
+        if self.src_rate == self.dst_rate:
+            return samples
+        x = np.concatenate((self._tail, samples.astype(np.float32)))
+        last = len(x) - 1
+        if last < self._pos:
+            self._tail = x[-1:]
+            self._pos -= len(samples)
+            return np.zeros(0, dtype=np.int16)
+        count = int((last - self._pos) // self.step) + 1
+        positions = self._pos + self.step * np.arange(count)
+        out = np.interp(positions, np.arange(len(x)), x)
+        self._pos += self.step * count - last
+        self._tail = x[-1:]
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16)
+
+class JitterBuffer:
+    """Adaptive playout buffer for one remote audio stream.
+    
+    Tracks interarrival jitter (RFC 3550 style) and keeps its target depth
+    a few jitter deviations deep. It re-buffers after an underrun and drops
+    the oldest frames when it grows well past the target. ``push`` runs on
+    the event loop and ``pop`` in the audio callback thread; deque appends
+    and pops are atomic, so no lock is needed.
+    """
+    
+    def __init__(self, min_frames: int = 2, max_frames: int = 10):
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.frames = deque()
+        self.target_frames = min_frames
+        self.jitter = 0.0
+        self.underruns = 0
+        self.late_drops = 0
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._last_arrival = None
+        self._buffering = True
+    
+    def push(self, samples: np.ndarray, arrival: float):
+        """Add decoded 48 kHz mono samples received at time ``arrival``"""
+        if self._last_arrival is not None:
+            expected = len(samples) / SAMPLE_RATE
+            deviation = abs((arrival - self._last_arrival) - expected)
+            self.jitter += (deviation - self.jitter) / 16
+            depth = (4 * self.jitter * SAMPLE_RATE) / FRAME_SAMPLES
+            self.target_frames = int(min(self.max_frames, max(self.min_frames, np.ceil(depth) + 1)))
+        self._last_arrival = arrival
+        
+        # Re-chunk into fixed 20 ms frames
+        if len(self._pending):
+            samples = np.concatenate((self._pending, samples))
+        whole = len(samples) - len(samples) % FRAME_SAMPLES
+        for start in range(0, whole, FRAME_SAMPLES):
+            self.frames.append(samples[start:start + FRAME_SAMPLES])
+        self._pending = samples[whole:]
+        
+        while len(self.frames) > self.target_frames + 3:
+            self.frames.popleft()
+            self.late_drops += 1
+    
+    def pop(self):
+        """Next frame for playout, or None while buffering"""
+        if self._buffering:
+            if len(self.frames) < self.target_frames:
+                return None
+            self._buffering = False
+        try:
+            return self.frames.popleft()
+        except IndexError:
+            self.underruns += 1
+            self._buffering = True
+            return None
+
+def mix_frames(frames) -> np.ndarray:
+    """Sum int16 frames into one, scaling down instead of clipping on overload"""
+    if not frames:
+        return np.zeros(FRAME_SAMPLES, dtype=np.int16)
+    if len(frames) == 1:
+        return frames[0]
+    mixed = np.sum(np.stack(frames).astype(np.int32), axis=0)
+    peak = int(np.max(np.abs(mixed)))
+    if peak > 32767:
+        mixed = mixed * (32767 / peak)
+    return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+class Mixer:
+    """Mixes the jitter buffers of all remote speakers into one stream"""
+    
+    def __init__(self):
+        self.buffers = {}
+        self._silence = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+        # Mixed samples a previous read did not use; only the callback thread touches it
+        self._carry = np.zeros(0, dtype=np.int16)
+    
+    def add(self, key, buffer: JitterBuffer):
+        # Copy-on-write so the audio callback can iterate without a lock
+        self.buffers = {**self.buffers, key: buffer}
+    
+    def remove(self, key):
+        self.buffers = {k: v for k, v in self.buffers.items() if k != key}
+    
+    def next_frame(self) -> np.ndarray:
+        """Pop one frame from every speaker and mix them"""
+        frames = []
+        for buffer in self.buffers.values():
+            frame = buffer.pop()
+            if frame is not None:
+                frames.append(frame)
+        if not frames:
+            return self._silence
+        return mix_frames(frames)
+    
+    def read(self, count: int) -> np.ndarray:
+        """Exactly count mixed samples, whatever size the output device asks for.
+        
+        Whole frames are mixed as needed and the unplayed rest is kept for the
+        next call; while every speaker is buffering the gap is silence.
+        """
+        chunks = [self._carry]
+        have = len(self._carry)
+        while have < count:
+            frame = self.next_frame()
+            chunks.append(frame)
+            have += len(frame)
+        samples = np.concatenate(chunks) if len(chunks) > 1 else self._carry
+        self._carry = samples[count:]
+        return samples[:count]
+
+def frame_features(frames: np.ndarray):
+    """Energy (dBFS) and zero-crossing rate of each row of a 2-D frame array"""
+    samples = frames.astype(np.float32) / 32768.0
+    rms = np.sqrt(np.mean(samples * samples, axis=-1))
+    energy_db = 20 * np.log10(np.maximum(rms, 1e-6))
+    signs = np.signbit(samples)
+    zcr = np.mean(signs[..., 1:] != signs[..., :-1], axis=-1)
+    return energy_db, zcr
+
+class VoiceActivityDetector:
+    """Energy and zero-crossing voice activity detector with hangover.
+    
+    A frame counts as speech when its energy is ``threshold_db`` above an
+    adaptive noise floor and its zero-crossing rate is below ``max_zcr``.
+    Frames that are very loud pass regardless, so fricatives are not cut.
+    After speech ends the detector stays active for ``hangover_frames``
+    so word endings and short pauses are not clipped.
+    """
+    
+    def __init__(self, threshold_db: float = 9.0, min_energy_db: float = -55.0,
+                 max_zcr: float = 0.4, hangover_frames: int = 15):
+        self.threshold_db = threshold_db
+        self.min_energy_db = min_energy_db
+        self.max_zcr = max_zcr
+        self.hangover_frames = hangover_frames
+        self.noise_floor_db = min_energy_db
+        self.speaking = False
+        self._hangover = 0
+    
+    def process(self, frame: np.ndarray) -> bool:
+        """Classify one frame; returns whether it should be sent"""
+        energy, zcr = frame_features(frame)
+        energy = float(energy)
+        
+        # Floor follows quiet frames quickly and rises slowly during speech
+        if energy < self.noise_floor_db:
+            self.noise_floor_db = energy
+        else:
+            rate = 0.001 if self.speaking else 0.02
+            self.noise_floor_db += rate * (energy - self.noise_floor_db)
+        
+        above = energy - max(self.noise_floor_db, self.min_energy_db)
+        voiced = bool(above > self.threshold_db and (zcr < self.max_zcr or above > 2 * self.threshold_db))
+        
+        if voiced:
+            self._hangover = self.hangover_frames
+        elif self._hangover > 0:
+            self._hangover -= 1
+        self.speaking = voiced or self._hangover > 0
+        return self.speaking
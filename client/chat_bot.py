@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Headless chat bot SDK and CLI
+Posts large volumes of messages into rooms without the terminal UI
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Any, Callable, Dict, Optional
+
+from chat_client import ChatClient, Config
+
+# The server rejects chat_batch frames with more messages than this
+MAX_BATCH_MESSAGES = 500
+
+class RoomSender:
+    """Pipelined, batching sender for one room's WebSocket.
+    
+    Messages are queued and written as ``chat_batch`` frames of up to
+    ``batch_size`` messages, waiting at most ``linger`` seconds to fill a
+    batch. When the queue is full ``send`` waits, so producers slow down to
+    the rate the socket can drain. Once the socket fails, ``send`` and
+    ``flush`` raise the error instead of waiting for a writer that is gone.
+    """
+    
+    def __init__(self, websocket, room_id: int, batch_size: int = 100,
+                 linger: float = 0.005, queue_size: int = 10000,
+                 on_message: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.websocket = websocket
+        self.room_id = room_id
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_MESSAGES))
+        self.linger = linger
+        self.on_message = on_message
+        # Why the writer stopped, if it did
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.batches = 0
+        self.received = 0
+        self.error: Optional[BaseException] = None
+        self._writer = asyncio.create_task(self._write_loop())
+        self._reader = asyncio.create_task(self._read_loop())
+    
+    async def send(self, content: str):
+        """Queue a message, waiting while the queue is full"""
+        if self.error:
+            raise self.error
+        await self.queue.put(content)
+        if self.error:
+            # The writer failed while we waited for room; nobody will send this
+            self._discard_queued()
+            raise self.error
+    
+    def _discard_queued(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            self.queue.task_done()
+    
+    async def _write_loop(self):
+        try:
+            await self._write_batches()
+        except Exception as e:
+            self.error = e
+            self._discard_queued()
+    
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            
+            if len(batch) == 1:
+                frame = {"type": "chat_message", "content": batch[0]}
+            else:
+                frame = {"type": "chat_batch", "messages": batch}
+            try:
+                # send() waits for the transport to drain past its write limit
+                await self.websocket.send(json.dumps(frame))
+                self.sent += len(batch)
+                self.batches += 1
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+    
+    async def _read_loop(self):
+        # Drain broadcasts so the server never blocks writing to us
+        import websockets
+        
+        try:
+            async for message in self.websocket:
+                self.received += 1
+                if self.on_message:
+                    self.on_message(json.loads(message))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+    
+    async def flush(self):
+        """Wait until every queued message has been written"""
+        await self.queue.join()
+        if self.error:
+            raise self.error
+    
+    async def close(self):
+        """Flush pending messages and close the socket"""
+        try:
+            await self.flush()
+        finally:
+            self._writer.cancel()
+            await self.websocket.close()
+            self._reader.cancel()
+
+class ChatBot:
+    """Headless client that shares ChatClient authentication.
+    
+    Each room gets its own socket (the server's WebSocket endpoint is scoped
+    per room); all rooms are multiplexed on one event loop.
+    """
+    
+    def __init__(self, client: ChatClient, batch_size: int = 100,
+                 linger: float = 0.005, queue_size: int = 10000):
+        self.client = client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue_size = queue_size
+        self.rooms: Dict[int, RoomSender] = {}
+    
+    async def open_room(self, room_id: int,
+                        on_message: Optional[Callable[[Dict[str, Any]], None]] = None) -> RoomSender:
+        """Join a room and open its pipelined sender"""
+        if room_id in self.rooms:
+            return self.rooms[room_id]
+        if not self.client.token:
+            raise Exception("Not authenticated")
+        
+        import websockets
+        
+        result = await asyncio.to_thread(self.client.join_room, room_id)
+        if not result["success"]:
+            raise Exception(f"Failed to join room {room_id}: {result}")
+        
+        ws_url = f"{self.client.config.websocket_url}/ws/{room_id}?token={self.client.token}"
+        websocket = await websockets.connect(ws_url, max_queue=None)
+        sender = RoomSender(
+            websocket, room_id,
+            batch_size=self.batch_size,
+            linger=self.linger,
+            queue_size=self.queue_size,
+            on_message=on_message,
+        )
+        self.rooms[room_id] = sender
+        return sender
+    
+    async def send(self, room_id: int, content: str):
+        """Queue a message for a room, opening the room on first use"""
+        sender = self.rooms.get(room_id) or await self.open_room(room_id)
+        await sender.send(content)
+    
+    async def flush(self):
+        """Wait for every room's queue to drain"""
+        await asyncio.gather(*(sender.flush() for sender in self.rooms.values()))
+    
+    async def close(self):
+        """Flush and close every room"""
+        await asyncio.gather(*(sender.close() for sender in self.rooms.values()))
+        self.rooms.clear()
+
+async def read_lines(paths):
+    """Yield lines from the given files, or stdin when none are given.
+    
+    Reads happen off the event loop so queued messages keep flowing while
+    waiting on a slow pipe such as ``tail -f``.
+    """
+    if not paths or paths == ["-"]:
+        streams = [sys.stdin]
+    else:
+        streams = [open(path, encoding="utf-8") for path in paths]
+    for stream in streams:
+        try:
+            while True:
+                line = await asyncio.to_thread(stream.readline)
+                if not line:
+                    break
+                yield line.rstrip("\n")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+async def run_cli(args):
+    config = Config(server_url=args.server_url, websocket_url=args.websocket_url)
+    client = ChatClient(config)
+    result = client.login(args.username, args.password)
+    if not result["success"]:
+        print(f"Login failed: {result.get('error')}", file=sys.stderr)
+        return 1
+    
+    bot = ChatBot(client, batch_size=args.batch_size, linger=args.linger)
+    count = 0
+    try:
+        async for line in read_lines(args.files):
+            if not line.strip():
+                continue
+            if args.json:
+                # {"room_id": 1, "content": "..."} per line
+                record = json.loads(line)
+                await bot.send(int(record.get("room_id", args.room)), record["content"])
+            else:
+                await bot.send(args.room, line)
+            count += 1
+        await bot.close()
+    except Exception as e:
+        print(f"Sending failed after {count} messages: {e!r}", file=sys.stderr)
+        return 1
+    print(f"Sent {count} messages", file=sys.stderr)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Post messages to Terminal Chat rooms")
+    parser.add_argument("files", nargs="*", help="input files (default: stdin)")
+    parser.add_argument("--room", type=int, default=1, help="default room id")
+    parser.add_argument("--json", action="store_true",
+                        help="read JSON lines with room_id and content")
+    parser.add_argument("--username", default=os.getenv("CHAT_BOT_USERNAME"))
+    parser.add_argument("--password", default=os.getenv("CHAT_BOT_PASSWORD"))
+    parser.add_argument("--server-url", default=os.getenv("SERVER_URL", Config.server_url))
+    parser.add_argument("--websocket-url", default=os.getenv("WEBSOCKET_URL", Config.websocket_url))
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help=f"messages per chat_batch frame (at most {MAX_BATCH_MESSAGES})")
+    parser.add_argument("--linger", type=float, default=0.005,
+                        help="seconds to wait for a batch to fill")
+    args = parser.parse_args()
+    
+    if not args.username or not args.password:
+        parser.error("--username and --password (or CHAT_BOT_USERNAME/CHAT_BOT_PASSWORD) are required")
+    sys.exit(asyncio.run(run_cli(args)))
+
+if __name__ == "__main__":
+    main()
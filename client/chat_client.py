@@ -1,27 +1,103 @@
-import requests
 import json
 import asyncio
-import websockets
-from typing import Optional, Dict, Any
+import hashlib
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List
+
+# requests and websockets are imported on first use so the login screen
+# can render before the networking stack has been loaded.
 from dataclasses import dataclass
 
 @dataclass
 class Config:
     server_url: str = "http://localhost:8000"
     websocket_url: str = "ws://localhost:8000"
+    # Background history prefetch after login
+    prefetch_rooms: int = 8
+    prefetch_concurrency: int = 3
+    prefetch_byte_budget: int = 2_000_000
+    room_refresh_interval: float = 30.0
+    # Read acknowledgements are batched and sent at most this often
+    read_ack_delay: float = 1.0
+    # Reconnect after a server restart or drain, at a random delay up to this
+    reconnect_max_delay: float = 5.0
+    # Unacknowledged messages are resent after this many seconds, and at most
+    # this many are kept waiting
+    ack_timeout: float = 10.0
+    max_pending_sends: int = 500
+    # Messages still unacknowledged after this many seconds, including ones
+    # for a room the user has since left, are given up on as failed
+    pending_send_ttl: float = 300.0
+    # Attachment uploads go up in chunks of this size, each retried on failure
+    upload_chunk_size: int = 4 * 1024 * 1024
+    upload_retries: int = 5
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_attachment(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """sha256, size and filename of a "file" message, else None"""
+    if message.get("message_type") != "file":
+        return None
+    try:
+        return json.loads(message["content"])
+    except (KeyError, ValueError):
+        return None
+
+def wire_bytes(response) -> int:
+    """Bytes a response took to download: the encoded Content-Length, which
+    for a compressed body is far less than the decoded content"""
+    length = response.headers.get("Content-Length", "")
+    if length.isdigit():
+        return int(length)
+    # Chunked: only the decoded size is known
+    return len(response.content)
 
 class ChatClient:
     def __init__(self, config: Config):
         self.config = config
         self.token: Optional[str] = None
         self.username: Optional[str] = None
-        self.websocket: Optional[websockets.WebSocketServerProtocol] = None
+        self.websocket = None
         self.current_room_id: Optional[int] = None
+        self._http = None
+        
+        # Local caches used for conditional requests and instant room opens
+        self.rooms_cache: List[Dict[str, Any]] = []
+        self.rooms_etag: Optional[str] = None
+        self.history_cache: Dict[int, List[Dict[str, Any]]] = {}
+        self.history_etags: Dict[int, str] = {}
+        self.recent_rooms: List[int] = []
+        self.room_activity: Dict[int, int] = {}
+        
+        # Sent messages not yet acknowledged, by client message id; kept across
+        # reconnects and resent under the same id, which the server dedups
+        self.pending_sends: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Messages given up on, for the UI to report and clear
+        self.failed_sends: List[Dict[str, Any]] = []
         
+        # Unread mentions handed over at login, newest first
+        self.pending_mentions: List[Dict[str, Any]] = []
+    
+    @property
+    def http(self):
+        """HTTP session, created on first request"""
+        if self._http is None:
+            import requests
+            self._http = requests.Session()
+        return self._http
+    
     def register(self, username: str, email: str, password: str) -> Dict[str, Any]:
         """Register a new user"""
         try:
-            response = requests.post(
+            response = self.http.post(
                 f"{self.config.server_url}/register",
                 json={
                     "username": username,
@@ -36,7 +112,7 @@ class ChatClient:
     def login(self, username: str, password: str) -> Dict[str, Any]:
         """Login user and get token"""
         try:
-            response = requests.post(
+            response = self.http.post(
                 f"{self.config.server_url}/login",
                 json={
                     "username": username,
@@ -47,6 +123,7 @@ class ChatClient:
                 data = response.json()
                 self.token = data["access_token"]
                 self.username = username
+                self.pending_mentions = data.get("pending_mentions", [])
                 return {"success": True, "data": data}
             else:
                 return {"success": False, "error": response.json()}
@@ -54,14 +131,22 @@ class ChatClient:
             return {"success": False, "error": str(e)}
     
     def get_rooms(self) -> Dict[str, Any]:
-        """Get available chat rooms"""
+        """Get available chat rooms, revalidating the cached list"""
         if not self.token:
             return {"success": False, "error": "Not authenticated"}
         
         try:
             headers = {"Authorization": f"Bearer {self.token}"}
-            response = requests.get(f"{self.config.server_url}/rooms", headers=headers)
-            return {"success": response.status_code == 200, "data": response.json()}
+            if self.rooms_etag:
+                headers["If-None-Match"] = self.rooms_etag
+            response = self.http.get(f"{self.config.server_url}/rooms", headers=headers)
+            if response.status_code == 304:
+                return {"success": True, "data": self.rooms_cache, "not_modified": True}
+            if response.status_code == 200:
+                self.rooms_cache = response.json()
+                self.rooms_etag = response.headers.get("ETag")
+                return {"success": True, "data": self.rooms_cache, "not_modified": False}
+            return {"success": False, "data": response.json()}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
@@ -72,7 +157,7 @@ class ChatClient:
         
         try:
             headers = {"Authorization": f"Bearer {self.token}"}
-            response = requests.post(
+            response = self.http.post(
                 f"{self.config.server_url}/rooms/{room_id}/join",
                 headers=headers
             )
@@ -81,55 +166,350 @@ class ChatClient:
             return {"success": False, "error": str(e)}
     
     def get_messages(self, room_id: int, limit: int = 50) -> Dict[str, Any]:
-        """Get chat history for a room"""
+        """Get chat history for a room, revalidating the cached page"""
         if not self.token:
             return {"success": False, "error": "Not authenticated"}
         
         try:
             headers = {"Authorization": f"Bearer {self.token}"}
-            response = requests.get(
+            if room_id in self.history_cache and room_id in self.history_etags:
+                headers["If-None-Match"] = self.history_etags[room_id]
+            response = self.http.get(
                 f"{self.config.server_url}/rooms/{room_id}/messages?limit={limit}",
                 headers=headers
             )
-            return {"success": response.status_code == 200, "data": response.json()}
+            if response.status_code == 304:
+                return {"success": True, "data": self.history_cache[room_id], "not_modified": True, "bytes": 0}
+            if response.status_code == 200:
+                self.history_cache[room_id] = response.json()
+                if response.headers.get("ETag"):
+                    self.history_etags[room_id] = response.headers["ETag"]
+                return {
+                    "success": True,
+                    "data": self.history_cache[room_id],
+                    "not_modified": False,
+                    "bytes": wire_bytes(response),
+                }
+            return {"success": False, "data": response.json(), "bytes": wire_bytes(response)}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    def get_cached_messages(self, room_id: int) -> Optional[List[Dict[str, Any]]]:
+        """Return prefetched history for a room, if any"""
+        return self.history_cache.get(room_id)
+    
+    def cache_message(self, room_id: int, message: Dict[str, Any]):
+        """Append a live message to the cached history of a room"""
+        self.room_activity[room_id] = self.room_activity.get(room_id, 0) + 1
+        if room_id in self.history_cache:
+            self.history_cache[room_id].append(message)
+            # The cached page no longer matches the server's validator
+            self.history_etags.pop(room_id, None)
+    
+    def mark_room_used(self, room_id: int):
+        """Move a room to the front of the most-recently-used list"""
+        if room_id in self.recent_rooms:
+            self.recent_rooms.remove(room_id)
+        self.recent_rooms.insert(0, room_id)
+    
     async def connect_websocket(self, room_id: int):
         """Connect to WebSocket for real-time chat"""
         if not self.token:
             raise Exception("Not authenticated")
         
+        import websockets
+        
+        # One room socket at a time
+        if self.websocket:
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+            self.websocket = None
+        
         ws_url = f"{self.config.websocket_url}/ws/{room_id}?token={self.token}"
         self.websocket = await websockets.connect(ws_url)
         self.current_room_id = room_id
+        await self.resend_pending()
+    
+    async def send_message(self, content: str) -> str:
+        """Send a message through WebSocket; returns its client message id.
+        
+        The message stays queued until the server acknowledges it, so a send
+        lost to a dropped connection goes out again after reconnecting.
+        """
+        return await self.queue_frame({"type": "chat_message", "content": content})
+    
+    async def send_file_message(self, sha256: str, filename: str) -> str:
+        """Post an uploaded attachment to the current room by its hash"""
+        return await self.queue_frame({"type": "file_message", "sha256": sha256, "filename": filename})
+    
+    async def queue_frame(self, frame: Dict[str, Any]) -> str:
+        if not self.websocket:
+            raise Exception("WebSocket not connected")
+        self.expire_pending()
+        if len(self.pending_sends) >= self.config.max_pending_sends:
+            raise Exception("Too many messages waiting for the server")
+        
+        client_msg_id = uuid.uuid4().hex
+        self.pending_sends[client_msg_id] = {"room_id": self.current_room_id, "frame": frame, "sent_at": 0.0,
+                                             "queued_at": time.monotonic()}
+        await self.send_pending(client_msg_id)
+        return client_msg_id
+    
+    async def send_pending(self, client_msg_id: str):
+        """Send one queued message; a failed send waits for the next resend"""
+        import websockets
+        
+        entry = self.pending_sends.get(client_msg_id)
+        if entry is None or not self.websocket:
+            return
+        entry["sent_at"] = time.monotonic()
+        try:
+            await self.websocket.send(json.dumps({**entry["frame"], "client_msg_id": client_msg_id}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+    
+    def expire_pending(self):
+        """Move messages queued over pending_send_ttl ago, in any room, to failed_sends.
+        
+        Other rooms' messages are resent when their room is joined again; this
+        bounds how long they wait for that.
+        """
+        cutoff = time.monotonic() - self.config.pending_send_ttl
+        # Oldest first, so expired entries are at the front
+        while self.pending_sends:
+            client_msg_id, entry = next(iter(self.pending_sends.items()))
+            if entry["queued_at"] > cutoff:
+                break
+            del self.pending_sends[client_msg_id]
+            self.failed_sends.append({"client_msg_id": client_msg_id, "room_id": entry["room_id"],
+                                      "frame": entry["frame"]})
+    
+    async def resend_pending(self, older_than: float = 0.0):
+        """Resend this room's unacknowledged messages sent over older_than seconds ago"""
+        self.expire_pending()
+        cutoff = time.monotonic() - older_than
+        for client_msg_id, entry in list(self.pending_sends.items()):
+            if not self.websocket:
+                return
+            if entry["room_id"] == self.current_room_id and entry["sent_at"] <= cutoff:
+                await self.send_pending(client_msg_id)
+    
+    def acknowledge(self, data: Dict[str, Any]):
+        """Drop messages the server has stored, or will never store, from the pending queue"""
+        if data.get("type") == "ack":
+            client_msg_ids = [ack.get("client_msg_id") for ack in data.get("messages", [])]
+        elif not data.get("retry", True):
+            client_msg_ids = data.get("client_msg_ids", [])
+        else:
+            return
+        for client_msg_id in client_msg_ids:
+            self.pending_sends.pop(client_msg_id, None)
     
-    async def send_message(self, content: str):
-        """Send a message through WebSocket"""
+    async def send_direct_message(self, username: str, content: str):
+        """Send a direct message to a user through the open WebSocket"""
         if not self.websocket:
             raise Exception("WebSocket not connected")
+        await self.websocket.send(json.dumps({"type": "direct_message", "to": username, "content": content}))
+    
+    def get_direct_messages(self, username: str, limit: int = 50) -> Dict[str, Any]:
+        """Get direct message history with a user"""
+        if not self.token:
+            return {"success": False, "error": "Not authenticated"}
+        
+        try:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = self.http.get(
+                f"{self.config.server_url}/direct/{username}?limit={limit}",
+                headers=headers
+            )
+            return {"success": response.status_code == 200, "data": response.json()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def upload_file(self, path: str) -> Dict[str, Any]:
+        """Upload a file in chunks; data holds the sha256 to post it with.
         
-        message = {
-            "type": "chat_message",
-            "content": content
-        }
-        await self.websocket.send(json.dumps(message))
+        A failed chunk is retried from wherever the server says the upload
+        stands, and a file the server already has is not sent at all.
+        """
+        if not self.token:
+            return {"success": False, "error": "Not authenticated"}
+        
+        import requests
+        
+        try:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            base = f"{self.config.server_url}/attachments"
+            size = os.path.getsize(path)
+            filename = os.path.basename(path)
+            sha256 = file_sha256(path)
+            if self.http.head(f"{base}/{sha256}", headers=headers).status_code == 200:
+                return {"success": True, "data": {"sha256": sha256, "size": size, "filename": filename}}
+            
+            response = self.http.post(f"{base}/uploads", json={"filename": filename, "size": size}, headers=headers)
+            if response.status_code != 200:
+                return {"success": False, "error": response.json()}
+            upload_url = f"{base}/uploads/{response.json()['upload_id']}"
+            offset = 0
+            failures = 0
+            with open(path, "rb") as f:
+                while True:
+                    f.seek(offset)
+                    chunk = f.read(self.config.upload_chunk_size)
+                    try:
+                        response = self.http.put(f"{upload_url}?offset={offset}", data=chunk, headers=headers)
+                        if response.status_code == 409:
+                            # Out of step, or an earlier attempt is still writing
+                            raise requests.RequestException(response.json().get("detail"))
+                    except requests.RequestException:
+                        failures += 1
+                        if failures > self.config.upload_retries:
+                            raise
+                        time.sleep(min(2 ** failures, 30))
+                        offset = self.http.get(upload_url, headers=headers).json()["offset"]
+                        continue
+                    if response.status_code != 200:
+                        return {"success": False, "error": response.json()}
+                    data = response.json()
+                    if "sha256" in data:
+                        return {"success": True, "data": data}
+                    offset = data["offset"]
+                    failures = 0
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def download_attachment(self, sha256: str, path: str) -> Dict[str, Any]:
+        """Download an attachment to path, resuming a partial file with a Range request"""
+        if not self.token:
+            return {"success": False, "error": "Not authenticated"}
+        
+        try:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+            with self.http.get(f"{self.config.server_url}/attachments/{sha256}", headers=headers,
+                               stream=True) as response:
+                if response.status_code == 416:
+                    # Already complete
+                    return {"success": True, "data": {"path": path, "size": offset}}
+                if response.status_code not in (200, 206):
+                    return {"success": False, "error": response.status_code}
+                # A 200 is the whole file, whatever we asked for
+                with open(path, "ab" if response.status_code == 206 else "wb") as f:
+                    for block in response.iter_content(1024 * 1024):
+                        f.write(block)
+            return {"success": True, "data": {"path": path, "size": os.path.getsize(path)}}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def get_mentions(self, before: Optional[int] = None, limit: int = 50, unread: bool = False) -> Dict[str, Any]:
+        """Page through the mention inbox, newest first"""
+        if not self.token:
+            return {"success": False, "error": "Not authenticated"}
+        
+        try:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            params = {"limit": limit, "unread": str(unread).lower()}
+            if before:
+                params["before"] = before
+            response = self.http.get(f"{self.config.server_url}/mentions", params=params, headers=headers)
+            return {"success": response.status_code == 200, "data": response.json()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def mark_mentions_read(self, up_to: int) -> Dict[str, Any]:
+        """Mark mentions up to id up_to as seen"""
+        if not self.token:
+            return {"success": False, "error": "Not authenticated"}
+        
+        try:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            response = self.http.post(f"{self.config.server_url}/mentions/read?up_to={up_to}", headers=headers)
+            if response.status_code == 200:
+                self.pending_mentions = [m for m in self.pending_mentions if m["id"] > up_to]
+            return {"success": response.status_code == 200, "data": response.json()}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
     
-    async def listen_messages(self, callback):
-        """Listen for incoming messages"""
+    async def send_read_ack(self, message_id: int):
+        """Tell the server messages up to message_id have been displayed"""
+        if not self.websocket:
+            return
+        await self.websocket.send(json.dumps({"type": "read", "message_id": message_id}))
+    
+    async def listen_messages(self, callback) -> Optional[int]:
+        """Listen for incoming messages; returns the close code"""
         if not self.websocket:
             raise Exception("WebSocket not connected")
         
+        import websockets
+        
+        websocket = self.websocket
         try:
-            async for message in self.websocket:
+            async for message in websocket:
                 data = json.loads(message)
+                if data.get("type") in ("ack", "error"):
+                    self.acknowledge(data)
                 callback(data)
         except websockets.exceptions.ConnectionClosed:
             pass
+        return websocket.close_code
     
     async def disconnect(self):
         """Disconnect from WebSocket"""
         if self.websocket:
             await self.websocket.close()
             self.websocket = None
-            self.current_room_id = None
\ No newline at end of file
+            self.current_room_id = None
+
+class HistoryPrefetcher:
+    """Prefetches room histories in the background after login.
+    
+    Rooms are ranked most-recently-used first, then by observed activity.
+    At most ``concurrency`` requests are in flight and no new fetch starts
+    once ``byte_budget`` bytes have been downloaded.
+    """
+    
+    def __init__(self, client: ChatClient, max_rooms: Optional[int] = None,
+                 concurrency: Optional[int] = None, byte_budget: Optional[int] = None):
+        self.client = client
+        self.max_rooms = max_rooms if max_rooms is not None else client.config.prefetch_rooms
+        self.concurrency = concurrency if concurrency is not None else client.config.prefetch_concurrency
+        self.byte_budget = byte_budget if byte_budget is not None else client.config.prefetch_byte_budget
+        self.bytes_used = 0
+        self._tasks: List[asyncio.Task] = []
+    
+    def rank_rooms(self, rooms: List[Dict[str, Any]]) -> List[int]:
+        """Order member room ids by recency of use, then by activity"""
+        # History of rooms the user has not joined is forbidden anyway
+        room_ids = [room["id"] for room in rooms if room.get("is_member")]
+        known = set(room_ids)
+        ranked = [room_id for room_id in self.client.recent_rooms if room_id in known]
+        rest = [room_id for room_id in room_ids if room_id not in ranked]
+        rest.sort(key=lambda room_id: -self.client.room_activity.get(room_id, 0))
+        return (ranked + rest)[:self.max_rooms]
+    
+    async def run(self, rooms: List[Dict[str, Any]]):
+        """Prefetch history for the highest ranked rooms"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def fetch(room_id: int):
+            async with semaphore:
+                if self.bytes_used >= self.byte_budget:
+                    return
+                result = await asyncio.to_thread(self.client.get_messages, room_id)
+                self.bytes_used += result.get("bytes", 0)
+        
+        self._tasks = [asyncio.create_task(fetch(room_id)) for room_id in self.rank_rooms(rooms)]
+        try:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            self._tasks = []
+    
+    def cancel(self):
+        """Cancel all pending prefetches"""
+        for task in self._tasks:
+            task.cancel()
@@ -2,13 +2,22 @@ from textual.app import App, ComposeResult
 from textual.containers import Container, Horizontal, Vertical
 from textual.widgets import Header, Footer, Input, Static, ListView, ListItem, Button, Label
 from textual.reactive import reactive
-from textual import events
 from textual.screen import Screen
-from rich.text import Text
-from rich.console import Console
 import asyncio
+import random
 from datetime import datetime
-from chat_client import ChatClient, Config
+from typing import Optional
+from chat_client import ChatClient, Config, HistoryPrefetcher, parse_attachment
+
+RECONNECT_CLOSE_CODES = (1001, 1012)
+RECONNECT_ATTEMPTS = 5
+
+def format_content(message) -> str:
+    """Message text, or a line describing an attachment"""
+    attachment = parse_attachment(message)
+    if attachment is None:
+        return message["content"]
+    return f"📎 {attachment['filename']} ({attachment['size']:,} bytes) [dim]{attachment['sha256'][:12]}[/]"
 
 class LoginScreen(Screen):
     """Login/Register screen"""
@@ -119,6 +128,15 @@ class MainChatScreen(Screen):
     
     current_room = reactive(None)
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetcher: Optional[HistoryPrefetcher] = None
+        self.prefetch_task: Optional[asyncio.Task] = None
+        # Highest displayed message id not yet acknowledged to the server
+        self.read_ack_pending: Optional[int] = None
+        # Receive loop of the open room's socket
+        self.listen_task: Optional[asyncio.Task] = None
+    
     def compose(self) -> ComposeResult:
         yield Header()
         yield Container(
@@ -147,38 +165,93 @@ class MainChatScreen(Screen):
     
     def on_mount(self) -> None:
         self.load_rooms()
+        self.start_prefetch()
+        self.set_interval(self.app.client.config.room_refresh_interval, self.refresh_rooms)
+        self.set_interval(self.app.client.config.ack_timeout, self.resend_unacknowledged)
+        self.show_pending_mentions()
+    
+    def on_unmount(self) -> None:
+        if self.prefetcher:
+            self.prefetcher.cancel()
     
     def load_rooms(self):
         """Load available chat rooms"""
         result = self.app.client.get_rooms()
         if result["success"]:
-            rooms_list = self.query_one("#rooms_list", ListView)
-            rooms_list.clear()
-            
-            for room in result["data"]:
-                item = ListItem(
-                    Label(f"#{room['name']}"),
-                    classes="room-item"
-                )
-                item.room_data = room
-                rooms_list.append(item)
+            self.show_rooms(result)
         else:
             self.notify("Failed to load rooms", severity="error")
     
-    def on_button_pressed(self, event: Button.Pressed) -> None:
+    async def refresh_rooms(self):
+        """Revalidate the room list in the background"""
+        result = await asyncio.to_thread(self.app.client.get_rooms)
+        if result["success"]:
+            self.show_rooms(result)
+    
+    def show_pending_mentions(self):
+        """Mentions that arrived while logged out"""
+        client = self.app.client
+        mentions = client.pending_mentions
+        if not mentions:
+            return
+        latest = mentions[0]
+        more = f" (+{len(mentions) - 1} more)" if len(mentions) > 1 else ""
+        self.notify(f"{latest['from']} mentioned you: {latest['preview']}{more}", timeout=10)
+        asyncio.create_task(asyncio.to_thread(client.mark_mentions_read, latest["id"]))
+    
+    async def resend_unacknowledged(self):
+        """Resend messages the server has not acknowledged in time"""
+        client = self.app.client
+        if client.websocket:
+            await client.resend_pending(older_than=client.config.ack_timeout)
+        else:
+            client.expire_pending()
+        if client.failed_sends:
+            failed, client.failed_sends = client.failed_sends, []
+            rooms = {room["id"]: room["name"] for room in client.rooms_cache}
+            names = sorted({rooms.get(entry["room_id"], f"room {entry['room_id']}") for entry in failed})
+            self.notify(f"{len(failed)} message(s) could not be delivered to {', '.join(names)}",
+                        severity="error", timeout=10)
+    
+    def show_rooms(self, result):
+        """Rebuild the room list unless the server reported no change"""
+        rooms_list = self.query_one("#rooms_list", ListView)
+        if result.get("not_modified") and len(rooms_list.children):
+            return
+        rooms_list.clear()
+        
+        for room in result["data"]:
+            label = f"#{room['name']}"
+            if room.get("unread_count") and room["id"] != self.current_room:
+                label += f" ({room['unread_count']})"
+            item = ListItem(
+                Label(label),
+                classes="room-item"
+            )
+            item.room_data = room
+            rooms_list.append(item)
+    
+    def start_prefetch(self):
+        """Prefetch room histories so opening a room is instant"""
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.prefetcher = HistoryPrefetcher(self.app.client)
+        self.prefetch_task = asyncio.create_task(self.prefetcher.run(self.app.client.rooms_cache))
+    
+    async def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "refresh_rooms":
             self.load_rooms()
         elif event.button.id == "send_message":
-            self.send_message()
+            await self.send_message()
     
-    def on_input_submitted(self, event: Input.Submitted) -> None:
+    async def on_input_submitted(self, event: Input.Submitted) -> None:
         if event.input.id == "message_input":
-            self.send_message()
+            await self.send_message()
     
-    def on_list_view_selected(self, event: ListView.Selected) -> None:
+    async def on_list_view_selected(self, event: ListView.Selected) -> None:
         if event.list_view.id == "rooms_list":
             room_data = event.item.room_data
-            self.join_room(room_data)
+            await self.join_room(room_data)
     
     async def join_room(self, room_data):
         """Join a chat room"""
@@ -195,7 +268,18 @@ class MainChatScreen(Screen):
         chat_title = self.query_one("#chat_title", Static)
         chat_title.update(f"💬 #{room_name}")
         
+        # Acks belong to the socket of the room being left
+        await self.send_read_ack()
+        
+        # The old room's socket and listener go before the new ones start
+        if self.listen_task:
+            self.listen_task.cancel()
+            self.listen_task = None
+        await self.app.client.disconnect()
+        self.current_room = None
+        
         # Load message history
+        self.app.client.mark_room_used(room_id)
         self.load_messages(room_id)
         
         # Connect WebSocket
@@ -204,27 +288,61 @@ class MainChatScreen(Screen):
             self.current_room = room_id
             
             # Start listening for messages
-            asyncio.create_task(self.listen_for_messages())
-            
+            self.listen_task = asyncio.create_task(self.listen_for_messages(room_id))
+        
         except Exception as e:
             self.notify(f"Failed to connect to room: {e}", severity="error")
     
     def load_messages(self, room_id):
-        """Load chat history"""
+        """Load chat history, showing prefetched messages immediately"""
+        cached = self.app.client.get_cached_messages(room_id)
+        if cached is not None:
+            self.show_messages(cached)
+            asyncio.create_task(self.revalidate_messages(room_id))
+            return
+        
         result = self.app.client.get_messages(room_id)
         if result["success"]:
-            messages_container = self.query_one("#messages_container", Container)
-            messages_container.remove_children()
+            self.show_messages(result["data"])
+    
+    async def revalidate_messages(self, room_id):
+        """Refresh a prefetched history page in the background"""
+        result = await asyncio.to_thread(self.app.client.get_messages, room_id)
+        if result["success"] and not result.get("not_modified") and self.current_room == room_id:
+            self.show_messages(result["data"])
+    
+    def show_messages(self, messages):
+        """Render a page of chat history"""
+        messages_container = self.query_one("#messages_container", Container)
+        messages_container.remove_children()
+        
+        for msg in messages:
+            timestamp = datetime.fromisoformat(msg["timestamp"].replace("Z", "+00:00"))
+            time_str = timestamp.strftime("%H:%M")
             
-            for msg in result["data"]:
-                timestamp = datetime.fromisoformat(msg["timestamp"].replace("Z", "+00:00"))
-                time_str = timestamp.strftime("%H:%M")
-                
-                message_widget = Static(
-                    f"[dim]{time_str}[/] [bold cyan]{msg['username']}[/]: {msg['content']}",
-                    classes="message"
-                )
-                messages_container.mount(message_widget)
+            message_widget = Static(
+                f"[dim]{time_str}[/] [bold cyan]{msg['username']}[/]: {format_content(msg)}",
+                classes="message"
+            )
+            messages_container.mount(message_widget)
+        
+        if messages and messages[-1].get("id"):
+            self.mark_read(messages[-1]["id"])
+    
+    def mark_read(self, message_id: int):
+        """Acknowledge displayed messages, batching acks into one send per delay"""
+        if self.read_ack_pending is None:
+            self.set_timer(self.app.client.config.read_ack_delay, self.send_read_ack)
+        self.read_ack_pending = max(message_id, self.read_ack_pending or 0)
+    
+    async def send_read_ack(self):
+        """Send the pending ack on the current room's socket"""
+        message_id, self.read_ack_pending = self.read_ack_pending, None
+        if message_id is not None:
+            try:
+                await self.app.client.send_read_ack(message_id)
+            except Exception:
+                pass
     
     async def send_message(self):
         """Send a message"""
@@ -239,33 +357,119 @@ class MainChatScreen(Screen):
             return
         
         try:
-            await self.app.client.send_message(content)
+            if content.startswith("/msg "):
+                # /msg <username> <text> sends a direct message
+                _, username, text = (content.split(" ", 2) + ["", ""])[:3]
+                if not username or not text:
+                    self.notify("Usage: /msg <username> <message>", severity="warning")
+                    return
+                await self.app.client.send_direct_message(username, text)
+            elif content.startswith("/upload "):
+                # /upload <path> shares a file; only its hash goes through the room
+                path = content[len("/upload "):].strip()
+                self.notify(f"Uploading {path}...")
+                result = await asyncio.to_thread(self.app.client.upload_file, path)
+                if not result["success"]:
+                    self.notify(f"Upload failed: {result.get('error')}", severity="error")
+                    return
+                await self.app.client.send_file_message(result["data"]["sha256"], result["data"]["filename"])
+            else:
+                await self.app.client.send_message(content)
             message_input.value = ""
         except Exception as e:
             self.notify(f"Failed to send message: {e}", severity="error")
     
-    async def listen_for_messages(self):
-        """Listen for incoming messages"""
-        try:
-            await self.app.client.listen_messages(self.handle_incoming_message)
-        except Exception as e:
-            self.notify(f"Connection lost: {e}", severity="error")
-    
-    def handle_incoming_message(self, data):
-        """Handle incoming WebSocket message"""
+    async def listen_for_messages(self, room_id):
+        """Listen for room_id's messages, reconnecting when the server restarts"""
+        client = self.app.client
+        while True:
+            websocket = client.websocket
+            try:
+                code = await client.listen_messages(lambda data: self.handle_incoming_message(data, room_id))
+            except Exception as e:
+                self.notify(f"Connection lost: {e}", severity="error")
+                return
+            # 1012 is a worker draining, 1001 the server going away
+            if code not in RECONNECT_CLOSE_CODES or client.websocket is not websocket:
+                return
+            if not await self.reconnect(room_id):
+                self.notify("Connection lost", severity="error")
+                return
+            # Catch up on whatever was sent while disconnected
+            await self.revalidate_messages(room_id)
+    
+    async def reconnect(self, room_id) -> bool:
+        """Reconnect to room_id after a jittered delay, retrying with backoff"""
+        client = self.app.client
+        websocket = client.websocket
+        delay = client.config.reconnect_max_delay
+        for _ in range(RECONNECT_ATTEMPTS):
+            # Spread the drained clients out instead of all reconnecting at once
+            await asyncio.sleep(random.uniform(0, delay))
+            if client.websocket is not websocket or self.current_room != room_id:
+                return False
+            try:
+                await client.connect_websocket(room_id)
+                return True
+            except Exception:
+                delay *= 2
+        return False
+    
+    def handle_incoming_message(self, data, room_id):
+        """Handle a frame from room_id's socket"""
         if data["type"] == "chat_message":
+            self.app.client.cache_message(room_id, data)
+            if room_id != self.current_room:
+                # A frame still in flight from a room that was just left
+                return
             timestamp = datetime.fromisoformat(data["timestamp"].replace("Z", "+00:00"))
             time_str = timestamp.strftime("%H:%M")
             
             messages_container = self.query_one("#messages_container", Container)
             message_widget = Static(
-                f"[dim]{time_str}[/] [bold cyan]{data['username']}[/]: {data['content']}",
+                f"[dim]{time_str}[/] [bold cyan]{data['username']}[/]: {format_content(data)}",
                 classes="message"
             )
             messages_container.mount(message_widget)
             
             # Auto-scroll to bottom
             messages_container.scroll_end()
+            if data.get("id"):
+                self.mark_read(data["id"])
+        
+        elif data["type"] == "direct_message":
+            timestamp = datetime.fromisoformat(data["timestamp"].replace("Z", "+00:00"))
+            time_str = timestamp.strftime("%H:%M")
+            
+            messages_container = self.query_one("#messages_container", Container)
+            message_widget = Static(
+                f"[dim]{time_str}[/] [bold magenta]{data['from']} → {data['to']}[/]: {data['content']}",
+                classes="message"
+            )
+            messages_container.mount(message_widget)
+            messages_container.scroll_end()
+        
+        elif data["type"] == "mention":
+            self.notify(f"{data['from']} mentioned you: {data['preview']}", timeout=10)
+            asyncio.create_task(asyncio.to_thread(self.app.client.mark_mentions_read, data["id"]))
+        
+        elif data["type"] == "error":
+            self.notify(data.get("message", "Server error"), severity="error")
+        
+        elif data["type"] == "voice_activity":
+            if self.app._voice:
+                self.app._voice.handle_voice_activity(data)
+        
+        elif data["type"] in ["voice_answer", "sfu_answer"]:
+            if self.app._voice:
+                asyncio.create_task(self.app._voice.handle_voice_answer(data))
+        
+        elif data["type"] == "voice_offer":
+            asyncio.create_task(self.app.voice.handle_voice_offer(data))
+        
+        elif data["type"] == "ice_candidate":
+            if self.app._voice:
+                asyncio.create_task(self.app._voice.handle_ice_candidate(data))
         
         elif data["type"] in ["user_joined", "user_left"]:
             messages_container = self.query_one("#messages_container", Container)
@@ -398,6 +602,16 @@ class TerminalChatApp(App):
     def __init__(self):
         super().__init__()
         self.client = ChatClient(Config())
+        self._voice = None
+    
+    @property
+    def voice(self):
+        """Voice chat manager; audio and WebRTC stacks load on first access"""
+        if self._voice is None:
+            from voice_chat import VoiceChatManager
+            self._voice = VoiceChatManager(self.client.websocket)
+        self._voice.websocket = self.client.websocket
+        return self._voice
     
     def on_mount(self) -> None:
         self.push_screen("login")
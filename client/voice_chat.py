@@ -1,33 +1,76 @@
 import asyncio
+import fractions
 import json
-import pyaudio
 import threading
+import time
+import numpy as np
 from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
-from aiortc.contrib.media import MediaRecorder, MediaPlayer
+from aiortc.mediastreams import MediaStreamError
+from aiortc.sdp import SessionDescription, candidate_from_sdp, candidate_to_sdp
+from av import AudioFrame, AudioResampler
 import logging
 
+from audio_processing import FRAME_SAMPLES, SAMPLE_RATE, JitterBuffer, Mixer, RingBuffer, Resampler, VoiceActivityDetector
+
 # Configure logging for aiortc
 logging.basicConfig(level=logging.INFO)
 
+_pyaudio = None
+
+def load_pyaudio():
+    """Import PyAudio on first use; it loads the native PortAudio library"""
+    global _pyaudio
+    if _pyaudio is None:
+        import pyaudio
+        _pyaudio = pyaudio
+    return _pyaudio
+
 class AudioTrack(MediaStreamTrack):
-    """Custom audio track for capturing microphone input"""
+    """Custom audio track for capturing microphone input
+    
+    A capture thread performs the blocking device reads, resamples to
+    48 kHz and writes into a lock-free ring buffer; ``recv`` awaits that
+    buffer and returns timestamped 20 ms frames for aiortc.
+    """
     
     kind = "audio"
     
-    def __init__(self):
+    # Latency bound: older samples are skipped beyond this many frames
+    MAX_BUFFERED_FRAMES = 5
+    
+    def __init__(self, rate: int = 44100, chunk: int = 1024, buffer_ms: int = 500, vad: bool = True):
         super().__init__()
         
+        pyaudio = load_pyaudio()
+        
         # Audio configuration
         self.format = pyaudio.paInt16
         self.channels = 1
-        self.rate = 44100
-        self.chunk = 1024
+        self.rate = rate
+        self.chunk = chunk
         
         # Initialize PyAudio
         self.audio = pyaudio.PyAudio()
         self.stream = None
         self.running = False
         
+        # Capture pipeline
+        self.buffer = RingBuffer(SAMPLE_RATE * buffer_ms // 1000)
+        self.resampler = Resampler(self.rate, SAMPLE_RATE)
+        self.capture_thread = None
+        self.underruns = 0
+        self.dropped_frames = 0
+        self._timestamp = 0
+        self._loop = None
+        self._data_ready = asyncio.Event()
+        self._waiting = False
+        
+        # Voice activity gating; on_activity(speaking) fires on transitions
+        self.vad = VoiceActivityDetector() if vad else None
+        self.speaking = False
+        self.gated_frames = 0
+        self.on_activity = None
+    
     def start_recording(self):
         """Start recording audio from microphone"""
         try:
@@ -39,31 +82,96 @@ class AudioTrack(MediaStreamTrack):
                 frames_per_buffer=self.chunk
             )
             self.running = True
+            self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+            self.capture_thread.start()
         except Exception as e:
             print(f"Failed to start audio recording: {e}")
     
     def stop_recording(self):
         """Stop recording audio"""
         self.running = False
+        if self.capture_thread:
+            self.capture_thread.join(timeout=1)
+            self.capture_thread = None
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
+            self.stream = None
         self.audio.terminate()
+        self.stop()
+    
+    def _capture_loop(self):
+        """Blocking device reads, kept off the event loop"""
+        while self.running:
+            try:
+                data = self.stream.read(self.chunk, exception_on_overflow=False)
+            except Exception as e:
+                print(f"Error reading audio: {e}")
+                break
+            samples = self.resampler.process(np.frombuffer(data, dtype=np.int16))
+            self.buffer.write(samples)
+            if self._waiting and self._loop:
+                self._loop.call_soon_threadsafe(self._data_ready.set)
     
     async def recv(self):
-        """Receive audio frame"""
+        """Receive the next 20 ms audio frame containing speech"""
+        while True:
+            samples = await self._next_samples()
+            speaking = self.vad.process(samples) if self.vad else True
+            if speaking != self.speaking:
+                self.speaking = speaking
+                if self.on_activity:
+                    self.on_activity(speaking)
+            if speaking:
+                return self._make_frame(samples)
+            # Silent: skip encoding and sending, but keep the timeline moving
+            self.gated_frames += 1
+            self._timestamp += FRAME_SAMPLES
+    
+    async def _next_samples(self):
         if not self.running or not self.stream:
-            return None
+            raise MediaStreamError
         
-        try:
-            # Read audio data from microphone
-            data = self.stream.read(self.chunk, exception_on_overflow=False)
-            # Convert to appropriate format for WebRTC
-            # This is a simplified implementation
-            return data
-        except Exception as e:
-            print(f"Error reading audio: {e}")
-            return None
+        self._loop = asyncio.get_running_loop()
+        while self.buffer.available() < FRAME_SAMPLES:
+            self._data_ready.clear()
+            self._waiting = True
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), timeout=2 * FRAME_SAMPLES / SAMPLE_RATE)
+            except asyncio.TimeoutError:
+                # Device stalled: keep the stream timed with a silent frame
+                self.underruns += 1
+                return np.zeros(FRAME_SAMPLES, dtype=np.int16)
+            finally:
+                self._waiting = False
+            if not self.running:
+                raise MediaStreamError
+        
+        excess = self.buffer.available() - self.MAX_BUFFERED_FRAMES * FRAME_SAMPLES
+        if excess > 0:
+            frames = -(-excess // FRAME_SAMPLES)
+            self.buffer.skip(frames * FRAME_SAMPLES)
+            self.dropped_frames += frames
+        
+        return self.buffer.read(FRAME_SAMPLES)
+    
+    def _make_frame(self, samples):
+        frame = AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = SAMPLE_RATE
+        frame.pts = self._timestamp
+        frame.time_base = fractions.Fraction(1, SAMPLE_RATE)
+        self._timestamp += FRAME_SAMPLES
+        return frame
+    
+    def get_stats(self):
+        """Buffer counters for tuning capture latency"""
+        return {
+            "overruns": self.buffer.overruns,
+            "underruns": self.underruns,
+            "dropped_frames": self.dropped_frames,
+            "gated_frames": self.gated_frames,
+            "buffered_ms": self.buffer.available() * 1000 // SAMPLE_RATE,
+        }
 
 class VoiceChatManager:
     """Manages voice chat functionality using WebRTC"""
@@ -75,48 +183,78 @@ class VoiceChatManager:
         self.is_voice_active = False
         self.current_room_id = None
         
-        # Audio playback
-        self.audio = pyaudio.PyAudio()
+        # Audio playback, opened when the first remote track arrives
+        self.audio = None
         self.playback_stream = None
+        self.mixer = Mixer()
+        self.track_tasks = {}
+        self.active_speakers = set()
+        
+        # Trickle ICE: remote candidates wait here until the remote description is set
+        self.pending_candidates = []
+        self.remote_user = None
+        self.use_sfu = False
+        self.gathering = None
+        self.setup_marks = {}
+    
+    async def start_voice_chat(self, room_id: int, use_sfu: bool = True, slots: int = 3):
+        """Start voice chat in a room
         
-    async def start_voice_chat(self, room_id: int):
-        """Start voice chat in a room"""
+        With ``use_sfu`` the microphone is published once to the server's
+        selective forwarding unit, and ``slots`` audio sections receive the
+        speakers it forwards. Otherwise a peer-to-peer offer is sent.
+        """
         if self.is_voice_active:
             return {"success": False, "error": "Voice chat already active"}
         
         try:
+            self.mark_setup("start", reset=True)
+            
             # Create RTCPeerConnection
             self.pc = RTCPeerConnection()
+            self.pc.on("iceconnectionstatechange", self.on_ice_state_change)
             self.current_room_id = room_id
+            self.use_sfu = use_sfu
+            self.pending_candidates = []
             
             # Create audio track
             self.audio_track = AudioTrack()
+            self.audio_track.on_activity = self.on_local_activity
             self.audio_track.start_recording()
             
             # Add audio track to peer connection
             self.pc.addTrack(self.audio_track)
+            if use_sfu:
+                # Extra receive-only sections become SFU downlink slots
+                for _ in range(slots - 1):
+                    self.pc.addTransceiver("audio", direction="recvonly")
             
             # Set up event handlers
             self.pc.on("track", self.on_track)
             self.pc.on("icecandidate", self.on_ice_candidate)
             
-            # Create offer
+            # Send the offer before ICE gathering so the remote side can start
+            # its own gathering in parallel; candidates follow as ice_candidate
             offer = await self.pc.createOffer()
-            await self.pc.setLocalDescription(offer)
-            
-            # Send offer through WebSocket
+            # The remote side starts its own gathering while ours runs
+            self.gathering = asyncio.create_task(self.pc.setLocalDescription(offer))
             await self.websocket.send(json.dumps({
-                "type": "voice_offer",
+                "type": "sfu_offer" if use_sfu else "voice_offer",
                 "room_id": room_id,
                 "offer": {
                     "type": offer.type,
                     "sdp": offer.sdp
                 }
             }))
+            self.mark_setup("offer_sent")
+            
+            await self.gathering
+            self.mark_setup("gathering_complete")
+            await self.send_local_candidates()
             
             self.is_voice_active = True
             return {"success": True, "message": "Voice chat started"}
-            
+        
         except Exception as e:
             return {"success": False, "error": f"Failed to start voice chat: {e}"}
     
@@ -132,6 +270,8 @@ class VoiceChatManager:
                 self.audio_track = None
             
             # Stop audio playback
+            for task in list(self.track_tasks.values()):
+                task.cancel()
             if self.playback_stream:
                 self.playback_stream.stop_stream()
                 self.playback_stream.close()
@@ -151,7 +291,7 @@ class VoiceChatManager:
             
             self.is_voice_active = False
             self.current_room_id = None
-            
+        
         except Exception as e:
             print(f"Error stopping voice chat: {e}")
     
@@ -159,8 +299,12 @@ class VoiceChatManager:
         """Handle incoming voice offer"""
         try:
             if not self.pc:
+                self.mark_setup("start", reset=True)
                 self.pc = RTCPeerConnection()
                 self.pc.on("track", self.on_track)
+                self.pc.on("iceconnectionstatechange", self.on_ice_state_change)
+            self.remote_user = offer_data.get("from_user")
+            self.current_room_id = offer_data["room_id"]
             
             # Set remote description
             offer = RTCSessionDescription(
@@ -168,20 +312,24 @@ class VoiceChatManager:
                 type=offer_data["offer"]["type"]
             )
             await self.pc.setRemoteDescription(offer)
+            await self.flush_pending_candidates()
             
-            # Create and send answer
+            # Create and send answer, then trickle candidates once gathered
             answer = await self.pc.createAnswer()
-            await self.pc.setLocalDescription(answer)
-            
             await self.websocket.send(json.dumps({
                 "type": "voice_answer",
                 "room_id": offer_data["room_id"],
+                "target_user": self.remote_user,
                 "answer": {
                     "type": answer.type,
                     "sdp": answer.sdp
                 }
             }))
             
+            await self.pc.setLocalDescription(answer)
+            self.mark_setup("gathering_complete")
+            await self.send_local_candidates()
+        
         except Exception as e:
             print(f"Error handling voice offer: {e}")
     
@@ -189,45 +337,170 @@ class VoiceChatManager:
         """Handle incoming voice answer"""
         try:
             if self.pc:
+                self.mark_setup("answer_received")
+                if answer_data.get("from_user") is not None:
+                    self.remote_user = answer_data["from_user"]
+                if self.gathering:
+                    # aiortc applies an answer only after the local offer is gathered
+                    await self.gathering
                 answer = RTCSessionDescription(
                     sdp=answer_data["answer"]["sdp"],
                     type=answer_data["answer"]["type"]
                 )
                 await self.pc.setRemoteDescription(answer)
+                await self.flush_pending_candidates()
         except Exception as e:
             print(f"Error handling voice answer: {e}")
     
+    async def handle_ice_candidate(self, data):
+        """Add a trickled remote candidate, queueing it until the remote description is set"""
+        if not self.pc:
+            return
+        if self.pc.remoteDescription is None:
+            self.pending_candidates.append(data.get("candidate"))
+            return
+        await self.add_remote_candidate(data.get("candidate"))
+    
+    async def flush_pending_candidates(self):
+        pending, self.pending_candidates = self.pending_candidates, []
+        for candidate in pending:
+            await self.add_remote_candidate(candidate)
+    
+    async def add_remote_candidate(self, candidate_data):
+        try:
+            if candidate_data is None:
+                # End of candidates
+                await self.pc.addIceCandidate(None)
+                return
+            candidate = candidate_from_sdp(candidate_data["candidate"].split(":", 1)[1])
+            candidate.sdpMid = candidate_data.get("sdpMid")
+            candidate.sdpMLineIndex = candidate_data.get("sdpMLineIndex")
+            await self.pc.addIceCandidate(candidate)
+        except Exception as e:
+            print(f"Error adding ICE candidate: {e}")
+    
+    async def send_local_candidates(self):
+        """Trickle gathered local candidates, then signal end-of-candidates"""
+        description = SessionDescription.parse(self.pc.localDescription.sdp)
+        for index, media in enumerate(description.media):
+            for candidate in media.ice_candidates:
+                candidate.sdpMid = media.rtp.muxId
+                candidate.sdpMLineIndex = index
+                self.on_ice_candidate(candidate)
+        self.on_ice_candidate(None)
+    
     def on_track(self, track):
         """Handle incoming audio track"""
         if track.kind == "audio":
-            # Set up audio playback
-            def play_audio():
-                try:
-                    self.playback_stream = self.audio.open(
-                        format=pyaudio.paInt16,
-                        channels=1,
-                        rate=44100,
-                        output=True,
-                        frames_per_buffer=1024
-                    )
-                    
-                    # This is a simplified audio playback loop
-                    # In a real implementation, you'd need proper audio format conversion
-                    while self.is_voice_active and self.playback_stream:
-                        # Receive audio data and play it
-                        # This would need proper implementation with aiortc
-                        pass
-                        
-                except Exception as e:
-                    print(f"Audio playback error: {e}")
-            
-            threading.Thread(target=play_audio, daemon=True).start()
+            jitter_buffer = JitterBuffer()
+            self.mixer.add(track.id, jitter_buffer)
+            self.track_tasks[track.id] = asyncio.create_task(self._receive_track(track, jitter_buffer))
+            self._ensure_playback()
+    
+    async def _receive_track(self, track, jitter_buffer):
+        """Feed decoded frames from a remote track into its jitter buffer"""
+        loop = asyncio.get_running_loop()
+        resampler = AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+        try:
+            while True:
+                frame = await track.recv()
+                self.mark_setup("first_audio")
+                arrival = loop.time()
+                for out in resampler.resample(frame):
+                    jitter_buffer.push(out.to_ndarray().reshape(-1), arrival)
+        except MediaStreamError:
+            pass
+        finally:
+            self.mixer.remove(track.id)
+            self.track_tasks.pop(track.id, None)
+    
+    def _ensure_playback(self):
+        """Open the output stream; PortAudio pulls mixed frames from its own thread"""
+        if self.playback_stream:
+            return
+        try:
+            pyaudio = load_pyaudio()
+            if self.audio is None:
+                self.audio = pyaudio.PyAudio()
+            self.playback_stream = self.audio.open(
+                format=pyaudio.paInt16,
+                channels=1,
+                rate=SAMPLE_RATE,
+                output=True,
+                frames_per_buffer=FRAME_SAMPLES,
+                stream_callback=self._playback_callback
+            )
+            self.playback_stream.start_stream()
+        except Exception as e:
+            print(f"Audio playback error: {e}")
+    
+    def _playback_callback(self, in_data, frame_count, time_info, status):
+        # frames_per_buffer is only a hint; some hosts ask for other sizes
+        return self.mixer.read(frame_count).tobytes(), load_pyaudio().paContinue
+    
+    def on_local_activity(self, speaking: bool):
+        """Tell the room when the local user starts or stops speaking"""
+        if not self.websocket or not self.current_room_id:
+            return
+        asyncio.create_task(self.websocket.send(json.dumps({
+            "type": "voice_activity",
+            "room_id": self.current_room_id,
+            "speaking": speaking
+        })))
+    
+    async def set_subscription(self, mode: str = "active_speakers", users=None):
+        """Choose which speakers the SFU forwards: active_speakers, all or users"""
+        if not self.websocket or not self.current_room_id:
+            return
+        await self.websocket.send(json.dumps({
+            "type": "sfu_subscribe",
+            "room_id": self.current_room_id,
+            "mode": mode,
+            "users": users or []
+        }))
+    
+    def handle_voice_activity(self, data):
+        """Track which remote users are currently speaking"""
+        if data.get("speaking"):
+            self.active_speakers.add(data["username"])
+        else:
+            self.active_speakers.discard(data["username"])
     
     def on_ice_candidate(self, candidate):
-        """Handle ICE candidates"""
-        # In a full implementation, you'd exchange ICE candidates
-        # through the signaling server (WebSocket)
-        pass
+        """Forward a local ICE candidate (None ends the list) through the signaling socket"""
+        if not self.websocket or not self.current_room_id:
+            return
+        message = {
+            "type": "ice_candidate",
+            "room_id": self.current_room_id,
+            "candidate": None
+        }
+        if not self.use_sfu:
+            message["target_user"] = self.remote_user
+        if candidate is not None:
+            message["candidate"] = {
+                "candidate": "candidate:" + candidate_to_sdp(candidate),
+                "sdpMid": candidate.sdpMid,
+                "sdpMLineIndex": candidate.sdpMLineIndex
+            }
+        asyncio.create_task(self.websocket.send(json.dumps(message)))
+    
+    def on_ice_state_change(self):
+        if self.pc and self.pc.iceConnectionState == "completed":
+            self.mark_setup("ice_connected")
+    
+    def mark_setup(self, stage: str, reset: bool = False):
+        """Record when a call setup stage is reached"""
+        if reset:
+            self.setup_marks = {}
+        self.setup_marks.setdefault(stage, time.monotonic())
+    
+    def get_setup_timings(self):
+        """Milliseconds from call start to each setup stage"""
+        start = self.setup_marks.get("start")
+        if start is None:
+            return {}
+        return {stage: round((mark - start) * 1000, 1) for stage, mark in self.setup_marks.items()}
     
     def toggle_mute(self):
         """Toggle microphone mute"""
@@ -240,5 +513,7 @@ class VoiceChatManager:
         return {
             "active": self.is_voice_active,
             "room_id": self.current_room_id,
-            "muted": False  # Would track mute state
+            "muted": False,  # Would track mute state
+            "active_speakers": sorted(self.active_speakers),
+            "setup_ms": self.get_setup_timings()
         }
\ No newline at end of file
@@ -0,0 +1,461 @@
+"""
+Cold storage for old messages
+Messages past the retention age move out of SQLite into immutable,
+compressed per-room segment files that are read back through mmap
+"""
+
+import asyncio
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, text
+
+from database import SessionLocal
+from sql_metrics import sql_metrics
+
+load_dotenv()
+
+# Configuration
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+# Compaction throttle so archiving never competes with live traffic
+ARCHIVE_ROWS_PER_SECOND = int(os.getenv("ARCHIVE_ROWS_PER_SECOND", "20000"))
+
+SEGMENT_MESSAGES = 50000
+BLOCK_MESSAGES = 256
+MAX_OPEN_SEGMENTS = 64
+DELETE_BATCH = 2000
+
+# Segment layout:
+#   header  magic, message count, first id, last id, block count
+#   blocks  zlib-compressed JSON arrays of [id, user_id, type, timestamp, content]
+#   index   one (first id, last id, offset, length) entry per block
+#   footer  index offset, magic
+MAGIC = b"TCSEG001"
+HEADER = struct.Struct("<8sIqqI")
+INDEX_ENTRY = struct.Struct("<qqQI")
+FOOTER = struct.Struct("<Q8s")
+
+def segment_name(first_id: int, last_id: int) -> str:
+    return f"{first_id:012d}-{last_id:012d}.seg"
+
+def write_segment(path: str, rows: List[list]):
+    """Write rows (ascending id) to an immutable segment file atomically"""
+    tmp_path = path + ".tmp"
+    index = []
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(rows), rows[0][0], rows[-1][0], 0))
+        for start in range(0, len(rows), BLOCK_MESSAGES):
+            block = rows[start:start + BLOCK_MESSAGES]
+            data = zlib.compress(json.dumps(block, separators=(",", ":")).encode("utf-8"), 6)
+            index.append((block[0][0], block[-1][0], f.tell(), len(data)))
+            f.write(data)
+        index_offset = f.tell()
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.write(FOOTER.pack(index_offset, MAGIC))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(rows), rows[0][0], rows[-1][0], len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class Segment:
+    """Read-only, memory-mapped view of one segment file"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.first_id, self.last_id, blocks = HEADER.unpack_from(self.map, 0)
+        index_offset, tail_magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC or tail_magic != MAGIC:
+            self.map.close()
+            raise ValueError(f"Not a message segment: {path}")
+        self.index = [
+            INDEX_ENTRY.unpack_from(self.map, index_offset + i * INDEX_ENTRY.size)
+            for i in range(blocks)
+        ]
+        self.block_first_ids = [entry[0] for entry in self.index]
+    
+    def block(self, number: int) -> List[list]:
+        _, _, offset, length = self.index[number]
+        return json.loads(zlib.decompress(self.map[offset:offset + length]))
+    
+    def read_before(self, before_id: int, limit: int) -> List[list]:
+        """Up to limit rows with id < before_id, newest first"""
+        rows: List[list] = []
+        number = bisect.bisect_left(self.block_first_ids, before_id) - 1
+        while number >= 0 and len(rows) < limit:
+            for row in reversed(self.block(number)):
+                if row[0] < before_id:
+                    rows.append(row)
+                    if len(rows) == limit:
+                        break
+            number -= 1
+        return rows
+    
+    def iter_after(self, after_id: int):
+        """Rows with id > after_id, oldest first, one block in memory at a time"""
+        number = max(0, bisect.bisect_right(self.block_first_ids, after_id) - 1)
+        for number in range(number, len(self.index)):
+            for row in self.block(number):
+                if row[0] > after_id:
+                    yield row
+    
+    def close(self):
+        self.map.close()
+
+class ColdStore:
+    """Per-room segment catalog with a bounded cache of open mappings"""
+    
+    def __init__(self, root: str = ARCHIVE_DIR):
+        self.root = root
+        # room_id -> sorted [(first_id, last_id, filename)]
+        self.catalog: Dict[int, List[Tuple[int, int, str]]] = {}
+        self._open: "OrderedDict[str, Segment]" = OrderedDict()
+        self.load()
+    
+    def room_dir(self, room_id: int) -> str:
+        return os.path.join(self.root, f"room_{room_id}")
+    
+    def load(self):
+        """Build the catalog from file names; segments carry their id range"""
+        self.catalog = {}
+        self._mtimes: Dict[int, float] = {}
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.listdir(self.root):
+            if entry.startswith("room_"):
+                self.scan(int(entry[len("room_"):]))
+    
+    def scan(self, room_id: int):
+        directory = self.room_dir(room_id)
+        try:
+            mtime = os.stat(directory).st_mtime
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        segments = []
+        for name in names:
+            if name.endswith(".seg"):
+                first_id, last_id = name[:-len(".seg")].split("-")
+                segments.append((int(first_id), int(last_id), name))
+        self.catalog[room_id] = sorted(segments)
+        self._mtimes[room_id] = mtime
+    
+    def segments(self, room_id: int) -> List[Tuple[int, int, str]]:
+        """A room's segments, rescanning if another process added one"""
+        try:
+            mtime = os.stat(self.room_dir(room_id)).st_mtime
+        except FileNotFoundError:
+            return []
+        if self._mtimes.get(room_id) != mtime:
+            self.scan(room_id)
+        return self.catalog.get(room_id, [])
+    
+    def last_archived_id(self, room_id: int) -> int:
+        segments = self.segments(room_id)
+        return segments[-1][1] if segments else 0
+    
+    def add(self, room_id: int, rows: List[list]):
+        """Persist rows as a new segment and publish it in the catalog"""
+        directory = self.room_dir(room_id)
+        os.makedirs(directory, exist_ok=True)
+        name = segment_name(rows[0][0], rows[-1][0])
+        write_segment(os.path.join(directory, name), rows)
+        # Rescan rather than append so the catalog and mtime stay in step;
+        # the list is replaced, never mutated, under concurrent readers
+        self.scan(room_id)
+    
+    def segment(self, room_id: int, name: str) -> Segment:
+        path = os.path.join(self.room_dir(room_id), name)
+        segment = self._open.get(path)
+        if segment is None:
+            segment = Segment(path)
+            self._open[path] = segment
+            if len(self._open) > MAX_OPEN_SEGMENTS:
+                self._open.popitem(last=False)[1].close()
+        else:
+            self._open.move_to_end(path)
+        return segment
+    
+    def get(self, room_id: int, message_id: int) -> Optional[list]:
+        """One archived row by id, or None"""
+        rows = self.read_before(room_id, message_id + 1, 1)
+        return rows[0] if rows and rows[0][0] == message_id else None
+    
+    def read_before(self, room_id: int, before_id: int, limit: int) -> List[list]:
+        """Up to limit archived rows of a room with id < before_id, newest first"""
+        rows: List[list] = []
+        for first_id, _, name in reversed(self.segments(room_id)):
+            if len(rows) >= limit:
+                break
+            if first_id >= before_id:
+                continue
+            rows.extend(self.segment(room_id, name).read_before(before_id, limit - len(rows)))
+        return rows
+    
+    def iter_after(self, room_id: int, after_id: int = 0):
+        """Every archived row of a room with id > after_id, oldest first"""
+        for _, last_id, name in self.segments(room_id):
+            if last_id > after_id:
+                # Not cached: a full scan would evict the segments live reads use
+                segment = Segment(os.path.join(self.room_dir(room_id), name))
+                try:
+                    yield from segment.iter_after(after_id)
+                finally:
+                    segment.close()
+    
+    def close(self):
+        for segment in self._open.values():
+            segment.close()
+        self._open.clear()
+
+def lookup_usernames(db, user_ids) -> Dict[int, str]:
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    return dict(db.execute(
+        text("SELECT id, username FROM users WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+        {"ids": user_ids}
+    ).all())
+
+def newest_message(db, store: ColdStore, room_id: int,
+                   before_id: Optional[int] = None) -> Optional[Tuple[int, str]]:
+    """(id, timestamp) of the newest message below before_id, from either tier"""
+    before_id = before_id or (1 << 62)
+    row = db.execute(text("""
+        SELECT id, timestamp FROM messages
+        WHERE room_id = :room_id AND id < :before_id
+        ORDER BY id DESC
+        LIMIT 1
+    """), {"room_id": room_id, "before_id": before_id}).first()
+    if row is not None:
+        return row.id, str(row.timestamp)
+    cold = store.read_before(room_id, before_id, 1)
+    return (cold[0][0], cold[0][3]) if cold else None
+
+def read_history(db, store: ColdStore, room_id: int, limit: int,
+                 before_id: Optional[int] = None) -> List[dict]:
+    """The newest limit messages of a room older than before_id, oldest first.
+    
+    Reads the hot table first and continues into cold segments when it runs
+    out, so callers never see where the tiers meet.
+    """
+    before_id = before_id or (1 << 62)
+    hot = db.execute(text("""
+        SELECT m.id, m.user_id, m.message_type, m.timestamp, m.content
+        FROM messages m
+        WHERE m.room_id = :room_id AND m.id < :before_id
+        ORDER BY m.id DESC
+        LIMIT :limit
+    """), {"room_id": room_id, "before_id": before_id, "limit": limit}).all()
+    rows = [[row.id, row.user_id, row.message_type, str(row.timestamp), row.content] for row in hot]
+    if len(rows) < limit:
+        # A crash between writing a segment and deleting its rows leaves the
+        # rows in both tiers; skip anything the hot table already returned
+        floor = rows[-1][0] if rows else before_id
+        rows.extend(store.read_before(room_id, floor, limit - len(rows)))
+    rows.reverse()
+    
+    usernames = lookup_usernames(db, {row[1] for row in rows})
+    return [
+        {
+            "id": message_id,
+            "content": content,
+            "username": usernames.get(user_id),
+            "timestamp": timestamp.replace(" ", "T"),
+            "message_type": message_type
+        }
+        for message_id, user_id, message_type, timestamp, content in rows
+    ]
+
+class Compactor:
+    """Background task that moves messages past the retention age into segments"""
+    
+    def __init__(self, store: ColdStore, after_days: float = ARCHIVE_AFTER_DAYS,
+                 interval: float = ARCHIVE_INTERVAL_SECONDS,
+                 rows_per_second: int = ARCHIVE_ROWS_PER_SECOND):
+        self.store = store
+        self.after_days = after_days
+        self.interval = interval
+        self.rows_per_second = rows_per_second
+        self.archived = 0
+        # Rooms whose segments are known to be in the search index
+        self.indexed = set()
+    
+    async def run(self):
+        while True:
+            try:
+                with sql_metrics.scope("archive compact"):
+                    await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Archive compaction failed: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def compact(self):
+        """Archive every room once; database work runs off the event loop"""
+        cutoff = (datetime.utcnow() - timedelta(days=self.after_days)).strftime("%Y-%m-%d %H:%M:%S")
+        for room_id in list(self.store.catalog):
+            if room_id not in self.indexed:
+                await asyncio.to_thread(self._index_segments, room_id)
+                self.indexed.add(room_id)
+        room_ids = await asyncio.to_thread(self._rooms_with_old_messages, cutoff)
+        for room_id in room_ids:
+            while True:
+                rows = await asyncio.to_thread(self._select_chunk, room_id, cutoff)
+                if not rows:
+                    break
+                await asyncio.to_thread(self.store.add, room_id, rows)
+                # Delete in small transactions so live writers are never
+                # locked out for long, pacing to the configured rate
+                for start in range(0, len(rows), DELETE_BATCH):
+                    batch = rows[start:start + DELETE_BATCH]
+                    started = time.monotonic()
+                    await asyncio.to_thread(self._delete_ids, room_id, [row[0] for row in batch])
+                    self.archived += len(batch)
+                    budget = len(batch) / self.rows_per_second
+                    await asyncio.sleep(max(0.0, budget - (time.monotonic() - started)))
+    
+    def _rooms_with_old_messages(self, cutoff: str) -> List[int]:
+        db = SessionLocal()
+        try:
+            return [row.room_id for row in db.execute(
+                text("SELECT DISTINCT room_id FROM messages WHERE timestamp < :cutoff"), {"cutoff": cutoff}
+            )]
+        finally:
+            db.close()
+    
+    def _select_chunk(self, room_id: int, cutoff: str) -> List[list]:
+        """Up to SEGMENT_MESSAGES old rows of a room that are not archived yet.
+        
+        Ids do not follow timestamps (imported history gets new, higher ids
+        with its old timestamps), so the chunk stops below the first row that
+        is still too recent: the hot tier keeps every id above the cold one.
+        The newest message of the whole table always stays, because SQLite
+        hands out max(id) + 1 and would otherwise reuse an archived id.
+        """
+        archived_up_to = self.store.last_archived_id(room_id)
+        self._delete_leftovers(room_id, archived_up_to)
+        db = SessionLocal()
+        try:
+            rows = db.execute(text("""
+                SELECT id, user_id, message_type, timestamp, content FROM messages
+                WHERE room_id = :room_id AND id > :archived AND timestamp < :cutoff
+                  AND id < COALESCE((
+                      SELECT MIN(id) FROM messages
+                      WHERE room_id = :room_id AND id > :archived AND timestamp >= :cutoff
+                  ), :no_bound)
+                  AND id < (SELECT MAX(id) FROM messages)
+                ORDER BY id
+                LIMIT :limit
+            """), {"room_id": room_id, "archived": archived_up_to, "cutoff": cutoff,
+                   "no_bound": 1 << 62, "limit": SEGMENT_MESSAGES}).all()
+            return [[row.id, row.user_id, row.message_type, str(row.timestamp), row.content] for row in rows]
+        finally:
+            db.close()
+    
+    def _delete_leftovers(self, room_id: int, archived_up_to: int):
+        """Delete rows a crash left behind after their segment was written.
+        
+        Only ids actually found in a segment go; nothing is assumed from the
+        id range alone.
+        """
+        db = SessionLocal()
+        try:
+            hot_ids = [row.id for row in db.execute(
+                text("SELECT id FROM messages WHERE room_id = :room_id AND id <= :archived ORDER BY id"),
+                {"room_id": room_id, "archived": archived_up_to}
+            )]
+        finally:
+            db.close()
+        if not hot_ids:
+            return
+        pending = set(hot_ids)
+        archived = [row[0] for row in self.store.iter_after(room_id, hot_ids[0] - 1) if row[0] in pending]
+        for start in range(0, len(archived), DELETE_BATCH):
+            self._delete_ids(room_id, archived[start:start + DELETE_BATCH])
+    
+    def _index_segments(self, room_id: int):
+        """Put segment rows archived before archived_messages existed back into search.
+        
+        Picks up after the newest row already recorded, so an interrupted run
+        resumes; rows still in the hot table are indexed there already.
+        """
+        db = SessionLocal()
+        try:
+            indexed_up_to = db.execute(
+                text("SELECT COALESCE(MAX(id), 0) FROM archived_messages WHERE room_id = :room_id"),
+                {"room_id": room_id}
+            ).scalar()
+        finally:
+            db.close()
+        if indexed_up_to >= self.store.last_archived_id(room_id):
+            return
+        batch = []
+        for row in self.store.iter_after(room_id, indexed_up_to):
+            batch.append(row)
+            if len(batch) == DELETE_BATCH:
+                self._index_rows(room_id, batch)
+                batch = []
+        if batch:
+            self._index_rows(room_id, batch)
+    
+    def _index_rows(self, room_id: int, rows: List[list]):
+        db = SessionLocal()
+        try:
+            hot = {row.id for row in db.execute(
+                text("SELECT id FROM messages WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                {"ids": [row[0] for row in rows]}
+            )}
+            rows = [row for row in rows if row[0] not in hot]
+            if rows:
+                db.execute(text("""
+                    INSERT OR IGNORE INTO archived_messages (id, room_id, user_id, message_type, timestamp)
+                    VALUES (:id, :room_id, :user_id, :message_type, :timestamp)
+                """), [{"id": row[0], "room_id": room_id, "user_id": row[1], "message_type": row[2],
+                        "timestamp": row[3]} for row in rows])
+                db.execute(text("INSERT INTO messages_fts (rowid, content, room_id) VALUES (:id, :content, :room_id)"),
+                           [{"id": row[0], "content": row[4], "room_id": room_id} for row in rows])
+            db.commit()
+        finally:
+            db.close()
+    
+    def _delete_ids(self, room_id: int, ids: List[int]):
+        """Delete exactly the given rows, the ones just written to a segment.
+        
+        Recording them in archived_messages first, in the same transaction,
+        keeps their search index entries (see FTS_DDL in database.py).
+        """
+        db = SessionLocal()
+        try:
+            db.execute(
+                text("""
+                    INSERT OR IGNORE INTO archived_messages (id, room_id, user_id, message_type, timestamp)
+                    SELECT id, room_id, user_id, message_type, timestamp FROM messages
+                    WHERE room_id = :room_id AND id IN :ids
+                """).bindparams(bindparam("ids", expanding=True)),
+                {"room_id": room_id, "ids": ids}
+            )
+            db.execute(
+                text("DELETE FROM messages WHERE room_id = :room_id AND id IN :ids").bindparams(
+                    bindparam("ids", expanding=True)
+                ),
+                {"room_id": room_id, "ids": ids}
+            )
+            db.commit()
+        finally:
+            db.close()
@@ -0,0 +1,313 @@
+"""
+Attachments
+Resumable chunked uploads streamed to disk, kept in a content-addressed
+store so a file shared any number of times is stored once
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from sqlalchemy import text
+
+from database import AttachmentUpload, SessionLocal
+
+load_dotenv()
+
+# Configuration
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "./attachments")
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(100 * 1024 * 1024)))
+# Unfinished uploads are removed after this many hours without a chunk
+UPLOAD_EXPIRE_HOURS = float(os.getenv("UPLOAD_EXPIRE_HOURS", "24"))
+# Served by nginx from this internal location instead of the worker, if set
+ATTACHMENT_ACCEL_REDIRECT = os.getenv("ATTACHMENT_ACCEL_REDIRECT", "")
+
+# Request body chunks are collected up to this size before each disk write
+WRITE_BUFFER = 1024 * 1024
+HASH_BLOCK = 1024 * 1024
+EXPIRE_INTERVAL_SECONDS = 3600
+MAX_FILENAME_LENGTH = 255
+
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+# One byte range; lists of ranges are answered with the whole file
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class UploadError(Exception):
+    """A chunk an upload cannot take; offset is where the client should resume"""
+    
+    def __init__(self, status: int, detail: str, offset: int):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.offset = offset
+
+def clean_filename(filename: str) -> str:
+    """Last path component, without control characters, bounded in length"""
+    name = os.path.basename(filename.replace("\\", "/"))
+    name = "".join(ch for ch in name if ch.isprintable() and ch not in "\"")
+    return name[:MAX_FILENAME_LENGTH] or "file"
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (first, last) byte of a Range header, or None to send everything.
+    
+    Raises ValueError for a range that starts past the end of the file.
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # "bytes=-n": the last n bytes
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - int(last)), size - 1
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise ValueError("Range starts past the end")
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+def iter_range(path: str, first: int, last: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining:
+            block = f.read(min(HASH_BLOCK, remaining))
+            if not block:
+                return
+            remaining -= len(block)
+            yield block
+
+def attachment_content(sha256: str, size: int, filename: str) -> str:
+    """Content of a "file" message: the reference, never the bytes"""
+    return json.dumps({"sha256": sha256, "size": size, "filename": filename}, separators=(",", ":"))
+
+def try_lock(f) -> bool:
+    """Take an exclusive lock on an open file without waiting; False if held.
+    
+    flock where available; on Windows msvcrt locks the first byte, which is
+    enough because every writer takes the same lock before writing.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+class AttachmentStore:
+    """Objects under objects/<2 hex>/<sha256>, partial uploads under uploads/.
+    
+    Both live on disk so every worker sees them; the upload rows only hold
+    who is uploading what. A part file's length is the resume offset.
+    """
+    
+    def __init__(self, directory: str = ATTACHMENT_DIR):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.uploads_dir = os.path.join(directory, "uploads")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+    
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+    
+    def part_path(self, upload_id: str) -> str:
+        return os.path.join(self.uploads_dir, upload_id)
+    
+    def object_size(self, sha256: str) -> Optional[int]:
+        """Size of a stored object, or None if the hash is not stored"""
+        if not SHA256_HEX.match(sha256):
+            return None
+        try:
+            return os.path.getsize(self.object_path(sha256))
+        except OSError:
+            return None
+    
+    def create_upload(self, user_id: int, filename: str, size: int) -> AttachmentUpload:
+        db = SessionLocal()
+        try:
+            upload = AttachmentUpload(id=uuid.uuid4().hex, user_id=user_id, filename=clean_filename(filename),
+                                      size=size, updated_at=datetime.utcnow())
+            db.add(upload)
+            db.commit()
+            db.refresh(upload)
+            db.expunge(upload)
+        finally:
+            db.close()
+        open(self.part_path(upload.id), "wb").close()
+        return upload
+    
+    def get_upload(self, upload_id: str, user_id: int) -> Optional[AttachmentUpload]:
+        """An unfinished upload of this user's"""
+        db = SessionLocal()
+        try:
+            upload = db.query(AttachmentUpload).filter(
+                AttachmentUpload.id == upload_id, AttachmentUpload.user_id == user_id
+            ).first()
+            if upload is not None:
+                db.expunge(upload)
+            return upload
+        finally:
+            db.close()
+    
+    def offset(self, upload_id: str) -> int:
+        try:
+            return os.path.getsize(self.part_path(upload_id))
+        except OSError:
+            return 0
+    
+    def open_part(self, upload: AttachmentUpload, offset: int):
+        """The part file, locked against other writers and positioned at offset"""
+        try:
+            f = open(self.part_path(upload.id), "r+b")
+        except FileNotFoundError:
+            raise UploadError(404, "Upload not found", 0)
+        # Another request, possibly in another worker, is writing this upload
+        if not try_lock(f):
+            f.close()
+            raise UploadError(409, "Upload is busy", self.offset(upload.id))
+        current = f.seek(0, os.SEEK_END)
+        if offset != current:
+            f.close()
+            raise UploadError(409, "Offset does not match the bytes received", current)
+        return f
+    
+    async def append(self, upload: AttachmentUpload, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """Stream a request body onto the upload from offset; returns the new length.
+        
+        Only WRITE_BUFFER bytes are held in memory at a time. Whatever arrived
+        before a dropped connection is kept, so the client resumes from there.
+        """
+        f = await asyncio.to_thread(self.open_part, upload, offset)
+        buffer = bytearray()
+        remaining = upload.size - offset
+        try:
+            async for chunk in chunks:
+                if len(chunk) > remaining:
+                    buffer += chunk[:remaining]
+                    remaining = 0
+                    raise UploadError(413, "Body goes past the declared size", upload.size)
+                buffer += chunk
+                remaining -= len(chunk)
+                if len(buffer) >= WRITE_BUFFER:
+                    data, buffer = bytes(buffer), bytearray()
+                    await asyncio.to_thread(f.write, data)
+        finally:
+            await asyncio.to_thread(self.close_part, f, bytes(buffer))
+        return upload.size - remaining
+    
+    @staticmethod
+    def close_part(f, data: bytes):
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    
+    def finish(self, upload: AttachmentUpload) -> str:
+        """Hash a complete upload and move it into the store; returns the sha256"""
+        path = self.part_path(upload.id)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+        target = self.object_path(sha256)
+        if os.path.exists(target):
+            # Already stored: the new copy is dropped
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        db = SessionLocal()
+        try:
+            db.query(AttachmentUpload).filter(AttachmentUpload.id == upload.id).delete()
+            # Sending every byte proves the uploader has the file, stored or not
+            db.execute(text("INSERT OR IGNORE INTO attachment_owners (sha256, user_id) VALUES (:sha256, :user_id)"),
+                       {"sha256": sha256, "user_id": upload.user_id})
+            db.commit()
+        finally:
+            db.close()
+        return sha256
+    
+    def can_read(self, sha256: str, user_id: int) -> bool:
+        """Whether the user uploaded the object or is in a room it was posted in"""
+        db = SessionLocal()
+        try:
+            return db.execute(text("""
+                SELECT 1 FROM attachment_owners WHERE sha256 = :sha256 AND user_id = :user_id
+                UNION ALL
+                SELECT 1 FROM attachment_rooms r
+                JOIN room_memberships m ON m.room_id = r.room_id AND m.user_id = :user_id
+                WHERE r.sha256 = :sha256
+                LIMIT 1
+            """), {"sha256": sha256, "user_id": user_id}).first() is not None
+        finally:
+            db.close()
+    
+    def share(self, sha256: str, user_id: int, room_id: int) -> bool:
+        """Record the object as posted in room_id, if the user may read it"""
+        if not self.can_read(sha256, user_id):
+            return False
+        db = SessionLocal()
+        try:
+            db.execute(text("INSERT OR IGNORE INTO attachment_rooms (sha256, room_id) VALUES (:sha256, :room_id)"),
+                       {"sha256": sha256, "room_id": room_id})
+            db.commit()
+        finally:
+            db.close()
+        return True
+    
+    def touch(self, upload: AttachmentUpload):
+        db = SessionLocal()
+        try:
+            db.query(AttachmentUpload).filter(AttachmentUpload.id == upload.id).update(
+                {AttachmentUpload.updated_at: datetime.utcnow()}
+            )
+            db.commit()
+        finally:
+            db.close()
+    
+    def expire_uploads(self, max_age_hours: float = UPLOAD_EXPIRE_HOURS) -> int:
+        """Remove uploads that have not received a chunk in max_age_hours"""
+        cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+        db = SessionLocal()
+        try:
+            stale = [row.id for row in db.query(AttachmentUpload.id).filter(AttachmentUpload.updated_at < cutoff)]
+            for upload_id in stale:
+                try:
+                    os.remove(self.part_path(upload_id))
+                except FileNotFoundError:
+                    pass
+            if stale:
+                db.query(AttachmentUpload).filter(AttachmentUpload.id.in_(stale)).delete(synchronize_session=False)
+                db.commit()
+            return len(stale)
+        finally:
+            db.close()
+    
+    async def run(self, interval: float = EXPIRE_INTERVAL_SECONDS):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.expire_uploads)
+                if removed:
+                    print(f"Removed {removed} abandoned uploads")
+            except Exception as e:
+                print(f"Upload expiry failed: {e}")
+            await asyncio.sleep(interval)
@@ -8,6 +8,7 @@ from typing import Optional
 from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 from database import User, get_db
+from tracing import tracer
 import os
 from dotenv import load_dotenv
 
@@ -32,12 +33,14 @@ class AuthService:
     @staticmethod
     def hash_password(password: str) -> str:
         """Hash a password using bcrypt"""
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        with tracer.span("bcrypt hash", "auth"):
+            return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
     
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str) -> bool:
         """Verify a password against its hash"""
-        return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+        with tracer.span("bcrypt verify", "auth"):
+            return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
     
     @staticmethod
     def generate_verification_token() -> str:
@@ -60,7 +63,8 @@ class AuthService:
     def verify_token(token: str) -> Optional[dict]:
         """Verify and decode a JWT token"""
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            with tracer.span("jwt decode", "auth"):
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             return payload
         except JWTError:
             return None
@@ -91,12 +95,13 @@ class AuthService:
             
             msg.attach(MIMEText(body, 'plain'))
             
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            server.starttls()
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-            text = msg.as_string()
-            server.sendmail(FROM_EMAIL, email, text)
-            server.quit()
+            with tracer.span("smtp send", "auth"):
+                server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+                server.starttls()
+                server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+                text = msg.as_string()
+                server.sendmail(FROM_EMAIL, email, text)
+                server.quit()
             
             return True
         except Exception as e:
@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, String, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.sql import Delete, Insert, TextClause, Update
 from sqlalchemy.sql import func
 from datetime import datetime
+import os
+from sql_metrics import sql_metrics
+from tracing import tracer
 
 Base = declarative_base()
 
@@ -18,6 +23,8 @@ class User(Base):
     verification_token = Column(String(100), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     last_seen = Column(DateTime(timezone=True), server_default=func.now())
+    # Mentions up to this id have been seen
+    mention_read_id = Column(Integer, nullable=False, default=0, server_default="0")
     
     # Relationships
     messages = relationship("Message", back_populates="user")
@@ -44,33 +51,280 @@ class Message(Base):
     content = Column(Text, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"))
     room_id = Column(Integer, ForeignKey("chat_rooms.id"))
-    message_type = Column(String(20), default="text")  # text, voice, system
+    message_type = Column(String(20), default="text")  # text, file, voice, system
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Id the sending client chose, so a resent message is stored only once
+    client_msg_id = Column(String(64), nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="messages")
     room = relationship("ChatRoom", back_populates="messages")
+    
+    # History pages walk one room by id; a client id is unique per sender and room
+    __table_args__ = (
+        Index("ix_messages_room_id_id", "room_id", "id"),
+        Index("ux_messages_user_id_room_id_client_msg_id", "user_id", "room_id", "client_msg_id", unique=True),
+    )
+
+class ArchivedMessage(Base):
+    __tablename__ = "archived_messages"
+    
+    # A message moved to a cold segment (see archive.py); its content stays in
+    # the segment and its words stay in messages_fts, so search still finds it
+    id = Column(Integer, primary_key=True)
+    room_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+    message_type = Column(String(20), nullable=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
 
 class RoomMembership(Base):
     __tablename__ = "room_memberships"
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     room_id = Column(Integer, ForeignKey("chat_rooms.id"))
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
     is_admin = Column(Boolean, default=False)
+    # Read marker and running unread count, maintained by read_markers.py
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default="0")
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
     
     # Relationships
     user = relationship("User", back_populates="room_memberships")
     room = relationship("ChatRoom", back_populates="memberships")
 
+class DirectMessage(Base):
+    __tablename__ = "direct_messages"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # A conversation is read as two keyset scans, one per direction
+    __table_args__ = (Index("ix_direct_messages_pair_id", "sender_id", "recipient_id", "id"),)
+
+class Mention(Base):
+    __tablename__ = "mentions"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), nullable=False)
+    message_id = Column(Integer, nullable=False)
+    sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # Enough to show the notification after the message has been archived
+    preview = Column(String(200), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    
+    # A user's inbox is read newest first by id
+    __table_args__ = (Index("ix_mentions_user_id_id", "user_id", "id"),)
+
+class AttachmentUpload(Base):
+    __tablename__ = "attachment_uploads"
+    
+    # The bytes received so far are on disk; see attachments.py
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    filename = Column(String(255), nullable=False)
+    size = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+# Who may read an attachment: whoever uploaded its bytes, and members of any
+# room it was posted in (see attachments.py)
+class AttachmentOwner(Base):
+    __tablename__ = "attachment_owners"
+    
+    sha256 = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+
+class AttachmentRoom(Base):
+    __tablename__ = "attachment_rooms"
+    
+    sha256 = Column(String(64), primary_key=True)
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), primary_key=True)
+
 # Database setup
 DATABASE_URL = "sqlite:///./chat.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Read-only connections per process; reads never wait on the writer in WAL mode
+READER_POOL_SIZE = int(os.getenv("DB_READER_POOL_SIZE", "8"))
+READER_POOL_OVERFLOW = int(os.getenv("DB_READER_POOL_OVERFLOW", "16"))
+# Seconds to wait for the single writer connection before giving up; a
+# stalled write then fails that request instead of queueing every other one
+WRITER_POOL_TIMEOUT = float(os.getenv("DB_WRITER_POOL_TIMEOUT", "5"))
+
+# Applied to every connection. NORMAL is durable across application crashes
+# in WAL mode; only an OS crash or power loss can lose the last commits
+SQLITE_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -64000,      # 64 MB of page cache per connection
+    "mmap_size": 268435456,    # Map the first 256 MB instead of copying pages
+    "temp_store": "MEMORY",
+}
+
+def set_pragmas(dbapi_connection, pragmas: dict):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+# All writes go through this single connection, so they are serialized within
+# the process instead of racing for SQLite's write lock
+engine = create_engine(
+    DATABASE_URL, connect_args={"check_same_thread": False}, pool_size=1, max_overflow=0,
+    pool_timeout=WRITER_POOL_TIMEOUT
+)
+reader_engine = create_engine(
+    DATABASE_URL, connect_args={"check_same_thread": False},
+    pool_size=READER_POOL_SIZE, max_overflow=READER_POOL_OVERFLOW
+)
+
+@event.listens_for(engine, "connect")
+def on_writer_connect(dbapi_connection, connection_record):
+    # WAL is persistent in the file; readers then see the last commit
+    # without blocking the writer or being blocked by it
+    set_pragmas(dbapi_connection, {**SQLITE_PRAGMAS, "journal_mode": "WAL"})
+
+@event.listens_for(reader_engine, "connect")
+def on_reader_connect(dbapi_connection, connection_record):
+    set_pragmas(dbapi_connection, {**SQLITE_PRAGMAS, "query_only": "ON"})
+
+# Statement timing, per-request counts and the slow-query log
+sql_metrics.instrument(engine)
+sql_metrics.instrument(reader_engine)
+tracer.instrument(engine)
+tracer.instrument(reader_engine)
+
+def is_write(clause) -> bool:
+    if isinstance(clause, (Insert, Update, Delete)):
+        return True
+    if isinstance(clause, TextClause):
+        # Raw SQL is a read only if it is a plain query
+        return clause.text.lstrip().split(None, 1)[0].upper() not in ("SELECT", "WITH")
+    return False
+
+class RoutingSession(Session):
+    """Sends flushes and DML to the writer and everything else to a reader.
+    
+    Once a transaction has written, its reads stay on the writer so they
+    see their own uncommitted changes.
+    """
+    
+    writing = False
+    
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.writing or self._flushing or is_write(clause):
+            self.writing = True
+            return engine
+        return reader_engine
+    
+    def commit(self):
+        super().commit()
+        self.writing = False
+    
+    def rollback(self):
+        super().rollback()
+        self.writing = False
+    
+    def close(self):
+        super().close()
+        self.writing = False
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False)
+
+# Full-text index over messages, maintained incrementally by triggers; room_id
+# is indexed alongside content so searches can be narrowed to rooms inside FTS5.
+# Rows the compactor archives keep their index entries: it records them in
+# archived_messages in the same transaction that deletes them
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, room_id, content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END""",
+    # Replaced on every start so databases made before archiving get the WHEN
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+    WHEN NOT EXISTS (SELECT 1 FROM archived_messages WHERE id = old.id) BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, room_id) VALUES ('delete', old.id, old.content, old.room_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, room_id ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, room_id) VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END""",
+]
+
+def create_search_index():
+    """Create the FTS5 index and its triggers, backfilling existing messages once"""
+    existed = inspect(engine).has_table("messages_fts")
+    with engine.begin() as conn:
+        for statement in FTS_DDL:
+            conn.execute(text(statement))
+        if not existed:
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+# Columns added after the first release: (table, column, DDL type)
+ADDED_COLUMNS = [
+    ("room_memberships", "last_read_message_id", "INTEGER NOT NULL DEFAULT 0"),
+    ("room_memberships", "unread_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("messages", "client_msg_id", "VARCHAR(64)"),
+    ("users", "mention_read_id", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# Indexes replaced by later versions
+DROPPED_INDEXES = ["ux_messages_user_id_client_msg_id"]
+
+def add_missing_columns():
+    """Bring databases created by older versions up to the current schema"""
+    with engine.begin() as conn:
+        # Inspect through the same connection; the writer pool holds only one
+        inspector = inspect(conn)
+        for table, column, ddl in ADDED_COLUMNS:
+            if column not in {c["name"] for c in inspector.get_columns(table)}:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def backfill_attachment_references():
+    """Grant access to attachments posted before references were recorded"""
+    with engine.begin() as conn:
+        for table, column in (("attachment_rooms", "room_id"), ("attachment_owners", "user_id")):
+            conn.execute(text(f"""
+                INSERT OR IGNORE INTO {table} (sha256, {column})
+                SELECT json_extract(content, '$.sha256'), {column} FROM messages
+                WHERE message_type = 'file' AND json_valid(content)
+                  AND json_extract(content, '$.sha256') IS NOT NULL
+            """))
 
 def create_tables():
+    new_attachment_references = not inspect(engine).has_table("attachment_rooms")
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    if new_attachment_references:
+        backfill_attachment_references()
+    with engine.begin() as conn:
+        for index in DROPPED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    # create_all skips indexes on tables that already exist
+    for table in (Message.__table__, RoomMembership.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    create_search_index()
+
+def init_database():
+    """Schema plus the default room; safe to run from several processes"""
+    create_tables()
+    db = SessionLocal()
+    try:
+        if not db.query(ChatRoom.id).filter(ChatRoom.name == "general").first():
+            db.add(ChatRoom(name="general", description="General chat room for everyone", is_private=False))
+            db.commit()
+    except IntegrityError:
+        # Another worker created it first
+        db.rollback()
+    finally:
+        db.close()
 
 def get_db():
     db = SessionLocal()
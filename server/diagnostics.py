@@ -0,0 +1,97 @@
+"""
+Connection diagnostics
+Live sizes of every per-connection registry and counters for socket
+lifecycles, so a leak shows up as a number that stays up after close
+"""
+
+import asyncio
+import gc
+import weakref
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # POSIX only; Windows reports no RSS
+    resource = None
+
+def rss_kb() -> Optional[int]:
+    """Current resident set size, the peak where /proc is unavailable, or None"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class ConnectionStats:
+    """Socket lifecycle counters plus a weak set of every Connection alive.
+    
+    A Connection that is still alive after its handler has exited is held
+    by something that should have let go of it.
+    """
+    
+    def __init__(self):
+        self.live = weakref.WeakSet()
+        self.open = 0
+        self.opened = 0
+        self.closed = 0
+        self.errors = 0
+        self.malformed_frames = 0
+    
+    def opening(self, connection):
+        self.live.add(connection)
+        self.open += 1
+        self.opened += 1
+    
+    def closing(self):
+        self.open -= 1
+        self.closed += 1
+
+def snapshot(stats: ConnectionStats, rooms, user_sessions, read_markers, pools, collect: bool = False,
+             bus=None, router=None) -> dict:
+    """Registry sizes and leak counts; collect=True runs the GC first"""
+    if collect:
+        gc.collect()
+    room_members = sum(len(actor.members) for actor in rooms.actors.values())
+    sessions = sum(len(connections) for connections in user_sessions.sessions.values())
+    alive = len(stats.live)
+    return {
+        "handlers": {
+            "open": stats.open,
+            "opened": stats.opened,
+            "closed": stats.closed,
+            "errors": stats.errors,
+            "malformed_frames": stats.malformed_frames
+        },
+        "registries": {
+            "room_actors": len(rooms.actors),
+            "room_members": room_members,
+            "inbox_events": sum(actor.inbox.qsize() for actor in rooms.actors.values()),
+            "session_users": len(user_sessions.sessions),
+            "sessions": sessions,
+            "read_markers_pending": len(read_markers.pending)
+        },
+        # Anything above zero is held past its socket's lifetime
+        "leaks": {
+            "room_members": max(0, room_members - stats.open),
+            "sessions": max(0, sessions - stats.open),
+            "connections": max(0, alive - stats.open)
+        },
+        "worker_bus": {
+            "sent": bus.sent if bus else 0,
+            "received": bus.received if bus else 0,
+            "dropped": bus.dropped if bus else 0,
+            "lost": bus.lost if bus else 0,
+            "chat_forwarded": router.forwarded if router else 0,
+            "chat_forward_failed": router.forward_failed if router else 0,
+            "relays_dropped": rooms.relays_dropped
+        },
+        "connections_alive": alive,
+        "tasks": len(asyncio.all_tasks()),
+        "db_connections_checked_out": sum(pool.checkedout() for pool in pools),
+        "rss_kb": rss_kb()
+    }
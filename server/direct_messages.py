@@ -0,0 +1,70 @@
+"""
+Direct messages
+One-to-one messages stored outside rooms and delivered to both users'
+open sessions through the user session index
+"""
+
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import DirectMessage, SessionLocal, User
+
+MAX_DIRECT_MESSAGE_LENGTH = 4000
+MAX_HISTORY_LIMIT = 200
+
+def format_direct_message(message_id: int, sender: str, recipient: str, content: str, timestamp) -> dict:
+    return {
+        "type": "direct_message",
+        "id": message_id,
+        "from": sender,
+        "to": recipient,
+        "content": content,
+        "timestamp": str(timestamp).replace(" ", "T")
+    }
+
+def store_direct_message(sender_id: int, sender: str, recipient: str, content: str) -> Optional[tuple]:
+    """Persist a message; (recipient_id, frame), or None for an unknown recipient.
+    
+    Opens its own session so it can run in a worker thread.
+    """
+    db = SessionLocal()
+    try:
+        target = db.query(User.id).filter(User.username == recipient, User.is_verified == True).first()
+        if target is None:
+            return None
+        timestamp = datetime.utcnow()
+        message = DirectMessage(sender_id=sender_id, recipient_id=target.id, content=content, timestamp=timestamp)
+        db.add(message)
+        db.flush()
+        message_id = message.id
+        db.commit()
+        return target.id, format_direct_message(message_id, sender, recipient, content, timestamp)
+    finally:
+        db.close()
+
+def conversation(db: Session, user: User, other: User, limit: int,
+                 before_id: Optional[int] = None) -> List[dict]:
+    """The newest limit messages between two users older than before_id, oldest first"""
+    rows = db.execute(text("""
+        SELECT id, sender_id, content, timestamp FROM (
+            SELECT id, sender_id, content, timestamp FROM direct_messages
+            WHERE sender_id = :a AND recipient_id = :b AND id < :before_id
+            ORDER BY id DESC LIMIT :limit
+        )
+        UNION ALL
+        SELECT id, sender_id, content, timestamp FROM (
+            SELECT id, sender_id, content, timestamp FROM direct_messages
+            WHERE sender_id = :b AND recipient_id = :a AND id < :before_id
+            ORDER BY id DESC LIMIT :limit
+        )
+        ORDER BY id DESC
+        LIMIT :limit
+    """), {"a": user.id, "b": other.id, "before_id": before_id or (1 << 62), "limit": limit}).all()
+    names = {user.id: (user.username, other.username), other.id: (other.username, user.username)}
+    return [
+        format_direct_message(row.id, *names[row.sender_id], row.content, row.timestamp)
+        for row in reversed(rows)
+    ]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Room history export and import
+Streams a room as NDJSON (optionally gzip-compressed) with constant memory,
+and bulk loads such files back in large batched transactions
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+
+from sqlalchemy import insert, text
+
+from archive import ColdStore, lookup_usernames
+from database import Message, SessionLocal, User, create_tables
+
+EXPORT_PAGE_SIZE = 1000
+IMPORT_BATCH_SIZE = 10000
+# Flush compressed output at least this often so clients see steady progress
+COMPRESS_FLUSH_BYTES = 64 * 1024
+
+def iter_room_history(store: ColdStore, room_id: int) -> Iterator[dict]:
+    """Every message of a room, oldest first: cold segments, then the hot table.
+    
+    Hot rows are read in keyset pages with a short-lived session per page, so
+    memory stays flat and no read transaction is held open while a slow
+    client drains the stream.
+    """
+    usernames: Dict[int, str] = {}
+    last_id = 0
+    while True:
+        page = []
+        for row in store.iter_after(room_id, last_id):
+            page.append(row)
+            if len(page) == EXPORT_PAGE_SIZE:
+                yield from format_page(room_id, page, usernames)
+                last_id = page[-1][0]
+                page = []
+        if page:
+            yield from format_page(room_id, page, usernames)
+            last_id = page[-1][0]
+        
+        while True:
+            db = SessionLocal()
+            try:
+                rows = db.execute(text("""
+                    SELECT id, user_id, message_type, timestamp, content FROM messages
+                    WHERE room_id = :room_id AND id > :last_id
+                    ORDER BY id
+                    LIMIT :limit
+                """), {"room_id": room_id, "last_id": last_id, "limit": EXPORT_PAGE_SIZE}).all()
+            finally:
+                db.close()
+            page = [[row.id, row.user_id, row.message_type, str(row.timestamp), row.content] for row in rows]
+            yield from format_page(room_id, page, usernames)
+            if page:
+                last_id = page[-1][0]
+            if len(page) < EXPORT_PAGE_SIZE:
+                break
+        
+        # Compaction may have archived rows we had not reached yet
+        if store.last_archived_id(room_id) <= last_id:
+            break
+
+def format_page(room_id: int, rows, usernames: Dict[int, str]) -> Iterator[dict]:
+    missing = {row[1] for row in rows} - usernames.keys()
+    if missing:
+        db = SessionLocal()
+        try:
+            usernames.update(lookup_usernames(db, missing))
+        finally:
+            db.close()
+    for message_id, user_id, message_type, timestamp, content in rows:
+        yield {
+            "id": message_id,
+            "room_id": room_id,
+            "username": usernames.get(user_id),
+            "content": content,
+            "message_type": message_type,
+            "timestamp": timestamp.replace(" ", "T")
+        }
+
+def encode_ndjson(records: Iterable[dict], compress: bool = False) -> Iterator[bytes]:
+    """One JSON object per line, optionally as a gzip stream"""
+    if not compress:
+        for record in records:
+            yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    pending = 0
+    for record in records:
+        chunk = compressor.compress((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        pending += len(chunk)
+        if chunk:
+            yield chunk
+        if pending >= COMPRESS_FLUSH_BYTES:
+            yield compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+    yield compressor.flush()
+
+def import_records(records: Iterable[dict], room_id: int, batch_size: int = IMPORT_BATCH_SIZE,
+                   skip_unknown_users: bool = True) -> dict:
+    """Insert records into a room in batched transactions; returns counts.
+    
+    Authors are matched by username. Ids are not preserved, but order is:
+    records get ids above every existing message while keeping their own
+    timestamps, which compaction allows for.
+    """
+    db = SessionLocal()
+    user_ids: Dict[str, Optional[int]] = {}
+    imported = skipped = 0
+    batch = []
+    
+    def flush():
+        nonlocal imported
+        if batch:
+            db.execute(insert(Message.__table__), batch)
+            db.commit()
+            imported += len(batch)
+            batch.clear()
+    
+    try:
+        for record in records:
+            username = record.get("username")
+            if username not in user_ids:
+                user = db.query(User.id).filter(User.username == username).first()
+                user_ids[username] = user.id if user else None
+            user_id = user_ids[username]
+            if user_id is None:
+                if not skip_unknown_users:
+                    raise ValueError(f"Unknown user: {username}")
+                skipped += 1
+                continue
+            batch.append({
+                "content": record["content"],
+                "user_id": user_id,
+                "room_id": room_id,
+                "message_type": record.get("message_type", "text"),
+                "timestamp": datetime.fromisoformat(record["timestamp"]) if record.get("timestamp") else datetime.utcnow()
+            })
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    finally:
+        db.close()
+    return {"imported": imported, "skipped": skipped}
+
+def read_ndjson(path: str) -> Iterator[dict]:
+    """Records from an NDJSON file (gzip if it ends in .gz, stdin for '-')"""
+    if path == "-":
+        stream = sys.stdin
+    elif path.endswith(".gz"):
+        stream = gzip.open(path, "rt", encoding="utf-8")
+    else:
+        stream = open(path, encoding="utf-8")
+    try:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import room history as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write a room's history")
+    export.add_argument("room_id", type=int)
+    export.add_argument("-o", "--output", default="-", help="output file; .gz compresses (default: stdout)")
+    load = commands.add_parser("import", help="append NDJSON records to a room")
+    load.add_argument("room_id", type=int)
+    load.add_argument("input", nargs="?", default="-", help="input file, .gz allowed (default: stdin)")
+    load.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    load.add_argument("--strict", action="store_true", help="fail on messages from unknown users")
+    args = parser.parse_args()
+    
+    create_tables()
+    if args.command == "export":
+        store = ColdStore()
+        chunks = encode_ndjson(iter_room_history(store, args.room_id), args.output.endswith(".gz"))
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+            store.close()
+    else:
+        result = import_records(read_ndjson(args.input), args.room_id, args.batch_size, not args.strict)
+        print(f"Imported {result['imported']} messages, skipped {result['skipped']}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
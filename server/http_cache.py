@@ -0,0 +1,160 @@
+"""
+HTTP response compression
+ASGI middleware that negotiates brotli or gzip for REST responses and keeps
+the compressed bytes of validated (ETag) responses for reuse
+"""
+
+import gzip
+import re
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip covers every client
+    brotli = None
+
+# Bodies smaller than this go out uncompressed; headers would dominate anyway
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+# One entity tag of an If-None-Match list, or the * wildcard
+ENTITY_TAG = re.compile(r'\*|(?:W/)?("[^"]*")')
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Best supported coding from an Accept-Encoding header, honouring q=0"""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip().lower()] = quality
+    for encoding in (("br",) if brotli else ()) + ("gzip",):
+        if offered.get(encoding, offered.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches etag, by weak comparison.
+    
+    The header is a comma-separated list or *. W/ is ignored on both sides:
+    a proxy that compresses a response may weaken its tag.
+    """
+    if not if_none_match:
+        return False
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for match in ENTITY_TAG.finditer(if_none_match):
+        if match.group(0) == "*" or match.group(1) == etag:
+            return True
+    return False
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        # Quality 5 is close to gzip -9 in size at a fraction of the CPU
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+class CompressedCache:
+    """LRU of compressed bodies keyed by (path, ETag, encoding), bounded in bytes"""
+    
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: "OrderedDict[Tuple[str, str, str], bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return body
+    
+    def put(self, key, body: bytes):
+        if key in self.entries or len(body) > self.max_bytes:
+            return
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+class CompressionMiddleware:
+    """Compress single-chunk REST responses; streamed responses pass through.
+    
+    Responses that carry an ETag are immutable for that tag, so their
+    compressed form is cached and shared by every client asking for it.
+    """
+    
+    def __init__(self, app, minimum_size: int = MIN_COMPRESS_SIZE, cache: Optional[CompressedCache] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache = cache or CompressedCache()
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope["path"] + "?" + scope.get("query_string", b"").decode("latin-1")
+        start = None
+        
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Hold the headers until we know whether the body is one chunk
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                # Files sent through the server's pathsend extension go out as is
+                if start is not None:
+                    await send(start)
+                    start = None
+                await send(message)
+                return
+            
+            response_start, start = start, None
+            body = message.get("body", b"")
+            response_headers = [(k.lower(), v) for k, v in response_start["headers"]]
+            header_map = dict(response_headers)
+            content_type = header_map.get(b"content-type", b"").decode("latin-1")
+            if (message.get("more_body")
+                    or b"content-encoding" in header_map
+                    or len(body) < self.minimum_size
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                await send(response_start)
+                await send(message)
+                return
+            
+            etag = header_map.get(b"etag")
+            key = (path, etag.decode("latin-1"), encoding) if etag else None
+            compressed = self.cache.get(key) if key else None
+            if compressed is None:
+                compressed = compress(body, encoding)
+                if key:
+                    self.cache.put(key, compressed)
+            
+            response_headers = [(k, v) for k, v in response_headers if k not in (b"content-length", b"vary")]
+            vary = header_map.get(b"vary")
+            response_headers += [
+                (b"content-encoding", encoding.encode("latin-1")),
+                (b"content-length", str(len(compressed)).encode("latin-1")),
+                (b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"),
+            ]
+            await send({**response_start, "headers": response_headers})
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Production launcher
+Runs N uvicorn worker processes that share one port through SO_REUSEPORT,
+supervises them, and drains sockets gracefully on SIGTERM
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+# Seconds a worker spends handing its sockets back before it exits
+DRAIN_SECONDS = float(os.getenv("DRAIN_SECONDS", "10"))
+
+# A worker that dies sooner than this after starting is not restarted
+MIN_WORKER_UPTIME = 5.0
+
+def reuseport_socket(host: str, port: int, backlog: int) -> socket.socket:
+    """A listening socket the kernel load-balances with the other workers'"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(worker_id: int, args, bus_dir: str):
+    os.environ["CHAT_WORKER_ID"] = str(worker_id)
+    os.environ["CHAT_WORKERS"] = str(args.workers)
+    os.environ["CHAT_BUS_DIR"] = bus_dir
+    if args.pin_cpus and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+    
+    import asyncio
+    import uvicorn
+    
+    class DrainingServer(uvicorn.Server):
+        """uvicorn.Server that drains WebSockets before its normal shutdown"""
+        
+        draining = False
+        
+        def handle_exit(self, sig, frame):
+            if sig == signal.SIGTERM and not self.draining and args.drain > 0:
+                self.draining = True
+                asyncio.get_event_loop().call_soon_threadsafe(lambda: asyncio.ensure_future(self.drain()))
+            else:
+                super().handle_exit(sig, frame)
+        
+        async def drain(self):
+            # Stop accepting; the other workers' sockets keep the port open
+            for server in getattr(self, "servers", []):
+                server.close()
+            import main
+            await main.drain_connections(args.drain)
+            self.should_exit = True
+    
+    sock = reuseport_socket(args.host, args.port, args.backlog)
+    config = uvicorn.Config(
+        "main:app",
+        loop=args.loop,
+        http=args.http,
+        log_level=args.log_level,
+        timeout_graceful_shutdown=args.drain + 5,
+        ws_ping_interval=args.ws_ping_interval or None,
+        ws_per_message_deflate=False,
+        backlog=args.backlog,
+    )
+    DrainingServer(config).run(sockets=[sock])
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server on several worker processes")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default="auto",
+                        help="event loop; auto uses uvloop when installed")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default="auto",
+                        help="HTTP parser; auto uses httptools when installed")
+    parser.add_argument("--pin-cpus", action="store_true", help="pin worker i to the i-th allowed CPU")
+    parser.add_argument("--drain", type=float, default=DRAIN_SECONDS,
+                        help="seconds to spread socket closes over on SIGTERM (0: close at once)")
+    parser.add_argument("--ws-ping-interval", type=float, default=20.0, help="0 disables keepalive pings")
+    parser.add_argument("--backlog", type=int, default=4096)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # Schema and default room once, before workers race to create them
+    from database import init_database
+    init_database()
+    
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    started = {}
+    stopping = False
+    
+    def start(worker_id: int):
+        process = context.Process(target=run_worker, args=(worker_id, args, bus_dir), name=f"chat-worker-{worker_id}")
+        process.start()
+        workers[worker_id] = process
+        started[worker_id] = time.monotonic()
+    
+    def stop(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(args.workers):
+        start(worker_id)
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers")
+    
+    deadline = None
+    while workers:
+        time.sleep(0.5)
+        if stopping and deadline is None:
+            deadline = time.monotonic() + args.drain + 10
+        for worker_id, process in list(workers.items()):
+            if process.is_alive():
+                if deadline is not None and time.monotonic() > deadline:
+                    process.kill()
+                continue
+            del workers[worker_id]
+            if stopping:
+                continue
+            if time.monotonic() - started[worker_id] < MIN_WORKER_UPTIME:
+                print(f"Worker {worker_id} exited with {process.exitcode} during startup; not restarting")
+                stop(None, None)
+                continue
+            print(f"Worker {worker_id} exited with {process.exitcode}; restarting")
+            start(worker_id)
+    
+    for name in os.listdir(bus_dir):
+        os.unlink(os.path.join(bus_dir, name))
+    os.rmdir(bus_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,37 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
 from sqlalchemy.orm import Session
-from typing import Dict, List, Optional
+from typing import List, Optional
+import os
 import json
 import asyncio
-from datetime import datetime, timedelta
+from urllib.parse import quote, urlencode
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
-from database import create_tables, get_db, User, ChatRoom, Message, RoomMembership
+from database import init_database, engine, reader_engine, get_db, SessionLocal, User, ChatRoom, RoomMembership
+from mentions import LOGIN_BACKLOG_LIMIT, MAX_INBOX_LIMIT, inbox, mark_read
 from auth import AuthService
+from search import MAX_SEARCH_LIMIT, search_messages, search_terms
+from archive import ColdStore, Compactor, newest_message, read_history
+from history_io import encode_ndjson, iter_room_history
+from read_markers import ReadMarkerBuffer, start_at_latest
+from http_cache import CompressionMiddleware, etag_matches
+from room_actors import RoomActor, RoomActors
+from user_sessions import Connection, UserSessions
+from direct_messages import MAX_DIRECT_MESSAGE_LENGTH, MAX_HISTORY_LIMIT, conversation, store_direct_message
+from diagnostics import ConnectionStats, snapshot
+from sql_metrics import QueryScopeMiddleware, sql_metrics
+from tracing import TraceMiddleware, tracer
+from profiler import MAX_PROFILE_SECONDS, profiler
+from worker_bus import WorkerBus
+from room_routing import RoomRouter
+from room_directory import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, RoomDirectory, page_etag, render_page, user_memberships
+from attachments import (ATTACHMENT_ACCEL_REDIRECT, MAX_ATTACHMENT_BYTES, AttachmentStore, UploadError,
+                         attachment_content, clean_filename, iter_range, parse_range)
 from pydantic import BaseModel, EmailStr
 
 # Pydantic models for API
@@ -30,9 +53,15 @@ class SendMessage(BaseModel):
     content: str
     room_id: int
 
+class CreateUpload(BaseModel):
+    filename: str
+    size: int
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    # Unread mentions, newest first, so an offline user catches up at once
+    pending_mentions: List[dict] = []
 
 # FastAPI app
 app = FastAPI(title="Terminal Chat Server", version="1.0.0")
@@ -46,41 +75,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli for REST responses
+app.add_middleware(CompressionMiddleware)
+
+# Statements per request, by route
+app.add_middleware(QueryScopeMiddleware, metrics=sql_metrics)
+
+# Request spans when TRACE_DIR is set
+app.add_middleware(TraceMiddleware, tracer=tracer)
+
 # Security
 security = HTTPBearer()
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        self.user_connections: Dict[int, WebSocket] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: int, room_id: int):
-        await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        self.active_connections[room_id].append(websocket)
-        self.user_connections[user_id] = websocket
-    
-    def disconnect(self, websocket: WebSocket, user_id: int, room_id: int):
-        if room_id in self.active_connections:
-            self.active_connections[room_id].remove(websocket)
-        if user_id in self.user_connections:
-            del self.user_connections[user_id]
-    
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-    
-    async def broadcast_to_room(self, message: str, room_id: int):
-        if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                try:
-                    await connection.send_text(message)
-                except:
-                    # Remove dead connections
-                    self.active_connections[room_id].remove(connection)
+# Upper bound on messages accepted in a single chat_batch frame
+MAX_BATCH_MESSAGES = 500
+# Longest client-chosen message id; matches Message.client_msg_id
+MAX_CLIENT_MSG_ID = 64
+
+# Set by launcher.py when several worker processes share the port
+WORKER_ID = int(os.getenv("CHAT_WORKER_ID", "0"))
+WORKERS = int(os.getenv("CHAT_WORKERS", "1"))
+worker_bus = WorkerBus(os.getenv("CHAT_BUS_DIR"), WORKER_ID, WORKERS)
+bus_tasks = set()
+
+# Every open socket per user, for signaling, direct messages and mentions
+user_sessions = UserSessions(publish=worker_bus.publish_user if worker_bus.enabled else None)
+
+# One actor per active room: ordered persistence and fan-out
+rooms = RoomActors(publish=worker_bus.publish_room if worker_bus.enabled else None, notify=user_sessions.send)
+# Chat goes through the room's owning worker, so one actor orders it
+room_router = RoomRouter(rooms, worker_bus)
+
+# Set while the worker hands its sockets back before exiting
+draining = False
+
+# Socket lifecycle counters for the leak detector
+connection_stats = ConnectionStats()
 
-manager = ConnectionManager()
+# Users allowed to call the /debug endpoints (comma-separated usernames)
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
+# Cached pages of the public room directory
+room_directory = RoomDirectory()
+
+# Cold message segments and the task that fills them
+cold_store = ColdStore()
+compactor = Compactor(cold_store)
+compactor_task: Optional[asyncio.Task] = None
+
+# Content-addressed file store and the task that drops abandoned uploads
+attachment_store = AttachmentStore()
+attachment_task: Optional[asyncio.Task] = None
+
+# Coalesced read acknowledgements
+read_markers = ReadMarkerBuffer()
+read_markers_task: Optional[asyncio.Task] = None
+
+# Periodic trace file writes, when tracing is on
+trace_task: Optional[asyncio.Task] = None
+
+# Selective forwarding unit for room voice; aiortc loads on first use
+_sfu = None
+
+def get_sfu():
+    global _sfu
+    if _sfu is None:
+        from sfu import SelectiveForwardingUnit
+        _sfu = SelectiveForwardingUnit()
+    return _sfu
 
 # Dependency to get current user from token
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
@@ -99,27 +161,75 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         )
     return user
 
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
 # Initialize database
 @app.on_event("startup")
 async def startup_event():
-    create_tables()
+    global compactor_task, read_markers_task, trace_task, attachment_task
+    init_database()
+    # Segments must have a single writer, so only the first worker compacts
+    if WORKER_ID == 0:
+        compactor_task = asyncio.create_task(compactor.run())
+        attachment_task = asyncio.create_task(attachment_store.run())
+    read_markers_task = asyncio.create_task(read_markers.run())
+    worker_bus.start(asyncio.get_running_loop(), on_bus_message)
+    if tracer.enabled:
+        trace_task = asyncio.create_task(tracer.run())
+
+def on_bus_message(message: dict):
+    """Frames from another worker for sockets held by this one"""
+    if "frames" in message:
+        rooms.relay(message["room"], message["frames"])
+    elif room_router.receive(message):
+        pass
+    else:
+        task = asyncio.create_task(user_sessions.deliver(message["user"], message["frame"], message.get("room")))
+        bus_tasks.add(task)
+        task.add_done_callback(bus_tasks.discard)
+
+async def drain_connections(period: float):
+    """Close every socket with 1012 (service restart), spread over period.
     
-    # Create default general room
-    db = next(get_db())
-    general_room = db.query(ChatRoom).filter(ChatRoom.name == "general").first()
-    if not general_room:
-        general_room = ChatRoom(
-            name="general",
-            description="General chat room for everyone",
-            is_private=False
-        )
-        db.add(general_room)
-        db.commit()
+    Clients reconnect through the shared port and land on other workers;
+    spreading the closes keeps them from all reconnecting at once.
+    """
+    global draining
+    draining = True
+    connections = [connection for sessions in user_sessions.sessions.values() for connection in sessions]
+    # Batches at most every 50 ms, evenly over the whole period
+    batches = max(1, min(len(connections), int(period / 0.05)))
+    per_batch = -(-len(connections) // batches) or 1
+    for start in range(0, len(connections), per_batch):
+        await asyncio.gather(*(
+            RoomActor.close_quietly(connection, code=1012) for connection in connections[start:start + per_batch]
+        ))
+        await asyncio.sleep(period / batches)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if compactor_task:
+        compactor_task.cancel()
+    if attachment_task:
+        attachment_task.cancel()
+    if read_markers_task:
+        read_markers_task.cancel()
+    if read_markers.pending:
+        await read_markers.flush()
+    await rooms.stop()
+    worker_bus.close()
+    cold_store.close()
+    if trace_task:
+        trace_task.cancel()
+        tracer.flush()
 
 # Authentication endpoints
 @app.post("/register", response_model=dict)
 async def register(user_data: UserRegister, db: Session = Depends(get_db)):
-    user = AuthService.register_user(db, user_data.username, user_data.email, user_data.password)
+    user = await asyncio.to_thread(AuthService.register_user, db, user_data.username, user_data.email, user_data.password)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -146,11 +256,12 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     access_token = AuthService.create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    pending = inbox(db, user.id, LOGIN_BACKLOG_LIMIT, after_id=user.mention_read_id)
+    return {"access_token": access_token, "token_type": "bearer", "pending_mentions": pending}
 
 @app.get("/verify-email")
 async def verify_email(token: str, db: Session = Depends(get_db)):
-    if AuthService.verify_email(db, token):
+    if await asyncio.to_thread(AuthService.verify_email, db, token):
         return {"message": "Email verified successfully"}
     else:
         raise HTTPException(
@@ -160,17 +271,31 @@ async def verify_email(token: str, db: Session = Depends(get_db)):
 
 # Chat room endpoints
 @app.get("/rooms")
-async def get_rooms(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    rooms = db.query(ChatRoom).all()
-    return [{"id": room.id, "name": room.name, "description": room.description} for room in rooms]
+async def get_rooms(request: Request, prefix: str = "", limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                    current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    try:
+        page = room_directory.page(db, prefix, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # The caller's memberships and unread counters in one query
+    memberships = user_memberships(db, current_user.id)
+    
+    headers = {"ETag": page_etag(page, memberships), "Cache-Control": "private, no-cache"}
+    if page.next_cursor:
+        headers["Link"] = f'</rooms?{urlencode({"prefix": prefix, "limit": limit, "cursor": page.next_cursor})}>; rel="next"'
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(render_page(page, memberships, prefix, cursor is None), headers=headers)
 
-@app.post("/rooms")
-async def create_room(room_data: CreateRoom, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+# Writes run in a thread: waiting for the single writer connection, which a
+# room actor may be holding, must not stall the event loop
+def add_room(db: Session, room_data: CreateRoom, user_id: int) -> ChatRoom:
     room = ChatRoom(
         name=room_data.name,
         description=room_data.description,
         is_private=room_data.is_private,
-        created_by=current_user.id
+        created_by=user_id
     )
     db.add(room)
     db.commit()
@@ -178,116 +303,351 @@ async def create_room(room_data: CreateRoom, current_user: User = Depends(get_cu
     
     # Add creator as admin member
     membership = RoomMembership(
-        user_id=current_user.id,
+        user_id=user_id,
         room_id=room.id,
         is_admin=True
     )
     db.add(membership)
     db.commit()
+    return room
+
+@app.post("/rooms")
+async def create_room(room_data: CreateRoom, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    room = await asyncio.to_thread(add_room, db, room_data, current_user.id)
+    room_directory.invalidate()
     
     return {"id": room.id, "name": room.name, "description": room.description}
 
-@app.post("/rooms/{room_id}/join")
-async def join_room(room_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def add_member(db: Session, room_id: int, user_id: int) -> Optional[str]:
+    """The join outcome, or None if the room does not exist"""
     # Check if room exists
     room = db.query(ChatRoom).filter(ChatRoom.id == room_id).first()
     if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
+        return None
     
     # Check if already a member
     membership = db.query(RoomMembership).filter(
-        RoomMembership.user_id == current_user.id,
+        RoomMembership.user_id == user_id,
         RoomMembership.room_id == room_id
     ).first()
     
     if membership:
-        return {"message": "Already a member of this room"}
+        return "Already a member of this room"
     
     # Add membership
     membership = RoomMembership(
-        user_id=current_user.id,
+        user_id=user_id,
         room_id=room_id
     )
     db.add(membership)
+    db.flush()
+    start_at_latest(db, room_id, user_id)
     db.commit()
     
-    return {"message": "Successfully joined room"}
+    return "Successfully joined room"
+
+@app.post("/rooms/{room_id}/join")
+async def join_room(room_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    message = await asyncio.to_thread(add_member, db, room_id, current_user.id)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    return {"message": message}
+
+def authenticate_socket(token: str, room_id: int):
+    """(close code, user id, username) for a socket handshake.
+    
+    Uses its own short-lived session so neither it nor the User object
+    stays referenced while the socket is open.
+    """
+    db = SessionLocal()
+    try:
+        user = AuthService.get_current_user(db, token)
+        if not user or not user.is_verified:
+            return 4001, None, None
+        membership = db.query(RoomMembership.id).filter(
+            RoomMembership.user_id == user.id,
+            RoomMembership.room_id == room_id
+        ).first()
+        if not membership:
+            return 4003, None, None
+        return None, user.id, user.username
+    finally:
+        db.close()
+
+def client_msg_id(value) -> Optional[str]:
+    """A client's id for its message, or None if missing or unusable"""
+    if isinstance(value, str) and 0 < len(value) <= MAX_CLIENT_MSG_ID:
+        return value
+    return None
 
 # WebSocket endpoint for real-time chat
 @app.websocket("/ws/{room_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: int, token: str, db: Session = Depends(get_db)):
-    # Verify user token
-    user = AuthService.get_current_user(db, token)
-    if not user or not user.is_verified:
-        await websocket.close(code=4001)
+async def websocket_endpoint(websocket: WebSocket, room_id: int, token: str):
+    if draining:
+        await websocket.close(code=1012)
         return
-    
-    # Check if user is member of room
-    membership = db.query(RoomMembership).filter(
-        RoomMembership.user_id == user.id,
-        RoomMembership.room_id == room_id
-    ).first()
-    
-    if not membership:
-        await websocket.close(code=4003)
+    with sql_metrics.scope("ws connect"), tracer.trace("ws connect", "ws"):
+        close_code, user_id, username = authenticate_socket(token, room_id)
+    if close_code:
+        await websocket.close(code=close_code)
         return
     
-    await manager.connect(websocket, user.id, room_id)
-    
-    # Notify room about user joining
-    join_message = {
-        "type": "user_joined",
-        "username": user.username,
-        "message": f"{user.username} joined the room",
-        "timestamp": datetime.now().isoformat()
-    }
-    await manager.broadcast_to_room(json.dumps(join_message), room_id)
+    connection = Connection(websocket, user_id, username, room_id)
+    await websocket.accept()
     
     try:
+        connection_stats.opening(connection)
+        user_sessions.add(connection)
+        await rooms.send(room_id, ("join", connection))
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            try:
+                message_data = json.loads(data)
+                message_type = message_data["type"]
+            except (ValueError, TypeError, KeyError):
+                connection_stats.malformed_frames += 1
+                await websocket.send_text(json.dumps({"type": "error", "message": "Malformed frame"}))
+                continue
             
-            if message_data["type"] == "chat_message":
-                # Save message to database
-                message = Message(
-                    content=message_data["content"],
-                    user_id=user.id,
-                    room_id=room_id,
-                    message_type="text"
-                )
-                db.add(message)
-                db.commit()
+            # One trace per frame; socket work inside it (SQL, encode, fan-out) nests under it
+            with tracer.trace(f"ws {str(message_type)[:32]}", "ws"):
+                if message_type == "chat_message":
+                    # The room actor stores and broadcasts in arrival order,
+                    # then acks the sender if it named the message
+                    content = message_data.get("content")
+                    if isinstance(content, str) and content:
+                        client_id = client_msg_id(message_data.get("client_msg_id"))
+                        await room_router.send_chat(room_id, ("chat", connection, [content], [client_id] if client_id else None, "text"))
+                
+                elif message_type == "chat_batch":
+                    # Pipelined sends from bots: one transaction for the whole batch
+                    messages = message_data.get("messages")
+                    if not isinstance(messages, list):
+                        continue
+                    if len(messages) > MAX_BATCH_MESSAGES:
+                        # Refused whole, so the sender never loses part of a batch unnoticed
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "message": f"chat_batch takes at most {MAX_BATCH_MESSAGES} messages",
+                            "rejected": len(messages)
+                        }))
+                        continue
+                    client_ids = message_data.get("client_msg_ids")
+                    if not isinstance(client_ids, list) or len(client_ids) != len(messages):
+                        client_ids = [None] * len(messages)
+                    pairs = [
+                        (content, client_msg_id(client_id)) for content, client_id in zip(messages, client_ids)
+                        if isinstance(content, str) and content
+                    ]
+                    if pairs:
+                        contents, ids = zip(*pairs)
+                        await room_router.send_chat(room_id, ("chat", connection, list(contents),
+                                                   list(ids) if any(ids) else None, "text"))
+                
+                elif message_type == "file_message":
+                    # An uploaded attachment, referenced by hash; the bytes
+                    # are fetched from /attachments/{sha256}, never fanned out
+                    sha256 = message_data.get("sha256")
+                    size = attachment_store.object_size(sha256) if isinstance(sha256, str) else None
+                    filename = message_data.get("filename")
+                    client_id = client_msg_id(message_data.get("client_msg_id"))
+                    # Only a hash the sender uploaded or can already see in a room
+                    if size is not None and not await asyncio.to_thread(attachment_store.share, sha256,
+                                                                        connection.user_id, room_id):
+                        size = None
+                    if size is None:
+                        # Resending will not help, so the client can drop it
+                        error = {"type": "error", "message": "Unknown attachment", "retry": False}
+                        if client_id:
+                            error["client_msg_ids"] = [client_id]
+                        await websocket.send_text(json.dumps(error))
+                    else:
+                        content = attachment_content(sha256, size, clean_filename(filename if isinstance(filename, str) else ""))
+                        await room_router.send_chat(room_id, ("chat", connection, [content], [client_id] if client_id else None, "file"))
+                
+                elif message_type == "read":
+                    # Client displayed messages up to message_id; the flush caps
+                    # it at the room's newest message
+                    message_id = message_data.get("message_id")
+                    if isinstance(message_id, int):
+                        read_markers.ack(connection.user_id, room_id, message_id)
+                
+                elif message_type == "voice_activity":
+                    # Speaking indicator from a client's voice activity detector
+                    activity_message = {
+                        "type": "voice_activity",
+                        "user_id": connection.user_id,
+                        "username": connection.username,
+                        "speaking": bool(message_data.get("speaking")),
+                        "timestamp": datetime.now().isoformat()
+                    }
+                    await rooms.send(room_id, ("broadcast", activity_message))
+                    if _sfu:
+                        _sfu.set_speaking(room_id, connection.user_id, activity_message["speaking"], owner=connection)
                 
-                # Broadcast to room
-                broadcast_message = {
-                    "type": "chat_message",
-                    "username": user.username,
-                    "content": message_data["content"],
-                    "timestamp": datetime.now().isoformat()
-                }
-                await manager.broadcast_to_room(json.dumps(broadcast_message), room_id)
+                elif message_type == "sfu_offer":
+                    # Publish to the room's SFU; the answer comes back on this socket
+                    async def send_to_socket(payload):
+                        await websocket.send_text(json.dumps(payload))
+                    await get_sfu().handle_offer(room_id, connection.user_id, connection.username, message_data["offer"],
+                                                 send_to_socket, owner=connection)
                 
-            elif message_data["type"] == "voice_offer" or message_data["type"] == "voice_answer":
-                # Handle WebRTC signaling for voice chat
-                target_user = message_data.get("target_user")
-                if target_user and target_user in manager.user_connections:
-                    await manager.send_personal_message(data, manager.user_connections[target_user])
+                elif message_type == "sfu_subscribe":
+                    get_sfu().subscribe(room_id, connection.user_id, message_data.get("mode", "active_speakers"),
+                                        message_data.get("users"), owner=connection)
+                
+                elif message_type == "voice_stop":
+                    if _sfu:
+                        await _sfu.leave(room_id, connection.user_id, owner=connection)
+                
+                elif message_type == "ice_candidate" and message_data.get("target_user") is None:
+                    # Trickled candidate for this user's SFU connection
+                    if _sfu:
+                        await _sfu.add_ice_candidate(room_id, connection.user_id, message_data.get("candidate"), owner=connection)
+                
+                elif message_type in ("voice_offer", "voice_answer", "ice_candidate"):
+                    # Handle WebRTC signaling for voice chat
+                    target_user = message_data.get("target_user")
+                    if target_user:
+                        message_data["from_user"] = connection.user_id
+                        await user_sessions.send(target_user, message_data, room_id=room_id)
+                
+                elif message_type == "direct_message":
+                    # Straight to both users' sessions; rooms are not involved
+                    content = message_data.get("content")
+                    recipient = message_data.get("to")
+                    if not (isinstance(content, str) and content and isinstance(recipient, str)):
+                        continue
+                    with sql_metrics.scope("ws direct_message"), tracer.span("store", "db"):
+                        stored = await asyncio.to_thread(
+                            store_direct_message, connection.user_id, connection.username, recipient, content[:MAX_DIRECT_MESSAGE_LENGTH]
+                        )
+                    if stored is None:
+                        await websocket.send_text(json.dumps({"type": "error", "message": f"Unknown user: {recipient}"}))
+                        continue
+                    recipient_id, frame = stored
+                    await user_sessions.send(recipient_id, frame)
+                    if recipient_id != connection.user_id:
+                        # The sender's own devices, this one included, see it too
+                        await user_sessions.send(connection.user_id, frame)
     
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user.id, room_id)
-        # Notify room about user leaving
-        leave_message = {
-            "type": "user_left",
-            "username": user.username,
-            "message": f"{user.username} left the room",
-            "timestamp": datetime.now().isoformat()
-        }
-        await manager.broadcast_to_room(json.dumps(leave_message), room_id)
+        pass
+    except Exception as e:
+        connection_stats.errors += 1
+        print(f"WebSocket handler error ({connection.username}, room {room_id}): {e!r}")
+        await RoomActor.close_quietly(connection)
+    finally:
+        # Every exit path unregisters the socket, not only a clean disconnect
+        connection_stats.closing()
+        user_sessions.remove(connection)
+        await rooms.send(room_id, ("leave", connection))
+        if _sfu:
+            # Only ends the session this socket published
+            await _sfu.leave(room_id, connection.user_id, owner=connection)
+
+# Live registry sizes and leak counts for soak tests and debugging
+@app.get("/debug/connections")
+async def debug_connections(collect: bool = False, admin: User = Depends(get_admin_user), db: Session = Depends(get_db)):
+    # Hand back this request's own connection so the pool count is everyone else's
+    db.close()
+    pools = (engine.pool, reader_engine.pool)
+    return snapshot(connection_stats, rooms, user_sessions, read_markers, pools, collect, worker_bus,
+                    room_router)
+
+# Samples every thread of this worker for `seconds` and returns folded stacks
+# ("frame;frame;frame count" lines) for flamegraph.pl, speedscope or inferno
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 10.0, interval_ms: float = 5.0, include_idle: bool = False,
+                        admin: User = Depends(get_admin_user)):
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {MAX_PROFILE_SECONDS:g}]")
+    # The sampler runs in a thread so the event loop it is watching keeps going
+    folded = await asyncio.to_thread(profiler.profile, seconds, interval_ms, include_idle)
+    if folded is None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return Response(folded, media_type="text/plain", headers={"X-Worker-Id": str(WORKER_ID)})
+
+# Statement latency histograms, statements per route or socket event, and
+# slow statements with their query plans; reset=true starts a new window
+@app.get("/debug/sql")
+async def debug_sql(top: int = 20, reset: bool = False, admin: User = Depends(get_admin_user)):
+    report = sql_metrics.report(top)
+    if reset:
+        sql_metrics.reset()
+    return report
+
+# Liveness for load balancers; 503 while draining
+@app.get("/health")
+async def health():
+    body = {"status": "draining" if draining else "ok", "worker": WORKER_ID, "connections": connection_stats.open}
+    return JSONResponse(body, status_code=503 if draining else 200)
 
 # Get chat history
 @app.get("/rooms/{room_id}/messages")
-async def get_messages(room_id: int, limit: int = 50, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_messages(request: Request, room_id: int, limit: int = 50, before: Optional[int] = None, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Check if user is member of room
+    membership = db.query(RoomMembership).filter(
+        RoomMembership.user_id == current_user.id,
+        RoomMembership.room_id == room_id
+    ).first()
+    
+    if not membership:
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    
+    # Messages are append-only, so a page is identified by its newest id
+    newest = newest_message(db, cold_store, room_id, before)
+    headers = {"Cache-Control": "private, no-cache"}
+    if newest:
+        newest_id, newest_timestamp = newest
+        modified = datetime.fromisoformat(newest_timestamp).replace(tzinfo=timezone.utc, microsecond=0)
+        headers["ETag"] = f'"m{room_id}-{limit}-{before or 0}-{newest_id}"'
+        headers["Last-Modified"] = format_datetime(modified, usegmt=True)
+        if_none_match = request.headers.get("if-none-match")
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            if etag_matches(if_none_match, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+        elif if_modified_since:
+            try:
+                if modified <= parsedate_to_datetime(if_modified_since):
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+    
+    # Oldest first; pass the first id back as before= to page further back
+    return JSONResponse(read_history(db, cold_store, room_id, limit, before), headers=headers)
+
+# Direct message history with one user
+@app.get("/direct/{username}")
+async def get_direct_messages(username: str, limit: int = 50, before: Optional[int] = None,
+                              current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    other = db.query(User).filter(User.username == username).first()
+    if not other:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Oldest first; pass the first id back as before= to page further back
+    return conversation(db, current_user, other, max(1, min(limit, MAX_HISTORY_LIMIT)), before)
+
+# Mention inbox, newest first; pass the last id back as before= to page further
+@app.get("/mentions")
+async def get_mentions(limit: int = 50, before: Optional[int] = None, unread: bool = False,
+                       current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    after = current_user.mention_read_id if unread else 0
+    mentions = inbox(db, current_user.id, max(1, min(limit, MAX_INBOX_LIMIT)), before, after)
+    for mention in mentions:
+        mention["read"] = mention["id"] <= current_user.mention_read_id
+    return mentions
+
+# Mentions up to up_to have been seen
+@app.post("/mentions/read")
+async def read_mentions(up_to: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    await asyncio.to_thread(mark_read, db, current_user.id, up_to)
+    return {"message": "Mentions marked as read"}
+
+# Export a room's full history as a stream
+@app.get("/rooms/{room_id}/export")
+async def export_room(room_id: int, compress: bool = False, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     # Check if user is member of room
     membership = db.query(RoomMembership).filter(
         RoomMembership.user_id == current_user.id,
@@ -297,19 +657,131 @@ async def get_messages(room_id: int, limit: int = 50, current_user: User = Depen
     if not membership:
         raise HTTPException(status_code=403, detail="Not a member of this room")
     
-    messages = db.query(Message).filter(Message.room_id == room_id).order_by(Message.timestamp.desc()).limit(limit).all()
-    messages.reverse()  # Show oldest first
+    # A sync generator: Starlette drains it in a worker thread
+    filename = f"room-{room_id}.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        encode_ndjson(iter_room_history(cold_store, room_id), compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def upload_status(upload, offset: int) -> dict:
+    return {"upload_id": upload.id, "filename": upload.filename, "size": upload.size, "offset": offset}
+
+# Attachments: start an upload, PUT its bytes in as many chunks as needed,
+# then post a file_message with the returned sha256
+@app.post("/attachments/uploads")
+async def create_upload(upload_data: CreateUpload, current_user: User = Depends(get_current_user)):
+    if not 0 < upload_data.size <= MAX_ATTACHMENT_BYTES:
+        raise HTTPException(status_code=400, detail=f"size must be in (0, {MAX_ATTACHMENT_BYTES}]")
+    upload = await asyncio.to_thread(attachment_store.create_upload, current_user.id, upload_data.filename, upload_data.size)
+    return upload_status(upload, 0)
+
+# Where an interrupted upload resumes
+@app.get("/attachments/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    upload = await asyncio.to_thread(attachment_store.get_upload, upload_id, current_user.id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload_status(upload, attachment_store.offset(upload_id))
+
+# Append the request body at offset; the last chunk returns the sha256
+@app.put("/attachments/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request,
+                       current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # A chunk can take minutes to arrive; keep no pooled connection meanwhile
+    db.close()
+    upload = await asyncio.to_thread(attachment_store.get_upload, upload_id, current_user.id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    try:
+        received = await attachment_store.append(upload, offset, request.stream())
+    except UploadError as e:
+        return JSONResponse({"detail": e.detail, "offset": e.offset}, status_code=e.status)
+    except ClientDisconnect:
+        # Nobody is left to answer; the bytes that arrived are kept
+        return Response(status_code=400)
+    if received < upload.size:
+        await asyncio.to_thread(attachment_store.touch, upload)
+        return upload_status(upload, received)
+    try:
+        sha256 = await asyncio.to_thread(attachment_store.finish, upload)
+    except FileNotFoundError:
+        # A concurrent request finished it first
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return {"sha256": sha256, "size": upload.size, "filename": upload.filename}
+
+# Download by hash, with single Range support, for the uploader and members of a
+# room it was posted in; anyone else gets the same 404 as for a missing hash.
+# Objects never change, so clients may cache them for good. With
+# ATTACHMENT_ACCEL_REDIRECT set, nginx sends the file itself (sendfile,
+# ranges) and the worker only authorizes
+@app.api_route("/attachments/{sha256}", methods=["GET", "HEAD"])
+async def download_attachment(request: Request, sha256: str, filename: Optional[str] = None,
+                              current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    db.close()
+    size = attachment_store.object_size(sha256)
+    if size is None or not await asyncio.to_thread(attachment_store.can_read, sha256, current_user.id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    name = clean_filename(filename or sha256)
+    etag = f'"{sha256}"'
+    headers = {
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(name)}"
+    }
+    if ATTACHMENT_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = f"{ATTACHMENT_ACCEL_REDIRECT.rstrip('/')}/{sha256[:2]}/{sha256}"
+        return Response(media_type="application/octet-stream", headers=headers)
+    
+    # Parsed here rather than left to FileResponse, which ignores Range in
+    # the Starlette releases the pinned FastAPI brings
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            first, last = byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+            headers["Content-Length"] = str(last - first + 1)
+            if request.method == "HEAD":
+                return Response(status_code=206, media_type="application/octet-stream", headers=headers)
+            return StreamingResponse(iter_range(attachment_store.object_path(sha256), first, last), status_code=206,
+                                     media_type="application/octet-stream", headers=headers)
+    return FileResponse(attachment_store.object_path(sha256), media_type="application/octet-stream",
+                        headers=headers)
+
+# Full-text search
+@app.get("/rooms/{room_id}/search")
+async def search_room(room_id: int, q: str, limit: int = 20, cursor: Optional[str] = None,
+                      current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Check if user is member of room
+    membership = db.query(RoomMembership).filter(
+        RoomMembership.user_id == current_user.id,
+        RoomMembership.room_id == room_id
+    ).first()
     
-    return [
-        {
-            "id": msg.id,
-            "content": msg.content,
-            "username": msg.user.username,
-            "timestamp": msg.timestamp.isoformat(),
-            "message_type": msg.message_type
-        }
-        for msg in messages
-    ]
+    if not membership:
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    
+    return run_search(db, q, current_user.id, room_id, limit, cursor)
+
+@app.get("/search")
+async def search_all_rooms(q: str, limit: int = 20, cursor: Optional[str] = None,
+                           current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    return run_search(db, q, current_user.id, None, limit, cursor)
+
+def run_search(db: Session, q: str, user_id: int, room_id: Optional[int], limit: int, cursor: Optional[str]):
+    terms = search_terms(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    try:
+        return search_messages(db, cold_store, terms, user_id, room_id, max(1, min(limit, MAX_SEARCH_LIMIT)), cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,94 @@
+"""
+Mentions
+@username mentions are found when a message is stored and appended to the
+mentioned user's inbox, so nobody has to scan room history to find them
+"""
+
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import Mention, RoomMembership, User
+
+MAX_MENTIONS_PER_MESSAGE = 20
+PREVIEW_LENGTH = 200
+MAX_INBOX_LIMIT = 200
+# Unread mentions returned with a login; older ones are paged from /mentions
+LOGIN_BACKLOG_LIMIT = 50
+
+# "@name", but not the middle of an email address or "@@name"
+MENTION = re.compile(r"(?<![\w@])@([A-Za-z0-9_.-]{1,50})")
+
+def parse_mentions(content: str) -> List[str]:
+    """Distinct usernames mentioned in content, in order of appearance"""
+    if "@" not in content:
+        return []
+    names = []
+    for match in MENTION.finditer(content):
+        # "@bob." at the end of a sentence mentions bob
+        name = match.group(1).rstrip(".-")
+        if name and name not in names:
+            names.append(name)
+            if len(names) == MAX_MENTIONS_PER_MESSAGE:
+                break
+    return names
+
+def format_mention(mention_id: int, room_id: int, message_id: int, sender: str, preview: str, timestamp) -> dict:
+    return {
+        "type": "mention",
+        "id": mention_id,
+        "room_id": room_id,
+        "message_id": message_id,
+        "from": sender,
+        "preview": preview,
+        "timestamp": str(timestamp).replace(" ", "T")
+    }
+
+def record_mentions(db: Session, room_id: int, mentioned: List[tuple]) -> List[Tuple[int, dict]]:
+    """Inbox rows for the room members mentioned in freshly flushed messages.
+    
+    mentioned holds (message, sender username, names) per message. Runs in
+    the caller's transaction; returns (user id, frame) per row for live
+    delivery once it commits.
+    """
+    names = {name for _, _, message_names in mentioned for name in message_names}
+    members = dict(db.query(User.username, User.id).join(
+        RoomMembership, RoomMembership.user_id == User.id
+    ).filter(RoomMembership.room_id == room_id, User.username.in_(names)).all())
+    if not members:
+        return []
+    created_at = datetime.utcnow()
+    rows = []
+    for message, sender, message_names in mentioned:
+        preview = message.content[:PREVIEW_LENGTH]
+        for name in message_names:
+            user_id = members.get(name)
+            if user_id is not None and user_id != message.user_id:
+                rows.append((Mention(user_id=user_id, room_id=room_id, message_id=message.id,
+                                     sender_id=message.user_id, preview=preview, created_at=created_at), sender))
+    db.add_all([mention for mention, _ in rows])
+    db.flush()
+    return [
+        (mention.user_id, format_mention(mention.id, room_id, mention.message_id, sender, mention.preview, created_at))
+        for mention, sender in rows
+    ]
+
+def inbox(db: Session, user_id: int, limit: int, before_id: Optional[int] = None, after_id: int = 0) -> List[dict]:
+    """A user's mentions newest first: one keyset scan of (user_id, id)"""
+    rows = db.execute(text("""
+        SELECT m.id, m.room_id, m.message_id, u.username, m.preview, m.created_at
+        FROM mentions m JOIN users u ON u.id = m.sender_id
+        WHERE m.user_id = :user_id AND m.id < :before_id AND m.id > :after_id
+        ORDER BY m.id DESC
+        LIMIT :limit
+    """), {"user_id": user_id, "before_id": before_id or (1 << 62), "after_id": after_id, "limit": limit}).all()
+    return [format_mention(*row) for row in rows]
+
+def mark_read(db: Session, user_id: int, up_to: int):
+    """Everything up to mention id up_to has been seen; the mark only moves forward"""
+    db.execute(text("UPDATE users SET mention_read_id = MAX(mention_read_id, :up_to) WHERE id = :user_id"),
+               {"up_to": up_to, "user_id": user_id})
+    db.commit()
@@ -0,0 +1,74 @@
+"""
+Sampling profiler
+Samples the stack of every thread in the worker at a fixed interval and
+folds the samples into flamegraph.pl / speedscope "folded stacks" text
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+MAX_PROFILE_SECONDS = 60.0
+MIN_INTERVAL_MS = 1.0
+
+# Innermost frames of a thread with nothing to do; dropped unless asked for
+IDLE_FRAMES = {
+    ("select", "selectors.py"),
+    ("poll", "selectors.py"),
+    ("wait", "threading.py"),
+    ("_worker", "thread.py"),      # asyncio.to_thread executor waiting for work
+    ("run", "runners.py"),         # uvloop waits in C under asyncio.run
+    ("run", "_asyncio.py"),        # anyio threadpool worker waiting for work
+}
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def is_idle(frame) -> bool:
+    code = frame.f_code
+    return (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES
+
+class SamplingProfiler:
+    """One profile at a time, sampled from a background thread.
+    
+    Samples include the event loop thread, so a handler that blocks the
+    loop (bcrypt, a slow query, a large json.dumps) shows up under it.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+    
+    def profile(self, seconds: float, interval_ms: float, include_idle: bool = False) -> Optional[str]:
+        """Folded stacks with sample counts, or None if a profile is already running"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            return self.sample(min(seconds, MAX_PROFILE_SECONDS), max(interval_ms, MIN_INTERVAL_MS) / 1000,
+                               include_idle)
+        finally:
+            self.lock.release()
+    
+    def sample(self, seconds: float, interval: float, include_idle: bool) -> str:
+        me = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (not include_idle and is_idle(frame)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+# One instance per process
+profiler = SamplingProfiler()
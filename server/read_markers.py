@@ -0,0 +1,106 @@
+"""
+Read markers and unread counters
+Each membership stores the id of the last message its user has read and a
+running unread count, so room lists never have to count messages
+"""
+
+import asyncio
+from typing import Dict, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from sql_metrics import sql_metrics
+
+# Read acknowledgements are applied at most this often per membership
+ACK_FLUSH_INTERVAL = 1.0
+
+def increment_unread(db: Session, room_id: int, sender_id: int, count: int = 1):
+    """Count new messages as unread for every member except the sender.
+    
+    Runs in the caller's transaction so counters and messages commit together.
+    """
+    db.execute(text("""
+        UPDATE room_memberships SET unread_count = unread_count + :count
+        WHERE room_id = :room_id AND user_id != :sender_id
+    """), {"count": count, "room_id": room_id, "sender_id": sender_id})
+
+def start_at_latest(db: Session, room_id: int, user_id: int):
+    """Mark everything already in the room as read for a new member"""
+    db.execute(text("""
+        UPDATE room_memberships
+        SET last_read_message_id = COALESCE((SELECT MAX(id) FROM messages WHERE room_id = :room_id), 0),
+            unread_count = 0
+        WHERE room_id = :room_id AND user_id = :user_id
+    """), {"room_id": room_id, "user_id": user_id})
+
+def newest_message_id(db: Session, room_id: int) -> int:
+    """Id of a room's newest message, hot or archived; 0 for an empty room"""
+    return db.execute(text("""
+        SELECT COALESCE(MAX(id), 0) FROM (
+            SELECT MAX(id) AS id FROM messages WHERE room_id = :room_id
+            UNION ALL
+            SELECT MAX(id) FROM archived_messages WHERE room_id = :room_id
+        )
+    """), {"room_id": room_id}).scalar()
+
+class ReadMarkerBuffer:
+    """Coalesces read acknowledgements and writes them in periodic batches.
+    
+    Clients ack every message they display; only the highest id per
+    membership is kept, so a burst of acks becomes one UPDATE per flush.
+    """
+    
+    def __init__(self, interval: float = ACK_FLUSH_INTERVAL):
+        self.interval = interval
+        self.pending: Dict[Tuple[int, int], int] = {}
+        self.flushes = 0
+    
+    def ack(self, user_id: int, room_id: int, message_id: int):
+        key = (user_id, room_id)
+        if message_id > self.pending.get(key, 0):
+            self.pending[key] = message_id
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.pending:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Read marker flush failed: {e}")
+    
+    async def flush(self):
+        # Swap the dict so acks arriving during the write go to the next batch
+        pending, self.pending = self.pending, {}
+        with sql_metrics.scope("read_markers flush"):
+            await asyncio.to_thread(self.write, pending)
+        self.flushes += 1
+    
+    def write(self, pending: Dict[Tuple[int, int], int]):
+        """Advance markers and recount what is still unread past them.
+        
+        Markers only move forward, and never past the room's newest message:
+        an id a client made up would otherwise hide every later message from
+        its unread count. The recount reads the (room_id, id) index from the
+        marker on, which is short once a user has caught up.
+        """
+        db = SessionLocal()
+        try:
+            newest = {room_id: newest_message_id(db, room_id) for room_id in {room_id for _, room_id in pending}}
+            db.execute(text("""
+                UPDATE room_memberships
+                SET last_read_message_id = :message_id,
+                    unread_count = (
+                        SELECT COUNT(*) FROM messages
+                        WHERE room_id = :room_id AND id > :message_id AND user_id != :user_id
+                    )
+                WHERE user_id = :user_id AND room_id = :room_id AND last_read_message_id < :message_id
+            """), [
+                {"user_id": user_id, "room_id": room_id, "message_id": min(message_id, newest[room_id])}
+                for (user_id, room_id), message_id in pending.items()
+            ])
+            db.commit()
+        finally:
+            db.close()
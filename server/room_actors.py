@@ -0,0 +1,369 @@
+"""
+Room actors
+Each active room is a single asyncio task that owns its connections and
+works through an inbox in order: persist, then fan out to every member
+"""
+
+import asyncio
+import json
+from collections import Counter, OrderedDict
+from datetime import datetime
+from itertools import repeat
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from database import Message, SessionLocal
+from mentions import parse_mentions, record_mentions
+from read_markers import increment_unread
+from sql_metrics import sql_metrics
+from tracing import tracer
+from user_sessions import Connection
+
+# A room with no connections stops after this many idle seconds
+ROOM_IDLE_TIMEOUT = 300.0
+# Senders wait once this many events are queued for one room
+INBOX_SIZE = 1000
+# Events taken from the inbox per turn; their messages share one transaction
+MAX_EVENTS_PER_TURN = 500
+# A member that cannot take a frame within this many seconds is dropped
+SEND_TIMEOUT = 5.0
+# Recently stored client message ids remembered per worker; older retries
+# are still caught by the database's unique index
+DEDUP_WINDOW = 50000
+
+# Inbox events, as tuples:
+#   ("join", connection)
+#   ("leave", connection)
+#   ("chat", connection, [content, ...], [client_msg_id or None, ...] or None, message type)
+#   ("broadcast", frame)
+#   ("relay", [encoded frame, ...])   broadcast by another worker
+
+class DedupWindow:
+    """(room id, user id, client message id) -> stored message id, oldest evicted first"""
+    
+    def __init__(self, size: int = DEDUP_WINDOW):
+        self.size = size
+        self.entries: "OrderedDict[Tuple[int, int, str], int]" = OrderedDict()
+        self.hits = 0
+    
+    def get(self, key: Tuple[int, int, str]) -> Optional[int]:
+        message_id = self.entries.get(key)
+        if message_id is not None:
+            self.hits += 1
+        return message_id
+    
+    def add(self, key: Tuple[int, int, str], message_id: int):
+        self.entries[key] = message_id
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def find_stored(db, room_id: int, keys) -> Dict[Tuple[int, str], int]:
+    """Ids of a room's messages already stored under any of the (user id, client id) keys.
+    
+    Client ids are only unique per sender and room: the same id sent to
+    another room is a different message.
+    """
+    rows = db.query(Message.id, Message.user_id, Message.client_msg_id).filter(
+        Message.room_id == room_id,
+        Message.user_id.in_({user_id for user_id, _ in keys}),
+        Message.client_msg_id.in_({client_id for _, client_id in keys})
+    ).all()
+    return {(user_id, client_id): message_id for message_id, user_id, client_id in rows
+            if (user_id, client_id) in keys}
+
+class RoomActor:
+    """Serializes everything that happens in one room.
+    
+    Only this actor's task touches its member table, so there is no locking,
+    every member receives frames in the same order, and a message is in the
+    database before anyone sees it.
+    """
+    
+    def __init__(self, room_id: int, on_idle: Callable[["RoomActor"], None],
+                 publish: Optional[Callable[[int, List[str]], None]] = None,
+                 recent: Optional[DedupWindow] = None,
+                 notify: Optional[Callable[[int, dict], Awaitable]] = None,
+                 after_turn: Optional[Callable[[int], None]] = None):
+        self.room_id = room_id
+        self.inbox: asyncio.Queue = asyncio.Queue(INBOX_SIZE)
+        self.members: Set[Connection] = set()
+        self.on_idle = on_idle
+        # Frames broadcast this turn, handed to other workers once it ends
+        self.publish = publish
+        self.outgoing: List[str] = []
+        self.recent = recent if recent is not None else DedupWindow()
+        # Reaches a mentioned user's sessions wherever they are connected
+        self.notify = notify
+        # Sends what the turn held back for other workers, behind its frames
+        self.after_turn = after_turn
+        self.task = asyncio.create_task(self.run())
+    
+    async def run(self):
+        while True:
+            try:
+                event = await asyncio.wait_for(self.inbox.get(), ROOM_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not self.members and self.inbox.empty():
+                    self.on_idle(self)
+                    return
+                continue
+            events = [event]
+            while len(events) < MAX_EVENTS_PER_TURN and not self.inbox.empty():
+                events.append(self.inbox.get_nowait())
+            try:
+                with tracer.trace("room turn", "room", room_id=self.room_id, events=len(events)):
+                    await self.handle(events)
+            except Exception as e:
+                print(f"Room {self.room_id} actor error: {e}")
+            if self.outgoing:
+                outgoing, self.outgoing = self.outgoing, []
+                try:
+                    self.publish(self.room_id, outgoing)
+                except Exception as e:
+                    # Other workers miss this turn; the room carries on
+                    print(f"Room {self.room_id} relay failed: {e}")
+            if self.after_turn:
+                try:
+                    self.after_turn(self.room_id)
+                except Exception as e:
+                    print(f"Room {self.room_id} relay failed: {e}")
+            # Drop the batch now; it would otherwise keep departed connections
+            # alive until the next event arrives
+            event = events = None
+    
+    async def handle(self, events: List[tuple]):
+        chats = [event for event in events if event[0] == "chat"]
+        stored = {}
+        notifications = []
+        if chats:
+            # Retries of messages this worker stored recently skip the lookup
+            known = {}
+            for _, connection, _, client_ids, _ in chats:
+                for client_id in client_ids or ():
+                    key = (connection.user_id, client_id)
+                    if client_id and key not in known:
+                        message_id = self.recent.get((self.room_id, *key))
+                        if message_id is not None:
+                            known[key] = message_id
+            try:
+                with sql_metrics.scope("room persist"), tracer.span("persist", "db", messages=len(chats)):
+                    results, notifications = await asyncio.to_thread(self.persist, chats, known)
+                stored = {id(event): event_results for event, event_results in zip(chats, results)}
+            except Exception as e:
+                print(f"Room {self.room_id} failed to store messages: {e}")
+        
+        for event in events:
+            kind = event[0]
+            if kind == "join":
+                connection = event[1]
+                username = connection.username
+                self.members.add(connection)
+                await self.broadcast({
+                    "type": "user_joined",
+                    "username": username,
+                    "message": f"{username} joined the room",
+                    "timestamp": datetime.now().isoformat()
+                })
+            elif kind == "leave":
+                connection = event[1]
+                username = connection.username
+                self.members.discard(connection)
+                await self.broadcast({
+                    "type": "user_left",
+                    "username": username,
+                    "message": f"{username} left the room",
+                    "timestamp": datetime.now().isoformat()
+                })
+            elif kind == "chat":
+                _, connection, contents, client_ids, message_type = event
+                results = stored.get(id(event))
+                if results is None:
+                    error = {"type": "error", "message": "Message could not be saved"}
+                    if client_ids:
+                        error["client_msg_ids"] = [client_id for client_id in client_ids if client_id]
+                    await self.send_all([connection], json.dumps(error))
+                    continue
+                timestamp = datetime.now().isoformat()
+                acks = []
+                for (message_id, duplicate), content, client_id in zip(results, contents, client_ids or repeat(None)):
+                    if client_id:
+                        self.recent.add((self.room_id, connection.user_id, client_id), message_id)
+                        acks.append({"client_msg_id": client_id, "id": message_id, "duplicate": duplicate})
+                    if duplicate:
+                        # Stored and broadcast the first time; only the ack is resent
+                        continue
+                    frame = {
+                        "type": "chat_message",
+                        "id": message_id,
+                        "username": connection.username,
+                        "content": content,
+                        "message_type": message_type,
+                        "timestamp": timestamp
+                    }
+                    if client_id:
+                        frame["client_msg_id"] = client_id
+                    await self.broadcast(frame)
+                if acks:
+                    # Sender only, after the broadcast so an ack never overtakes its message
+                    await self.send_all([connection], json.dumps({"type": "ack", "messages": acks}))
+            elif kind == "broadcast":
+                await self.broadcast(event[1])
+            elif kind == "relay":
+                for text in event[1]:
+                    await self.send_all(list(self.members), text)
+            elif kind == "reply":
+                await self.send_all([event[1]], event[2])
+        
+        if notifications and self.notify:
+            # After the broadcast, so a mention never arrives before its message
+            await asyncio.gather(*(self.notify(user_id, frame) for user_id, frame in notifications),
+                                 return_exceptions=True)
+    
+    def persist(self, chats: List[tuple], known: Dict[Tuple[int, str], int]) -> Tuple[list, list]:
+        """Store every new message of a turn, and its mentions, in one transaction.
+        
+        Returns (message id, duplicate) per content of each event, where a
+        duplicate is a resend of a stored message and keeps its first id, and
+        (user id, frame) per mention to deliver.
+        """
+        try:
+            return self.store(chats, known)
+        except IntegrityError:
+            # Another worker stored one of these resends between the lookup
+            # and the insert; the second pass finds it
+            return self.store(chats, known)
+    
+    def store(self, chats: List[tuple], known: Dict[Tuple[int, str], int]) -> Tuple[list, list]:
+        db = SessionLocal()
+        try:
+            keys = {
+                (connection.user_id, client_id)
+                for _, connection, _, client_ids, _ in chats for client_id in client_ids or () if client_id
+            } - known.keys()
+            if keys:
+                # Resends this worker has not seen: stored by another worker or evicted
+                known = {**known, **find_stored(db, self.room_id, keys)}
+            added: Dict[Tuple[int, str], Message] = {}
+            messages = []
+            mentioned = []
+            per_event = []
+            for _, connection, contents, client_ids, message_type in chats:
+                entries = []
+                for content, client_id in zip(contents, client_ids or repeat(None)):
+                    key = (connection.user_id, client_id)
+                    if client_id and key in known:
+                        entries.append((known[key], True))
+                    elif client_id and key in added:
+                        # Sent again before the first copy was acknowledged
+                        entries.append((added[key], True))
+                    else:
+                        message = Message(content=content, user_id=connection.user_id, room_id=self.room_id,
+                                          message_type=message_type, client_msg_id=client_id)
+                        messages.append(message)
+                        names = parse_mentions(content) if message_type == "text" else []
+                        if names:
+                            mentioned.append((message, connection.username, names))
+                        if client_id:
+                            added[key] = message
+                        entries.append((message, False))
+                per_event.append(entries)
+            db.add_all(messages)
+            db.flush()
+            # Read ids before commit expires the objects
+            results = [
+                [(entry.id if isinstance(entry, Message) else entry, duplicate) for entry, duplicate in entries]
+                for entries in per_event
+            ]
+            notifications = record_mentions(db, self.room_id, mentioned) if mentioned else []
+            senders = Counter(message.user_id for message in messages)
+            for sender_id, count in senders.items():
+                increment_unread(db, self.room_id, sender_id, count)
+            db.commit()
+            return results, notifications
+        finally:
+            db.close()
+    
+    async def broadcast(self, frame: dict):
+        with tracer.span("encode", "serialize"):
+            text = json.dumps(frame)
+        if self.publish:
+            self.outgoing.append(text)
+        await self.send_all(list(self.members), text)
+    
+    async def send_all(self, connections: List[Connection], text: str):
+        if not connections:
+            return
+        with tracer.span("fanout", "fanout", sockets=len(connections), bytes=len(text)):
+            results = await asyncio.gather(
+                *(asyncio.wait_for(connection.websocket.send_text(text), SEND_TIMEOUT) for connection in connections),
+                return_exceptions=True
+            )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception) and connection in self.members:
+                # Dead or stalled; closing ends that socket's receive loop
+                self.members.discard(connection)
+                asyncio.create_task(self.close_quietly(connection))
+    
+    @staticmethod
+    async def close_quietly(connection: Connection, code: int = 1011):
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass
+
+class RoomActors:
+    """Room id -> running actor; actors start on first event and stop when idle"""
+    
+    def __init__(self, publish: Optional[Callable[[int, List[str]], None]] = None,
+                 notify: Optional[Callable[[int, dict], Awaitable]] = None):
+        self.actors: Dict[int, RoomActor] = {}
+        self.publish = publish
+        self.notify = notify
+        self.after_turn: Optional[Callable[[int], None]] = None
+        self.relays_dropped = 0
+        # Shared by every room, so it outlives actors that stop when idle
+        self.recent = DedupWindow()
+    
+    async def send(self, room_id: int, event: tuple):
+        # Look up on every send: an evicted actor is never handed new events
+        actor = self.actors.get(room_id)
+        if actor is None:
+            actor = self.actors[room_id] = RoomActor(room_id, self.evict, self.publish, self.recent,
+                                                     self.notify, self.after_turn)
+            # However the task ends, the next event starts a fresh actor
+            actor.task.add_done_callback(lambda task, actor=actor: self.evict(actor))
+        await actor.inbox.put(event)
+    
+    def relay(self, room_id: int, frames: List[str]):
+        """Frames another worker broadcast; only a room with local members cares"""
+        actor = self.actors.get(room_id)
+        if actor is None:
+            return
+        try:
+            actor.inbox.put_nowait(("relay", frames))
+        except asyncio.QueueFull:
+            self.relays_dropped += 1
+    
+    def reply(self, room_id: int, connection: Connection, text: str) -> bool:
+        """An ack or error from the owning worker, queued behind the frames it
+        relayed first; False when the room has no local actor to queue it"""
+        actor = self.actors.get(room_id)
+        if actor is None:
+            return False
+        try:
+            actor.inbox.put_nowait(("reply", connection, text))
+        except asyncio.QueueFull:
+            return False
+        return True
+    
+    def evict(self, actor: RoomActor):
+        if self.actors.get(actor.room_id) is actor:
+            del self.actors[actor.room_id]
+    
+    async def stop(self):
+        actors, self.actors = list(self.actors.values()), {}
+        for actor in actors:
+            actor.task.cancel()
+        await asyncio.gather(*(actor.task for actor in actors), return_exceptions=True)
@@ -0,0 +1,132 @@
+"""
+Room directory
+Paginated public room listing served from an in-memory cache, with the
+caller's memberships and unread counters layered on per request
+"""
+
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+MAX_CACHED_PAGES = 256
+
+def encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> str:
+    return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+
+class DirectoryPage:
+    """One cached page of public rooms"""
+    
+    def __init__(self, rooms: List[dict], next_cursor: Optional[str]):
+        self.rooms = rooms
+        self.next_cursor = next_cursor
+        self.digest = hashlib.sha256(json.dumps([rooms, next_cursor]).encode("utf-8")).hexdigest()
+
+class RoomDirectory:
+    """Public room pages keyed by (prefix, cursor, limit).
+    
+    Every lookup runs one cheap validator query (room count and highest id)
+    and drops the cache when it changes, so rooms created through another
+    worker process are picked up without any messaging between processes.
+    """
+    
+    def __init__(self):
+        self.pages: "OrderedDict[Tuple[str, Optional[str], int], DirectoryPage]" = OrderedDict()
+        self.validator: Optional[tuple] = None
+        self.hits = 0
+        self.misses = 0
+    
+    def invalidate(self):
+        self.pages.clear()
+        self.validator = None
+    
+    def page(self, db: Session, prefix: str, cursor: Optional[str], limit: int) -> DirectoryPage:
+        validator = tuple(db.execute(text("SELECT COUNT(*), MAX(id) FROM chat_rooms")).one())
+        if validator != self.validator:
+            self.pages.clear()
+            self.validator = validator
+        
+        key = (prefix, cursor, limit)
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+        
+        self.misses += 1
+        page = self.load(db, prefix, cursor, limit)
+        self.pages[key] = page
+        if len(self.pages) > MAX_CACHED_PAGES:
+            self.pages.popitem(last=False)
+        return page
+    
+    def load(self, db: Session, prefix: str, cursor: Optional[str], limit: int) -> DirectoryPage:
+        # Keyset pagination over the unique name index
+        params = {"limit": limit + 1, "after": decode_cursor(cursor) if cursor else ""}
+        filters = ["is_private = 0", "name > :after"]
+        if prefix:
+            filters.append("name >= :prefix AND name < :prefix_end")
+            params.update(prefix=prefix, prefix_end=prefix + "\U0010ffff")
+        rows = db.execute(text(f"""
+            SELECT id, name, description FROM chat_rooms
+            WHERE {" AND ".join(filters)}
+            ORDER BY name
+            LIMIT :limit
+        """), params).all()
+        
+        rooms = [{"id": row.id, "name": row.name, "description": row.description} for row in rows[:limit]]
+        next_cursor = encode_cursor(rooms[-1]["name"]) if len(rows) > limit else None
+        return DirectoryPage(rooms, next_cursor)
+
+def user_memberships(db: Session, user_id: int) -> Dict[int, tuple]:
+    """room_id -> (unread_count, last_read_message_id, name, description, is_private)"""
+    rows = db.execute(text("""
+        SELECT rm.room_id, rm.unread_count, rm.last_read_message_id, r.name, r.description, r.is_private
+        FROM room_memberships rm
+        JOIN chat_rooms r ON r.id = rm.room_id
+        WHERE rm.user_id = :user_id
+    """), {"user_id": user_id}).all()
+    return {row.room_id: tuple(row[1:]) for row in rows}
+
+def page_etag(page: DirectoryPage, memberships: Dict[int, tuple]) -> str:
+    """Strong validator for a page as seen by one user"""
+    state = sorted((room_id, values[0], values[1]) for room_id, values in memberships.items())
+    digest = hashlib.sha256(f"{page.digest}:{state}".encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+def render_page(page: DirectoryPage, memberships: Dict[int, tuple], prefix: str,
+                first_page: bool) -> List[dict]:
+    """Public rooms plus the caller's private rooms, with unread counters"""
+    rooms = []
+    for room in page.rooms:
+        unread_count, last_read_message_id = memberships.get(room["id"], (0, 0))[:2]
+        rooms.append({
+            **room,
+            "is_private": False,
+            "is_member": room["id"] in memberships,
+            "unread_count": unread_count,
+            "last_read_message_id": last_read_message_id
+        })
+    if first_page:
+        # Private rooms stay out of the shared cache; members get theirs on page one
+        for room_id, (unread_count, last_read_message_id, name, description, is_private) in memberships.items():
+            if is_private and name.startswith(prefix):
+                rooms.append({
+                    "id": room_id,
+                    "name": name,
+                    "description": description,
+                    "is_private": True,
+                    "is_member": True,
+                    "unread_count": unread_count,
+                    "last_read_message_id": last_read_message_id
+                })
+    return rooms
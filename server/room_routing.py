@@ -0,0 +1,131 @@
+"""
+Room routing
+With several workers, each room's messages are stored and fanned out by one
+owning worker, so every member sees them in one order whichever worker holds
+their socket
+"""
+
+import asyncio
+import itertools
+import json
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+from room_actors import RoomActors
+from user_sessions import Connection
+from worker_bus import WorkerBus
+
+# Waits before each retry of a forward the owner's full queue refused
+FORWARD_RETRY_DELAYS = (0.001, 0.005, 0.02, 0.05, 0.1)
+
+class RemoteSocket:
+    """Stands in for a sender's socket on the owning worker.
+    
+    Acks and errors go back to the worker holding the real socket. They are
+    held until the actor has relayed the turn's frames, and the receiving
+    worker queues them behind those frames, so an ack never overtakes its
+    message there either.
+    """
+    
+    def __init__(self, router: "RoomRouter", worker_id: int, token: int, room_id: int):
+        self.router = router
+        self.worker_id = worker_id
+        self.token = token
+        self.room_id = room_id
+    
+    async def send_text(self, text: str):
+        self.router.replies.setdefault(self.room_id, []).append(
+            (self.worker_id, {"reply": self.token, "room": self.room_id, "text": text})
+        )
+    
+    async def close(self, code: int = 1000):
+        pass
+
+class RoomRouter:
+    """Sends chat events to the actor of the room's owning worker.
+    
+    The owner is room_id modulo the worker count. Other workers forward over
+    the bus; the owner's actor relays the frames back to every worker, as for
+    any broadcast. A forward the owner's queue refuses is retried briefly,
+    holding back the sender's next message; one that still fails, or is lost
+    while the owner restarts, is resent by the client after its ack timeout,
+    and deduplicated.
+    """
+    
+    def __init__(self, rooms: RoomActors, bus: WorkerBus):
+        self.rooms = rooms
+        self.bus = bus
+        # Replies to forwarded messages, sent when the room's turn ends
+        self.replies: Dict[int, List[Tuple[int, dict]]] = {}
+        rooms.after_turn = self.flush
+        # Local senders of forwarded messages, by the token their replies carry
+        self.tokens: "weakref.WeakKeyDictionary[Connection, int]" = weakref.WeakKeyDictionary()
+        self.connections: "weakref.WeakValueDictionary[int, Connection]" = weakref.WeakValueDictionary()
+        self.next_token = itertools.count(1)
+        self.forwarded = 0
+        self.forward_failed = 0
+        self.tasks = set()
+    
+    def owner(self, room_id: int) -> int:
+        return room_id % self.bus.workers
+    
+    async def send_chat(self, room_id: int, event: tuple):
+        """("chat", connection, contents, client ids, message type) for room_id"""
+        owner = self.owner(room_id) if self.bus.enabled else self.bus.worker_id
+        if owner == self.bus.worker_id:
+            await self.rooms.send(room_id, event)
+            return
+        _, connection, contents, client_ids, message_type = event
+        token = self.tokens.get(connection)
+        if token is None:
+            token = self.tokens[connection] = next(self.next_token)
+            self.connections[token] = connection
+        message = {
+            "chat": room_id, "origin": self.bus.worker_id, "token": token,
+            "user_id": connection.user_id, "username": connection.username,
+            "contents": contents, "client_ids": client_ids, "message_type": message_type
+        }
+        for delay in (*FORWARD_RETRY_DELAYS, None):
+            if self.bus.send_to(owner, message):
+                self.forwarded += 1
+                return
+            if delay is not None:
+                await asyncio.sleep(delay)
+        self.forward_failed += 1
+        error = {"type": "error", "message": "Message could not be sent"}
+        if client_ids:
+            error["client_msg_ids"] = [client_id for client_id in client_ids if client_id]
+        await self.reply(connection, json.dumps(error))
+    
+    def receive(self, message: dict) -> bool:
+        """Handle a forwarded chat or a reply to one; False for other bus messages"""
+        if "chat" in message:
+            sender = Connection(RemoteSocket(self, message["origin"], message["token"], message["chat"]),
+                                message["user_id"], message["username"], message["chat"])
+            self.spawn(self.rooms.send(message["chat"], ("chat", sender, message["contents"],
+                                                         message["client_ids"], message["message_type"])))
+            return True
+        if "reply" in message:
+            connection: Optional[Connection] = self.connections.get(message["reply"])
+            # Through the local actor, behind the relayed frames of the same turn
+            if connection is not None and not self.rooms.reply(message["room"], connection, message["text"]):
+                self.spawn(self.reply(connection, message["text"]))
+            return True
+        return False
+    
+    def flush(self, room_id: int):
+        for worker_id, reply in self.replies.pop(room_id, ()):
+            self.bus.send_to(worker_id, reply)
+    
+    @staticmethod
+    async def reply(connection: Connection, text: str):
+        try:
+            await connection.websocket.send_text(text)
+        except Exception:
+            # The socket closed; its handler cleans up
+            pass
+    
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
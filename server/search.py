@@ -0,0 +1,181 @@
+"""
+Full-text message search
+Queries the SQLite FTS5 index that triggers keep in sync with the messages table;
+archived messages stay in the index and are read back from their segments
+"""
+
+import re
+import unicodedata
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from archive import ColdStore, lookup_usernames
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+SNIPPET_TOKENS = 16
+MAX_SEARCH_LIMIT = 100
+# Only the newest matches are ranked, so very common terms cost the same as rare ones
+RANK_WINDOW = 5000
+
+# Same fields as a hot result row
+ArchivedHit = namedtuple("ArchivedHit", "id room_id content username timestamp message_type")
+
+def search_terms(query: str) -> List[str]:
+    """Words of a user query; punctuation and FTS5 operators are ignored"""
+    return re.findall(r"\w+", query)
+
+def build_match_query(terms: List[str]) -> str:
+    """Safe FTS5 expression for the terms: all words, last one as a prefix"""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def fold(word: str) -> str:
+    """Case and diacritic folding matching the index's unicode61 tokenizer"""
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def highlight(content: str, terms: List[str]) -> str:
+    """Excerpt of content around the first hit with matching words marked.
+    
+    Built in Python because FTS5's snippet() re-runs the whole match for
+    every row it is asked about, which is slow for prefix queries.
+    """
+    words = [fold(term) for term in terms]
+    *exact, prefix = words
+    tokens = list(re.finditer(r"\w+", content))
+    hits = [
+        index for index, token in enumerate(tokens)
+        if fold(token.group()) in exact or fold(token.group()).startswith(prefix)
+    ]
+    if not tokens:
+        return content
+    first = hits[0] if hits else 0
+    start = max(0, min(first - 2, len(tokens) - SNIPPET_TOKENS))
+    end = min(len(tokens), start + SNIPPET_TOKENS)
+    
+    parts = ["…" if start > 0 else content[:tokens[0].start()]]
+    position = tokens[start].start()
+    for index in range(start, end):
+        token = tokens[index]
+        parts.append(content[position:token.start()])
+        if index in hits:
+            parts.append(f"{HIGHLIGHT_START}{token.group()}{HIGHLIGHT_END}")
+        else:
+            parts.append(token.group())
+        position = token.end()
+    parts.append("…" if end < len(tokens) else content[position:])
+    return "".join(parts)
+
+def encode_cursor(rank: float, message_id: int, floor: int, ceiling: int) -> str:
+    return f"{rank!r}:{message_id}:{floor}:{ceiling}"
+
+def decode_cursor(cursor: str) -> Tuple[float, int, int, int]:
+    rank, message_id, floor, ceiling = cursor.split(":")
+    return float(rank), int(message_id), int(floor), int(ceiling)
+
+def archived_details(db: Session, store: ColdStore, ids: List[int]) -> dict:
+    """Search result rows for archived hits, with content from their segments"""
+    rows = db.execute(text("""
+        SELECT id, room_id, user_id, message_type, timestamp FROM archived_messages WHERE id IN :ids
+    """).bindparams(bindparam("ids", expanding=True)), {"ids": ids}).all()
+    usernames = lookup_usernames(db, {row.user_id for row in rows})
+    details = {}
+    for row in rows:
+        archived = store.get(row.room_id, row.id)
+        if archived is not None:
+            details[row.id] = ArchivedHit(row.id, row.room_id, archived[4], usernames.get(row.user_id),
+                                          row.timestamp, row.message_type)
+    return details
+
+def search_messages(db: Session, store: ColdStore, terms: List[str], user_id: int, room_id: Optional[int] = None,
+                    limit: int = 20, cursor: Optional[str] = None) -> dict:
+    """Ranked search over the rooms a user belongs to, one keyset page at a time.
+    
+    The first page pins a window of the newest ``RANK_WINDOW`` matching
+    message ids; results inside it are ordered by bm25 rank then id.
+    ``cursor`` is the ``next_cursor`` of the previous page and carries the
+    window, so messages sent while paging do not shift later pages.
+    """
+    match = build_match_query(terms)
+    params = {"user_id": user_id}
+    filters = ["messages_fts MATCH :match"]
+    if room_id is not None:
+        # room_id is indexed as a column, so FTS5 skips other rooms' hits
+        # itself instead of SQLite filtering every hit afterwards
+        params["match"] = f'({match}) AND room_id : "{int(room_id)}"'
+    else:
+        params["match"] = match
+    filters.append("COALESCE(m.room_id, a.room_id) IN (SELECT room_id FROM room_memberships WHERE user_id = :user_id)")
+    
+    if cursor:
+        after_rank, after_id, floor, ceiling = decode_cursor(cursor)
+    else:
+        # Walking the index newest-first is cheap; ranking every hit is not
+        floor, ceiling = db.execute(text(f"""
+            SELECT MIN(id), MAX(id) FROM (
+                SELECT messages_fts.rowid AS id FROM messages_fts
+                LEFT JOIN messages m ON m.id = messages_fts.rowid
+                LEFT JOIN archived_messages a ON a.id = messages_fts.rowid
+                WHERE {" AND ".join(filters)}
+                ORDER BY messages_fts.rowid DESC
+                LIMIT {RANK_WINDOW}
+            )
+        """), params).one()
+        if floor is None:
+            return {"results": [], "next_cursor": None}
+    
+    filters.append("messages_fts.rowid BETWEEN :floor AND :ceiling")
+    params.update(floor=floor, ceiling=ceiling, limit=limit + 1)
+    if cursor:
+        filters.append(
+            "(bm25(messages_fts, 1.0, 0.0) > :after_rank"
+            " OR (bm25(messages_fts, 1.0, 0.0) = :after_rank AND messages_fts.rowid > :after_id))"
+        )
+        params.update(after_rank=after_rank, after_id=after_id)
+    ranked = db.execute(text(f"""
+        SELECT messages_fts.rowid AS id, bm25(messages_fts, 1.0, 0.0) AS score
+        FROM messages_fts
+        LEFT JOIN messages m ON m.id = messages_fts.rowid
+        LEFT JOIN archived_messages a ON a.id = messages_fts.rowid
+        WHERE {" AND ".join(filters)}
+        ORDER BY score, messages_fts.rowid
+        LIMIT :limit
+    """), params).all()
+    page: List = ranked[:limit]
+    if not page:
+        return {"results": [], "next_cursor": None}
+    
+    details = db.execute(text("""
+        SELECT m.id, m.room_id, m.content, u.username, m.timestamp, m.message_type
+        FROM messages m
+        JOIN users u ON u.id = m.user_id
+        WHERE m.id IN :ids
+    """).bindparams(bindparam("ids", expanding=True)), {"ids": [row.id for row in page]})
+    by_id = {row.id: row for row in details}
+    archived = [hit.id for hit in page if hit.id not in by_id]
+    if archived:
+        by_id.update(archived_details(db, store, archived))
+    
+    results = []
+    for hit in page:
+        row = by_id.get(hit.id)
+        if row is None:
+            continue
+        results.append({
+            "id": row.id,
+            "room_id": row.room_id,
+            "username": row.username,
+            "timestamp": str(row.timestamp).replace(" ", "T"),
+            "message_type": row.message_type,
+            "snippet": highlight(row.content, terms),
+            "rank": hit.score,
+        })
+    next_cursor = None
+    if len(ranked) > limit:
+        next_cursor = encode_cursor(page[-1].score, page[-1].id, floor, ceiling)
+    return {"results": results, "next_cursor": next_cursor}
@@ -0,0 +1,273 @@
+"""
+Selective forwarding unit for room voice
+Each participant publishes one audio uplink to the server, which forwards
+the selected speakers to every subscriber over a fixed set of downlink slots
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from aiortc.sdp import SessionDescription, candidate_from_sdp, candidate_to_sdp
+
+# Upper bound on downlink slots a subscriber may negotiate
+MAX_SLOTS = 8
+
+def local_candidates(pc: RTCPeerConnection) -> List[dict]:
+    """Gathered local candidates in trickle ICE signaling form"""
+    description = SessionDescription.parse(pc.localDescription.sdp)
+    return [
+        {
+            "candidate": "candidate:" + candidate_to_sdp(candidate),
+            "sdpMid": media.rtp.muxId,
+            "sdpMLineIndex": index
+        }
+        for index, media in enumerate(description.media)
+        for candidate in media.ice_candidates
+    ]
+
+async def add_candidate(pc: RTCPeerConnection, data: Optional[dict]):
+    """Apply a trickled remote candidate; None signals end-of-candidates"""
+    if data is None:
+        await pc.addIceCandidate(None)
+        return
+    candidate = candidate_from_sdp(data["candidate"].split(":", 1)[1])
+    candidate.sdpMid = data.get("sdpMid")
+    candidate.sdpMLineIndex = data.get("sdpMLineIndex")
+    await pc.addIceCandidate(candidate)
+
+class SlotTrack(MediaStreamTrack):
+    """Downlink slot that carries whichever publisher is assigned to it"""
+    
+    kind = "audio"
+    
+    def __init__(self):
+        super().__init__()
+        self.publisher_id: Optional[int] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=10)
+    
+    def push(self, frame):
+        """Queue a frame, dropping the oldest if the subscriber lags"""
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(frame)
+    
+    def clear(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+    
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        frame = await self._queue.get()
+        if frame is None:
+            raise MediaStreamError
+        return frame
+    
+    def stop(self):
+        super().stop()
+        self.clear()
+        self._queue.put_nowait(None)
+
+class SfuParticipant:
+    """One user's peer connection with the server.
+    
+    A user may have several sockets open on a room; owner is the one that
+    published, and only it can renegotiate, steer or end the session.
+    """
+    
+    def __init__(self, user_id: int, username: str, send: Callable[[dict], Awaitable[None]], owner=None):
+        self.user_id = user_id
+        self.username = username
+        self.send = send
+        self.owner = owner
+        # Host candidates only: the server is directly reachable, and skipping
+        # STUN lets gathering finish immediately
+        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=[]))
+        self.pending_candidates: List[Optional[dict]] = []
+        self.uplink: Optional[MediaStreamTrack] = None
+        self.reader: Optional[asyncio.Task] = None
+        self.slots: List[SlotTrack] = []
+        # "active_speakers", "all" or "users"
+        self.mode = "active_speakers"
+        self.selected_users: List[int] = []
+        self.joined_at = time.monotonic()
+
+class SfuRoom:
+    """Participants of one room and the publisher -> slot routing table"""
+    
+    def __init__(self, room_id: int):
+        self.room_id = room_id
+        self.participants: Dict[int, SfuParticipant] = {}
+        self.speaking: Dict[int, bool] = {}
+        self.last_active: Dict[int, float] = {}
+        self.routes: Dict[int, List[SlotTrack]] = {}
+    
+    def select(self, subscriber: SfuParticipant) -> List[int]:
+        """Publisher ids a subscriber should hear, best first"""
+        publishers = [
+            p for p in self.participants.values()
+            if p.user_id != subscriber.user_id and p.uplink is not None
+        ]
+        if subscriber.mode == "users":
+            available = {p.user_id for p in publishers}
+            return [user_id for user_id in subscriber.selected_users if user_id in available]
+        if subscriber.mode == "active_speakers":
+            publishers.sort(key=lambda p: (
+                not self.speaking.get(p.user_id, False),
+                -self.last_active.get(p.user_id, 0.0),
+            ))
+        else:
+            publishers.sort(key=lambda p: p.joined_at)
+        return [p.user_id for p in publishers]
+    
+    def assign(self):
+        """Map selected publishers onto each subscriber's slots and rebuild routes"""
+        routes: Dict[int, List[SlotTrack]] = {}
+        for subscriber in self.participants.values():
+            wanted = self.select(subscriber)[:len(subscriber.slots)]
+            # Keep slots that already carry a wanted publisher to avoid glitches
+            kept = {slot.publisher_id for slot in subscriber.slots if slot.publisher_id in wanted}
+            free = [slot for slot in subscriber.slots if slot.publisher_id not in kept]
+            for publisher_id in wanted:
+                if publisher_id not in kept:
+                    slot = free.pop(0)
+                    slot.clear()
+                    slot.publisher_id = publisher_id
+            for slot in free:
+                slot.clear()
+                slot.publisher_id = None
+            for slot in subscriber.slots:
+                if slot.publisher_id is not None:
+                    routes.setdefault(slot.publisher_id, []).append(slot)
+        self.routes = routes
+    
+    async def forward(self, publisher: SfuParticipant):
+        """Copy frames from a publisher's uplink into the slots routed to it"""
+        try:
+            while True:
+                frame = await publisher.uplink.recv()
+                for slot in self.routes.get(publisher.user_id, ()):
+                    slot.push(frame)
+        except MediaStreamError:
+            pass
+
+class SelectiveForwardingUnit:
+    """Server side of room voice: one uplink in, selected speakers out"""
+    
+    def __init__(self):
+        self.rooms: Dict[int, SfuRoom] = {}
+    
+    def participant(self, room_id: int, user_id: int, owner=None) -> Optional[SfuParticipant]:
+        """user_id's participant in a room, if owner (None: any socket) published it"""
+        room = self.rooms.get(room_id)
+        participant = room.participants.get(user_id) if room else None
+        if participant is None or (owner is not None and participant.owner is not owner):
+            return None
+        return participant
+    
+    async def handle_offer(self, room_id: int, user_id: int, username: str, offer: dict,
+                           send: Callable[[dict], Awaitable[None]], owner=None):
+        """Accept a participant's offer and reply with an sfu_answer.
+        
+        The offer's first audio section carries the microphone; every audio
+        section becomes a downlink slot for forwarded speakers. An offer from
+        the publishing socket renegotiates; one from another of the user's
+        sockets is refused rather than taking the session over.
+        """
+        current = self.participant(room_id, user_id)
+        if current is not None and owner is not None and current.owner is not owner:
+            await send({"type": "error", "message": "Voice is already active on another device"})
+            return
+        await self.leave(room_id, user_id)
+        room = self.rooms.setdefault(room_id, SfuRoom(room_id))
+        participant = SfuParticipant(user_id, username, send, owner)
+        room.participants[user_id] = participant
+        
+        @participant.pc.on("track")
+        def on_track(track):
+            if track.kind == "audio" and participant.uplink is None:
+                participant.uplink = track
+                participant.reader = asyncio.create_task(room.forward(participant))
+                room.assign()
+        
+        await participant.pc.setRemoteDescription(
+            RTCSessionDescription(sdp=offer["sdp"], type=offer["type"])
+        )
+        for transceiver in participant.pc.getTransceivers()[:MAX_SLOTS]:
+            if transceiver.kind == "audio":
+                slot = SlotTrack()
+                participant.pc.addTrack(slot)
+                participant.slots.append(slot)
+        room.assign()
+        for candidate in participant.pending_candidates:
+            await add_candidate(participant.pc, candidate)
+        participant.pending_candidates = []
+        
+        # Answer before gathering, then trickle our candidates
+        answer = await participant.pc.createAnswer()
+        await send({
+            "type": "sfu_answer",
+            "room_id": room_id,
+            "answer": {
+                "type": answer.type,
+                "sdp": answer.sdp
+            }
+        })
+        await participant.pc.setLocalDescription(answer)
+        for candidate in local_candidates(participant.pc):
+            await send({"type": "ice_candidate", "room_id": room_id, "candidate": candidate})
+        await send({"type": "ice_candidate", "room_id": room_id, "candidate": None})
+    
+    async def add_ice_candidate(self, room_id: int, user_id: int, candidate: Optional[dict], owner=None):
+        """Add a participant's trickled candidate, queueing it until the offer is applied"""
+        participant = self.participant(room_id, user_id, owner)
+        if participant is None:
+            return
+        if participant.pc.remoteDescription is None:
+            participant.pending_candidates.append(candidate)
+            return
+        await add_candidate(participant.pc, candidate)
+    
+    def subscribe(self, room_id: int, user_id: int, mode: str, users: Optional[List[int]] = None, owner=None):
+        """Change which speakers a participant receives"""
+        participant = self.participant(room_id, user_id, owner)
+        if participant is None or mode not in ("active_speakers", "all", "users"):
+            return
+        participant.mode = mode
+        participant.selected_users = list(users or [])
+        self.rooms[room_id].assign()
+    
+    def set_speaking(self, room_id: int, user_id: int, speaking: bool, owner=None):
+        """Feed voice activity into active-speaker selection"""
+        if self.participant(room_id, user_id, owner) is None:
+            return
+        room = self.rooms[room_id]
+        if speaking:
+            room.last_active[user_id] = time.monotonic()
+        if room.speaking.get(user_id) != speaking:
+            room.speaking[user_id] = speaking
+            room.assign()
+    
+    async def leave(self, room_id: int, user_id: int, owner=None):
+        """Remove a participant and close its peer connection.
+        
+        With owner given, only if that socket published it: another device
+        of the same user closing leaves the session alone.
+        """
+        if self.participant(room_id, user_id, owner) is None:
+            return
+        room = self.rooms[room_id]
+        participant = room.participants.pop(user_id)
+        room.speaking.pop(user_id, None)
+        room.last_active.pop(user_id, None)
+        if participant.reader:
+            participant.reader.cancel()
+        for slot in participant.slots:
+            slot.stop()
+        room.assign()
+        await participant.pc.close()
+        if not room.participants:
+            del self.rooms[room_id]
@@ -0,0 +1,261 @@
+"""
+SQL instrumentation
+Engine event hooks that time every statement, count statements per HTTP
+request or socket event, and log slow statements with their query plan
+"""
+
+import bisect
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+# Statements slower than this are logged with EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+# Upper bounds of the statements-per-scope histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+MAX_SLOW_ENTRIES = 100
+
+# Statements EXPLAIN QUERY PLAN can describe; DDL and pragmas are skipped
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+NOT_TABLE_SCANS = ("VIRTUAL TABLE", "CONSTANT ROW", "SUBQUERY")
+
+# Expanding IN lists would otherwise make one statement per list length
+IN_LIST = re.compile(r"\((?:\?, )+\?\)")
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+    
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+        return dict(zip(labels, self.counts))
+
+class StatementStats:
+    __slots__ = ("count", "total_ms", "max_ms", "latency")
+    
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+
+class ScopeStats:
+    __slots__ = ("count", "queries", "sql_ms", "max_queries", "per_scope")
+    
+    def __init__(self):
+        self.count = 0
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.max_queries = 0
+        self.per_scope = Histogram(QUERY_COUNT_BUCKETS)
+
+class QueryCounter:
+    """Statements run on behalf of one request or socket event"""
+    
+    __slots__ = ("name", "queries", "sql_ms")
+    
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.queries = 0
+        self.sql_ms = 0.0
+
+# The request or event the current task or thread is working for; copied
+# into asyncio.to_thread and threadpool calls with the rest of the context
+current_counter: contextvars.ContextVar[Optional[QueryCounter]] = contextvars.ContextVar(
+    "current_counter", default=None
+)
+
+def normalize(statement: str) -> str:
+    return IN_LIST.sub("(?...)", " ".join(statement.split()))
+
+def format_plan(rows) -> List[str]:
+    """EXPLAIN QUERY PLAN rows (id, parent, notused, detail) as indented lines"""
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+def is_full_scan(plan: List[str]) -> bool:
+    """Whether a plan reads every row of some table or index.
+    
+    SEARCH is an index lookup; SCAN visits everything, with or without an
+    index. FTS5 tables and materialized subqueries are not table scans.
+    """
+    for line in plan:
+        line = line.strip().upper()
+        if line.startswith("SCAN ") and not any(word in line for word in NOT_TABLE_SCANS):
+            return True
+    return False
+
+class SqlMetrics:
+    """Per-statement latency histograms, per-scope statement counts and a slow log"""
+    
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.statements: Dict[str, StatementStats] = {}
+        self.scopes: Dict[str, ScopeStats] = {}
+        self.plans: Dict[str, List[str]] = {}
+        self.slow = deque(maxlen=MAX_SLOW_ENTRIES)
+        self.started = time.time()
+    
+    def instrument(self, engine):
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+    
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context.sql_metrics_start = time.perf_counter()
+    
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - context.sql_metrics_start) * 1000
+        key = normalize(statement)
+        counter = current_counter.get()
+        if counter is not None:
+            counter.queries += 1
+            counter.sql_ms += elapsed_ms
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.count += 1
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            stats.latency.add(elapsed_ms)
+        if elapsed_ms >= self.slow_ms:
+            self.record_slow(conn, statement, key, parameters, executemany, elapsed_ms, counter)
+    
+    def record_slow(self, conn, statement, key, parameters, executemany, elapsed_ms, counter):
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.explain(conn, statement, parameters[0] if executemany and parameters else parameters)
+            self.plans[key] = plan
+            print(f"Slow query ({elapsed_ms:.1f} ms, {counter.name if counter else 'unscoped'}): {key}")
+            for line in plan:
+                print(f"  {line}")
+        self.slow.append({
+            "at": time.time(),
+            "ms": round(elapsed_ms, 2),
+            "scope": counter.name if counter else None,
+            "statement": key,
+            "full_scan": is_full_scan(plan),
+            "plan": plan
+        })
+    
+    @staticmethod
+    def explain(conn, statement: str, parameters) -> List[str]:
+        """Plan of a statement on the connection that just ran it.
+        
+        Goes straight to the DBAPI cursor so the EXPLAIN is not timed itself.
+        """
+        if statement.lstrip().split(None, 1)[0].upper() not in EXPLAINABLE:
+            return []
+        try:
+            cursor = conn.connection.dbapi_connection.cursor()
+            try:
+                cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ())
+                return format_plan(cursor.fetchall())
+            finally:
+                cursor.close()
+        except Exception as e:
+            return [f"(no plan: {e})"]
+    
+    @contextmanager
+    def scope(self, name: str):
+        """Count the statements run inside the block under name"""
+        counter = QueryCounter(name)
+        token = current_counter.set(counter)
+        try:
+            yield counter
+        finally:
+            current_counter.reset(token)
+            self.finish(counter)
+    
+    def finish(self, counter: QueryCounter):
+        with self.lock:
+            stats = self.scopes.get(counter.name)
+            if stats is None:
+                stats = self.scopes[counter.name] = ScopeStats()
+            stats.count += 1
+            stats.queries += counter.queries
+            stats.sql_ms += counter.sql_ms
+            stats.max_queries = max(stats.max_queries, counter.queries)
+            stats.per_scope.add(counter.queries)
+    
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.scopes.clear()
+            self.slow.clear()
+            self.started = time.time()
+    
+    def report(self, top: int = 20) -> dict:
+        """Slowest statements by total time, every scope, and the slow log"""
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda item: item[1].total_ms, reverse=True)
+            scopes = sorted(self.scopes.items(), key=lambda item: item[1].queries, reverse=True)
+            return {
+                "since": self.started,
+                "slow_query_ms": self.slow_ms,
+                "statements": [
+                    {
+                        "statement": key,
+                        "count": stats.count,
+                        "total_ms": round(stats.total_ms, 2),
+                        "mean_ms": round(stats.total_ms / stats.count, 3),
+                        "max_ms": round(stats.max_ms, 2),
+                        "latency_ms": stats.latency.to_dict()
+                    }
+                    for key, stats in statements[:top]
+                ],
+                "scopes": {
+                    name: {
+                        "count": stats.count,
+                        "queries": stats.queries,
+                        "queries_per_scope": round(stats.queries / stats.count, 2),
+                        "max_queries": stats.max_queries,
+                        "sql_ms": round(stats.sql_ms, 2),
+                        "histogram": stats.per_scope.to_dict()
+                    }
+                    for name, stats in scopes
+                },
+                "slow": list(self.slow)
+            }
+
+class QueryScopeMiddleware:
+    """Counts the statements of each HTTP request under its route template"""
+    
+    def __init__(self, app, metrics: SqlMetrics):
+        self.app = app
+        self.metrics = metrics
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        counter = QueryCounter()
+        token = current_counter.set(counter)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_counter.reset(token)
+            # The router fills in the matched route; unmatched paths share one name
+            route = scope.get("route")
+            counter.name = f"{scope['method']} {route.path if route else '(unmatched)'}"
+            self.metrics.finish(counter)
+
+# One instance per process, shared by every engine
+sql_metrics = SqlMetrics()
@@ -0,0 +1,158 @@
+"""
+Span tracing
+Timed spans for HTTP requests, socket events and room turns, with auth,
+SQL, serialization and fan-out inside them, written in the Chrome trace
+event format (chrome://tracing, Perfetto, speedscope)
+"""
+
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+# Tracing is off unless TRACE_DIR is set; each worker writes its own file
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+# Fraction of requests, socket events and room turns traced
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1.0"))
+TRACE_FLUSH_INTERVAL = 1.0
+WORKER_ID = int(os.getenv("CHAT_WORKER_ID", "0"))
+# Spans buffered beyond this are dropped until the next flush
+MAX_BUFFERED_SPANS = 100000
+
+class Span:
+    __slots__ = ("name", "cat", "args", "start_ns")
+    
+    def __init__(self, name: str, cat: str, args: dict):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start_ns = time.perf_counter_ns()
+
+# Id of the trace the current task or thread belongs to; every trace gets
+# its own row (tid) so interleaved async requests do not overlap
+current_trace: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_trace", default=None)
+
+class Tracer:
+    """Buffers complete ("X") events and appends them to a JSON trace file.
+    
+    The file is a JSON array left open at the end, which the trace viewers
+    accept, so it stays valid to load while the worker is still writing.
+    """
+    
+    def __init__(self, directory: str = TRACE_DIR, sample: float = TRACE_SAMPLE, worker_id: int = WORKER_ID):
+        self.enabled = bool(directory)
+        self.sample = sample
+        self.worker_id = worker_id
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, f"trace-{worker_id}-{self.pid}.json") if directory else None
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.events: List[dict] = []
+        self.dropped = 0
+        self.started = False
+    
+    @contextmanager
+    def trace(self, name: str, cat: str, **args):
+        """Root span of a request, socket event or room turn, if sampled"""
+        if not self.enabled or random.random() >= self.sample:
+            yield None
+            return
+        token = current_trace.set(next(self.ids))
+        try:
+            with self.span(name, cat, **args) as span:
+                yield span
+        finally:
+            current_trace.reset(token)
+    
+    @contextmanager
+    def span(self, name: str, cat: str, **args):
+        """Child span; a no-op outside a sampled trace"""
+        trace_id = current_trace.get()
+        if trace_id is None:
+            yield None
+            return
+        span = Span(name, cat, args)
+        try:
+            yield span
+        finally:
+            self.record(span.name, span.cat, span.start_ns, time.perf_counter_ns() - span.start_ns, trace_id, span.args)
+    
+    def record(self, name: str, cat: str, start_ns: int, duration_ns: int, trace_id: int, args: dict):
+        entry = {
+            "name": name, "cat": cat, "ph": "X", "pid": self.pid, "tid": trace_id,
+            "ts": start_ns / 1000, "dur": duration_ns / 1000
+        }
+        if args:
+            entry["args"] = args
+        with self.lock:
+            if len(self.events) < MAX_BUFFERED_SPANS:
+                self.events.append(entry)
+            else:
+                self.dropped += 1
+    
+    def instrument(self, engine):
+        """A "sql" span per statement run inside a trace"""
+        def before(conn, cursor, statement, parameters, context, executemany):
+            context.trace_start_ns = time.perf_counter_ns()
+        
+        def after(conn, cursor, statement, parameters, context, executemany):
+            trace_id = current_trace.get()
+            if trace_id is not None:
+                self.record("sql", "db", context.trace_start_ns, time.perf_counter_ns() - context.trace_start_ns,
+                            trace_id, {"statement": statement[:200]})
+        
+        if self.enabled:
+            event.listen(engine, "before_cursor_execute", before)
+            event.listen(engine, "after_cursor_execute", after)
+    
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            if not self.started:
+                self.started = True
+                f.write("[\n")
+                f.write(json.dumps({"name": "process_name", "ph": "M", "pid": self.pid,
+                                    "args": {"name": f"worker {self.worker_id}"}}) + ",\n")
+            f.write("".join(json.dumps(entry, separators=(",", ":")) + ",\n" for entry in events))
+    
+    async def run(self, interval: float = TRACE_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except OSError as e:
+                print(f"Trace flush failed: {e}")
+
+class TraceMiddleware:
+    """A root span per HTTP request, named by its route template"""
+    
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled:
+            return await self.app(scope, receive, send)
+        with self.tracer.trace(scope["path"], "http") as span:
+            await self.app(scope, receive, send)
+            route = scope.get("route")
+            if span is not None and route is not None:
+                span.name = f"{scope['method']} {route.path}"
+
+# One instance per process
+tracer = Tracer()
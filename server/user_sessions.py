@@ -0,0 +1,84 @@
+"""
+User session index
+Routes frames straight to every socket a user has open, on any device and
+in any room, without going through room fan-out
+"""
+
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional
+
+from fastapi import WebSocket
+
+from tracing import tracer
+
+# A session that cannot take a frame within this many seconds is skipped
+SEND_TIMEOUT = 5.0
+
+class Connection:
+    """Everything the server keeps for one open socket.
+    
+    Plain ids and the username only: no ORM objects or database sessions
+    live as long as the socket, and __slots__ drops the per-instance dict.
+    __weakref__ lets diagnostics track instances without keeping them alive.
+    """
+    
+    __slots__ = ("websocket", "user_id", "username", "room_id", "__weakref__")
+    
+    def __init__(self, websocket: WebSocket, user_id: int, username: str, room_id: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        self.room_id = room_id
+
+class UserSessions:
+    """user_id -> open connections of that user.
+    
+    Connections are added after the handshake and removed when that
+    socket's handler exits, so a user's other devices stay reachable when
+    one of them disconnects. Most users have one device, so a short list
+    is smaller than a set per user.
+    """
+    
+    def __init__(self, publish: Optional[Callable[[int, dict, Optional[int]], None]] = None):
+        self.sessions: Dict[int, List[Connection]] = {}
+        # Reaches the user's sessions on other workers
+        self.publish = publish
+    
+    def add(self, connection: Connection):
+        self.sessions.setdefault(connection.user_id, []).append(connection)
+    
+    def remove(self, connection: Connection):
+        sessions = self.sessions.get(connection.user_id)
+        if sessions is not None and connection in sessions:
+            sessions.remove(connection)
+            if not sessions:
+                del self.sessions[connection.user_id]
+    
+    def lookup(self, user_id: int, room_id: Optional[int] = None) -> List[Connection]:
+        """A user's connections, optionally only those open on one room"""
+        sessions = self.sessions.get(user_id, ())
+        return [connection for connection in sessions if room_id is None or connection.room_id == room_id]
+    
+    async def send(self, user_id: int, frame: dict, room_id: Optional[int] = None) -> int:
+        """Deliver a frame to a user's sessions on every worker.
+        
+        Returns how many sessions on this worker took it.
+        """
+        if self.publish:
+            self.publish(user_id, frame, room_id)
+        return await self.deliver(user_id, frame, room_id)
+    
+    async def deliver(self, user_id: int, frame: dict, room_id: Optional[int] = None) -> int:
+        """Deliver a frame to a user's sessions on this worker only"""
+        targets = self.lookup(user_id, room_id)
+        if not targets:
+            return 0
+        with tracer.span("encode", "serialize"):
+            text = json.dumps(frame)
+        with tracer.span("fanout", "fanout", sockets=len(targets), bytes=len(text)):
+            results = await asyncio.gather(
+                *(asyncio.wait_for(connection.websocket.send_text(text), SEND_TIMEOUT) for connection in targets),
+                return_exceptions=True
+            )
+        return sum(1 for result in results if not isinstance(result, Exception))
@@ -0,0 +1,188 @@
+"""
+Worker bus
+Unix datagram sockets between the worker processes of one node, so room
+broadcasts and per-user frames reach sockets held by the other workers
+"""
+
+import json
+import os
+import socket
+from typing import Callable, Dict, List, Optional
+
+# Larger payloads are split across datagrams, one group of frames each;
+# a single message over the limit is spooled to a file instead
+MAX_DATAGRAM = 64 * 1024
+SOCKET_BUFFER = 4 * 1024 * 1024
+# Messages over this are refused rather than spooled
+MAX_MESSAGE = 16 * 1024 * 1024
+
+class WorkerBus:
+    """Fire-and-forget messages to the other workers on this host.
+    
+    Each worker binds worker-<id>.sock in a shared directory and sends to
+    all the others, or to one with send_to. Delivery is best effort: a peer that is restarting or
+    whose receive buffer is full misses the datagram, which is counted in
+    dropped. A message that arrives unreadable is counted in lost. Clients
+    recover such gaps from history, as after a reconnect.
+    
+    A message too large for one datagram is written to a spool file in the
+    same directory, linked once per peer, and only its name is sent.
+    """
+    
+    def __init__(self, directory: Optional[str], worker_id: int, workers: int):
+        self.directory = directory
+        self.worker_id = worker_id
+        self.workers = workers
+        self.sock: Optional[socket.socket] = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.lost = 0
+        self.spooled = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.workers > 1
+    
+    def path(self, worker_id: int) -> str:
+        return os.path.join(self.directory, f"worker-{worker_id}.sock")
+    
+    def spool_prefix(self, worker_id: int) -> str:
+        return f"spool-to-{worker_id}-"
+    
+    def start(self, loop, on_message: Callable[[dict], None]):
+        if not self.enabled:
+            return
+        path = self.path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        # Spooled messages for the previous process of this worker
+        for name in os.listdir(self.directory):
+            if name.startswith(self.spool_prefix(self.worker_id)):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self.on_readable, on_message)
+    
+    def on_readable(self, on_message: Callable[[dict], None]):
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM * 2)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            try:
+                message = json.loads(data)
+                if "spool" in message:
+                    message = self.read_spool(message["spool"])
+            except (OSError, ValueError) as e:
+                self.lost += 1
+                print(f"Worker bus message unreadable: {e}")
+                continue
+            try:
+                on_message(message)
+            except Exception as e:
+                print(f"Worker bus message failed: {e}")
+    
+    def read_spool(self, name: str) -> dict:
+        # Only names under our own prefix, never a path from the datagram
+        if os.path.basename(name) != name or not name.startswith(self.spool_prefix(self.worker_id)):
+            raise ValueError(f"Bad spool name: {name!r}")
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                return json.loads(f.read())
+        finally:
+            os.unlink(path)
+    
+    def spool(self, data: bytes, worker_ids: List[int]) -> Dict[int, str]:
+        """Write data once and link it for each peer; peer id -> file name"""
+        self.spooled += 1
+        tmp_path = os.path.join(self.directory, f"spool-{os.getpid()}-{self.spooled}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        names = {}
+        try:
+            for worker_id in worker_ids:
+                name = f"{self.spool_prefix(worker_id)}{os.getpid()}-{self.spooled}.json"
+                os.link(tmp_path, os.path.join(self.directory, name))
+                names[worker_id] = name
+        finally:
+            os.unlink(tmp_path)
+        return names
+    
+    def publish(self, message: dict):
+        """Send to every other worker"""
+        self.send(message, [worker_id for worker_id in range(self.workers) if worker_id != self.worker_id])
+    
+    def send_to(self, worker_id: int, message: dict) -> bool:
+        """Send to one other worker; False when it was dropped"""
+        return self.send(message, [worker_id]) == 1
+    
+    def send(self, message: dict, worker_ids: List[int]) -> int:
+        """Number of workers the message reached"""
+        if self.sock is None or not worker_ids:
+            return 0
+        data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+        spooled: Dict[int, str] = {}
+        if len(data) > MAX_DATAGRAM:
+            if len(data) > MAX_MESSAGE:
+                self.dropped += len(worker_ids)
+                print(f"Worker bus message of {len(data)} bytes is over {MAX_MESSAGE}; not relayed")
+                return 0
+            try:
+                spooled = self.spool(data, worker_ids)
+            except OSError as e:
+                self.dropped += len(worker_ids)
+                print(f"Worker bus spool failed: {e}")
+                return 0
+        sent = 0
+        for worker_id in worker_ids:
+            if spooled:
+                data = json.dumps({"spool": spooled[worker_id]}).encode("utf-8")
+            try:
+                self.sock.sendto(data, self.path(worker_id))
+                self.sent += 1
+                sent += 1
+            except OSError:
+                # Peer restarting, gone, or its buffer is full
+                self.dropped += 1
+                if spooled:
+                    try:
+                        os.unlink(os.path.join(self.directory, spooled[worker_id]))
+                    except OSError:
+                        pass
+        return sent
+    
+    def publish_room(self, room_id: int, frames: List[str]):
+        """Relay already-encoded room frames, split to fit in datagrams"""
+        group, size = [], 0
+        for frame in frames:
+            if group and size + len(frame) > MAX_DATAGRAM:
+                self.publish({"room": room_id, "frames": group})
+                group, size = [], 0
+            group.append(frame)
+            size += len(frame)
+        if group:
+            self.publish({"room": room_id, "frames": group})
+    
+    def publish_user(self, user_id: int, frame: dict, room_id: Optional[int] = None):
+        self.publish({"user": user_id, "room": room_id, "frame": frame})
+    
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path(self.worker_id))
+            except OSError:
+                pass
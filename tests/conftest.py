@@ -0,0 +1,14 @@
+"""
+Test setup
+The server modules import each other by plain name and open ./chat.db, so
+tests run them from a scratch directory with server/ on the path
+"""
+
+import os
+import sys
+import tempfile
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+
+os.chdir(tempfile.mkdtemp(prefix="terminal-chat-tests-"))
+sys.path.insert(0, SERVER_DIR)
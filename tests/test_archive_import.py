@@ -0,0 +1,92 @@
+"""
+Importing history and then compacting it must not lose messages: imported
+rows keep their old timestamps but get ids above the live ones
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from archive import ColdStore, Compactor
+from database import ChatRoom, Message, SessionLocal, User, create_tables
+from history_io import import_records
+
+
+def setup_room(name):
+    create_tables()
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.username == "alice").first()
+        if user is None:
+            user = User(username="alice", email="alice@example.com", hashed_password="x", is_active=True)
+            db.add(user)
+            db.flush()
+        room = ChatRoom(name=name, created_by=user.id)
+        db.add(room)
+        db.commit()
+        return room.id, user.id
+    finally:
+        db.close()
+
+
+def add_message(room_id, user_id, content, timestamp):
+    db = SessionLocal()
+    try:
+        message = Message(content=content, user_id=user_id, room_id=room_id, timestamp=timestamp)
+        db.add(message)
+        db.commit()
+        return message.id
+    finally:
+        db.close()
+
+
+def hot_ids(room_id):
+    db = SessionLocal()
+    try:
+        return {row.id for row in db.execute(text("SELECT id FROM messages WHERE room_id = :room_id"),
+                                              {"room_id": room_id})}
+    finally:
+        db.close()
+
+
+def test_compaction_after_import_keeps_unarchived_rows(tmp_path):
+    room_id, user_id = setup_room("import-then-compact")
+    now = datetime.utcnow()
+    old = now - timedelta(days=90)
+    old_live = add_message(room_id, user_id, "old live message", old)
+    recent = [add_message(room_id, user_id, f"recent {i}", now) for i in range(3)]
+    result = import_records(
+        [{"username": "alice", "content": f"imported {i}", "timestamp": (old + timedelta(minutes=i)).isoformat()}
+         for i in range(5)],
+        room_id
+    )
+    assert result == {"imported": 5, "skipped": 0}
+    every_id = hot_ids(room_id)
+
+    store = ColdStore(str(tmp_path / "archive"))
+    compactor = Compactor(store, after_days=30, rows_per_second=10 ** 9)
+    asyncio.run(compactor.compact())
+    # A second pass must not move the boundary past the recent rows either
+    asyncio.run(compactor.compact())
+
+    hot = hot_ids(room_id)
+    cold = {row[0] for row in store.iter_after(room_id)}
+    assert cold == {old_live}
+    assert set(recent) <= hot
+    assert hot | cold == every_id
+    assert not hot & cold
+
+
+def test_crash_cleanup_only_deletes_archived_ids(tmp_path):
+    room_id, user_id = setup_room("crash-cleanup")
+    old = datetime.utcnow() - timedelta(days=90)
+    archived = [add_message(room_id, user_id, f"archived {i}", old) for i in range(3)]
+    recent = add_message(room_id, user_id, "recent", datetime.utcnow())
+    store = ColdStore(str(tmp_path / "archive"))
+    # A segment written, then a crash before its rows were deleted
+    store.add(room_id, [[message_id, user_id, "text", str(old), "archived"] for message_id in archived[1:]])
+
+    Compactor(store, after_days=30, rows_per_second=10 ** 9)._delete_leftovers(room_id, archived[-1])
+
+    assert hot_ids(room_id) == {archived[0], recent}
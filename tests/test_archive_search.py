@@ -0,0 +1,75 @@
+"""
+Archived messages stay searchable after the compactor moves them out of the
+hot table
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from archive import ColdStore, Compactor
+from database import RoomMembership, SessionLocal
+from search import search_messages
+from test_archive_import import add_message, hot_ids, setup_room
+
+
+def join(room_id, user_id):
+    db = SessionLocal()
+    try:
+        db.add(RoomMembership(room_id=room_id, user_id=user_id))
+        db.commit()
+    finally:
+        db.close()
+
+
+def search(store, word, user_id, room_id=None):
+    db = SessionLocal()
+    try:
+        return search_messages(db, store, [word], user_id, room_id)["results"]
+    finally:
+        db.close()
+
+
+def test_archived_messages_are_still_found(tmp_path):
+    room_id, user_id = setup_room("archived-search")
+    join(room_id, user_id)
+    old = datetime.utcnow() - timedelta(days=90)
+    archived = add_message(room_id, user_id, "the quokka census is done", old)
+    hot = add_message(room_id, user_id, "another quokka sighting", datetime.utcnow())
+    store = ColdStore(str(tmp_path / "archive"))
+
+    asyncio.run(Compactor(store, after_days=30, rows_per_second=10 ** 9).compact())
+
+    assert hot_ids(room_id) == {hot}
+    for room_filter in (None, room_id):
+        results = search(store, "quokka", user_id, room_filter)
+        assert {result["id"] for result in results} == {archived, hot}
+    [result] = search(store, "census", user_id)
+    assert result["id"] == archived
+    assert result["room_id"] == room_id
+    assert result["username"] == "alice"
+    assert "<mark>census</mark>" in result["snippet"]
+
+
+def test_segments_archived_before_the_index_are_backfilled(tmp_path):
+    room_id, user_id = setup_room("backfilled-search")
+    join(room_id, user_id)
+    old = datetime.utcnow() - timedelta(days=90)
+    archived = add_message(room_id, user_id, "an ocelot from long ago", old)
+    add_message(room_id, user_id, "recent", datetime.utcnow())
+    store = ColdStore(str(tmp_path / "archive"))
+    # Archived the old way: the segment is written and the delete trigger
+    # drops the row from the search index
+    store.add(room_id, [[archived, user_id, "text", str(old), "an ocelot from long ago"]])
+    db = SessionLocal()
+    try:
+        db.execute(text("DELETE FROM messages WHERE id = :id"), {"id": archived})
+        db.commit()
+    finally:
+        db.close()
+    assert search(store, "ocelot", user_id) == []
+
+    asyncio.run(Compactor(store, after_days=30, rows_per_second=10 ** 9).compact())
+
+    assert [result["id"] for result in search(store, "ocelot", user_id, room_id)] == [archived]
@@ -0,0 +1,75 @@
+"""
+Attachment downloads: byte ranges for resuming, and access limited to the
+uploader and members of rooms the file was posted in
+"""
+
+import hashlib
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from database import User
+from test_archive_import import setup_room
+
+DATA = os.urandom(300000)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def clear_overrides():
+    yield
+    main.app.dependency_overrides.clear()
+
+
+def client_for(user_id):
+    main.app.dependency_overrides[main.get_current_user] = lambda: User(id=user_id, username=f"user{user_id}")
+    return TestClient(main.app)
+
+
+@pytest.fixture(scope="module")
+def owner_id():
+    _, owner_id = setup_room("attachments")
+    upload = main.attachment_store.create_upload(owner_id, "data.bin", len(DATA))
+    with open(main.attachment_store.part_path(upload.id), "wb") as f:
+        f.write(DATA)
+    assert main.attachment_store.finish(upload) == SHA256
+    return owner_id
+
+
+def test_range_requests_get_partial_content(owner_id):
+    client = client_for(owner_id)
+    url = f"/attachments/{SHA256}"
+
+    response = client.get(url, headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 1000-1999/{len(DATA)}"
+    assert response.content == DATA[1000:2000]
+
+    response = client.get(url, headers={"Range": "bytes=-500"})
+    assert response.status_code == 206
+    assert response.content == DATA[-500:]
+
+    # Resuming: everything from an offset
+    response = client.get(url, headers={"Range": "bytes=250000-"})
+    assert response.status_code == 206
+    assert response.content == DATA[250000:]
+
+    response = client.get(url, headers={"Range": f"bytes={len(DATA)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(DATA)}"
+
+    # A stale validator gets the whole, current file
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"something-else"'})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.content == DATA
+
+
+def test_other_users_cannot_fetch_by_hash(owner_id):
+    assert client_for(owner_id + 1000).get(f"/attachments/{SHA256}").status_code == 404
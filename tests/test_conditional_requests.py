@@ -0,0 +1,30 @@
+"""
+History revalidation: If-None-Match is a list of tags, weak or strong, or *
+"""
+
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+import main
+from database import User
+from test_archive_import import add_message, setup_room
+from test_archive_search import join
+
+
+def test_history_if_none_match_lists_and_weak_tags():
+    room_id, user_id = setup_room("revalidated")
+    join(room_id, user_id)
+    add_message(room_id, user_id, "hello", datetime.utcnow())
+    main.app.dependency_overrides[main.get_current_user] = lambda: User(id=user_id, username="alice")
+    try:
+        client = TestClient(main.app)
+        url = f"/rooms/{room_id}/messages"
+        etag = client.get(url).headers["etag"]
+
+        for header in (etag, f"W/{etag}", f'"other", {etag}', f'W/"other",W/{etag}', "*"):
+            assert client.get(url, headers={"If-None-Match": header}).status_code == 304, header
+        for header in ('"other"', f'W/"x{etag[1:]}', ""):
+            assert client.get(url, headers={"If-None-Match": header}).status_code == 200, header
+    finally:
+        main.app.dependency_overrides.clear()
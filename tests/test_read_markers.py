@@ -0,0 +1,40 @@
+"""
+Read markers never move past a room's newest message, whatever id a client
+acknowledges
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import SessionLocal
+from read_markers import ReadMarkerBuffer
+from test_archive_import import add_message, setup_room
+from test_archive_search import join
+
+
+def marker(room_id, user_id):
+    db = SessionLocal()
+    try:
+        return tuple(db.execute(text("""
+            SELECT last_read_message_id, unread_count FROM room_memberships
+            WHERE room_id = :room_id AND user_id = :user_id
+        """), {"room_id": room_id, "user_id": user_id}).one())
+    finally:
+        db.close()
+
+
+def test_ack_past_the_newest_message_is_capped():
+    room_id, user_id = setup_room("read-cap")
+    join(room_id, user_id)
+    newest = add_message(room_id, user_id, "hello", datetime.utcnow())
+    buffer = ReadMarkerBuffer()
+
+    buffer.write({(user_id, room_id): 10 ** 9})
+    assert marker(room_id, user_id) == (newest, 0)
+
+    # A later message can still be marked read; the made-up id did not
+    # move the marker past it
+    later = add_message(room_id, user_id, "later", datetime.utcnow())
+    buffer.write({(user_id, room_id): later})
+    assert marker(room_id, user_id) == (later, 0)
@@ -0,0 +1,79 @@
+"""
+Room actors: resends are deduplicated per sender and room
+"""
+
+import asyncio
+import json
+
+from room_actors import RoomActors
+from test_archive_import import setup_room
+from user_sessions import Connection
+
+
+class FakeSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    def acks(self):
+        return [ack for frame in self.frames if frame["type"] == "ack" for ack in frame["messages"]]
+
+
+async def send_chat(actors, connection, room_id, content, client_id):
+    await actors.send(room_id, ("chat", connection, [content], [client_id], "text"))
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if actors.actors[room_id].inbox.empty() and connection.websocket.acks():
+            break
+
+
+def test_client_id_reused_in_another_room_is_a_new_message():
+    first_room, user_id = setup_room("dedup-first")
+    second_room, _ = setup_room("dedup-second")
+
+    async def scenario():
+        actors = RoomActors()
+        sockets = []
+        for room_id in (first_room, second_room, first_room):
+            socket = FakeSocket()
+            await send_chat(actors, Connection(socket, user_id, "alice", room_id), room_id, f"hi {room_id}", "same-id")
+            sockets.append(socket)
+        # Forgetting the window sends the resend through the database lookup
+        await send_chat(RoomActors(), Connection(sockets[2], user_id, "alice", first_room), first_room, "again", "same-id")
+        await actors.stop()
+        return [socket.acks() for socket in sockets]
+
+    first, second, resent = asyncio.run(scenario())
+
+    assert not first[0]["duplicate"] and not second[0]["duplicate"]
+    assert first[0]["id"] != second[0]["id"]
+    assert [ack["duplicate"] for ack in resent] == [True, True]
+    assert {ack["id"] for ack in resent} == {first[0]["id"]}
+
+
+def test_failed_relay_does_not_stop_the_room():
+    room_id, user_id = setup_room("relay-failure")
+
+    def publish(room_id, frames):
+        raise OSError("bus is down")
+
+    async def scenario():
+        actors = RoomActors(publish=publish)
+        socket = FakeSocket()
+        connection = Connection(socket, user_id, "alice", room_id)
+        await actors.send(room_id, ("join", connection))
+        await send_chat(actors, connection, room_id, "first", "relay-1")
+        await send_chat(actors, connection, room_id, "second", "relay-2")
+        actor = actors.actors[room_id]
+        assert not actor.task.done()
+        # A crashed actor is not handed further events
+        actor.task.cancel()
+        await asyncio.gather(actor.task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert room_id not in actors.actors
+        await actors.stop()
+        return [frame["content"] for frame in socket.frames if frame["type"] == "chat_message"]
+
+    assert asyncio.run(scenario()) == ["first", "second"]
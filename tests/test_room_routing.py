@@ -0,0 +1,67 @@
+"""
+With two workers, chat sent on the worker that does not own the room is
+stored and ordered by the owner, and the sender still gets its frames and ack
+"""
+
+import asyncio
+
+from room_actors import RoomActors
+from room_routing import RoomRouter
+from test_archive_import import hot_ids, setup_room
+from test_room_actors import FakeSocket
+from user_sessions import Connection
+from worker_bus import WorkerBus
+
+
+def start_worker(directory, worker_id, loop):
+    bus = WorkerBus(directory, worker_id, 2)
+    rooms = RoomActors(publish=bus.publish_room)
+    router = RoomRouter(rooms, bus)
+
+    def on_message(message):
+        if "frames" in message:
+            rooms.relay(message["room"], message["frames"])
+        else:
+            router.receive(message)
+
+    bus.start(loop, on_message)
+    return bus, rooms, router
+
+
+def test_chat_on_another_worker_goes_through_the_owner(tmp_path):
+    room_id, user_id = setup_room("routed")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        workers = [start_worker(str(tmp_path), worker_id, loop) for worker_id in range(2)]
+        bus, rooms, router = workers[1 - room_id % 2]
+        socket = FakeSocket()
+        connection = Connection(socket, user_id, "alice", room_id)
+        try:
+            await rooms.send(room_id, ("join", connection))
+            for i in range(3):
+                await router.send_chat(room_id, ("chat", connection, [f"routed {i}"], [f"routed-{i}"], "text"))
+            for _ in range(200):
+                if len(socket.acks()) == 3:
+                    break
+                await asyncio.sleep(0.01)
+            return socket, router
+        finally:
+            for worker_bus, worker_rooms, _ in workers:
+                await worker_rooms.stop()
+                worker_bus.close()
+
+    socket, router = asyncio.run(scenario())
+
+    chat = [frame for frame in socket.frames if frame["type"] == "chat_message"]
+    assert [frame["content"] for frame in chat] == ["routed 0", "routed 1", "routed 2"]
+    assert [ack["client_msg_id"] for ack in socket.acks()] == ["routed-0", "routed-1", "routed-2"]
+    # Every ack follows its message
+    seen = set()
+    for frame in socket.frames:
+        if frame["type"] == "chat_message":
+            seen.add(frame["id"])
+        elif frame["type"] == "ack":
+            assert {ack["id"] for ack in frame["messages"]} <= seen
+    assert {frame["id"] for frame in chat} <= hot_ids(room_id)
+    assert router.forwarded == 3
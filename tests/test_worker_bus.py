@@ -0,0 +1,59 @@
+"""
+Frames relayed between workers arrive whole, however large
+"""
+
+import asyncio
+import os
+
+from worker_bus import MAX_DATAGRAM, WorkerBus
+
+
+async def relay(directory, publish, expected):
+    sender, receiver = WorkerBus(directory, 0, 2), WorkerBus(directory, 1, 2)
+    received = []
+    loop = asyncio.get_running_loop()
+    try:
+        receiver.start(loop, received.append)
+        sender.start(loop, lambda message: None)
+        publish(sender)
+        for _ in range(200):
+            if len(received) >= expected:
+                break
+            await asyncio.sleep(0.01)
+        return received, sender, receiver
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_frame_over_datagram_limit_crosses_the_bus(tmp_path):
+    big_frame = '{"type":"chat_message","content":"' + "x" * (64 * MAX_DATAGRAM) + '"}'
+    user_frame = {"type": "mention", "preview": "y" * (2 * MAX_DATAGRAM)}
+
+    def publish(bus):
+        bus.publish_room(7, ['{"type":"typing"}', big_frame, '{"type":"read"}'])
+        bus.publish_user(3, user_frame, room_id=7)
+
+    received, sender, receiver = asyncio.run(relay(str(tmp_path), publish, 4))
+
+    assert received == [
+        {"room": 7, "frames": ['{"type":"typing"}']},
+        {"room": 7, "frames": [big_frame]},
+        {"room": 7, "frames": ['{"type":"read"}']},
+        {"user": 3, "room": 7, "frame": user_frame},
+    ]
+    assert sender.dropped == 0
+    assert receiver.lost == 0
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("spool")]
+
+
+def test_unreadable_spool_is_counted_as_lost(tmp_path):
+    def publish(bus):
+        # A spooled message whose file is gone, then a whole small one
+        bus.sock.sendto(b'{"spool":"spool-to-1-gone.json"}', bus.path(1))
+        bus.publish({"room": 1, "frames": []})
+
+    received, _, receiver = asyncio.run(relay(str(tmp_path), publish, 1))
+
+    assert received == [{"room": 1, "frames": []}]
+    assert receiver.lost == 1